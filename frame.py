@@ -7,8 +7,9 @@ import re
 import json
 import datetime
 import asyncio
-from memory.memory import MemoryStorage
+from memory.memory import MemoryStorage, retrieve_many
 from memory.base import MemoryChunk, MemoryPiece
+from memory.context import assemble_context
 from dotenv import load_dotenv
 from models import get_llm_service
 
@@ -19,6 +20,23 @@ RECENT_MEMORY_LEN = int(os.getenv("RECENT_MEMORY_LEN") or 6)
 GLOBAL_RECENT_MEMORY_LEN = int(os.getenv("GLOBAL_RECENT_MEMORY_LEN") or 10)
 RETRIEVE_THRESHOLD = int(os.getenv("RETRIEVE_THRESHOLD") or 6)
 DIRECTOR_RETRIEVE_THRESHOLD = int(os.getenv("DIRECTOR_RETRIEVE_THRESHOLD") or 10)
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET") or 1000) # retrieved memory per character prompt, 0: no limit
+RECORDS_TOKEN_BUDGET = int(os.getenv("RECORDS_TOKEN_BUDGET") or 2000) # retrieved records per director prompt, 0: no limit
+RECORD_VIEWER = "__director__" # viewer id of the director in the shared event log: every scene record, no character's private lines
+
+def format_retrieved_records(retrieved, token_budget):
+    """
+    Prompt text for a retrieval result, and the {"Score", "Info"} list kept as last_retrieved.
+    Only what assemble_context keeps goes in: best chunks first, overlapping lines once, within token_budget.
+    """
+    last_retrieved = []
+    records = "The script records are too long, so we get some chunks which may be relevant to the current dialogues from the record storage.\n"
+    for _, kept_list in assemble_context(retrieved, token_budget).items():
+        records += "\n\nChunk:"
+        for kept in kept_list:
+            last_retrieved.append({"Score": kept["score"], "Info": kept["text"]})
+            records += f"\n{kept['chunk'].to_text(kept['text'])}"
+    return records, last_retrieved
 
 class Scene:
     def __init__(self, id = None, config={}):
@@ -30,6 +48,7 @@ class Scene:
         assert self.id
         self.characters =  {}
         self.record = []
+        self.visibility = [] # aligned with record: the characters who saw each line (None for everyone)
 
     @property
     def state(self):
@@ -50,6 +69,7 @@ class Scene:
         if len(self.record) == 1:
             print("withdraw one record for -stay")
             self.record.clear()
+            self.visibility.clear()
             for _, c in self.characters.items():
                 c.delete_memory()
             return 1            
@@ -79,7 +99,7 @@ class Scene:
                         c.delete_memory()
                     c.recent_memory = c.get_memory_list_from_dict()[-RECENT_MEMORY_LEN:]
                 for _ in range(cnt):
-                    self.record.pop()                
+                    self.pop_record()
                 return cnt
             elif self.mode == "v2":
                 pattern = r"(\S+)对(\S+)说" if not ENGLISH_MODE else r"(\S+) speak to (\S+)"
@@ -96,8 +116,8 @@ class Scene:
                             self.characters[m].delete_memory()
                         self.characters[m].delete_memory()
                         self.characters[m].delete_recent_memory()
-                self.record.pop()
-                self.record.pop()
+                self.pop_record()
+                self.pop_record()
                 return 2
 
     def add_character(self, char, motivation):
@@ -114,17 +134,28 @@ class Scene:
         char.loc = "W"
         # return char
         
-    def update_dialogues_record(self, a="", x="", b="", c="", y="", **kwargs):
+    def pop_record(self):
+        self.record.pop()
+        if len(self.visibility) > len(self.record):
+            self.visibility.pop()
+
+    def update_dialogues_record(self, a="", x="", b="", c="", y="", visible_to=None, **kwargs):
         m = {"a": a, "x": x, "b": b, "c": c, "y": y}
         m.update(kwargs)
         self.record.append(action_to_text(m))
+        self.visibility.append(sorted(visible_to) if visible_to is not None else None)
 
 
 class World:
     def __init__(self, config={}, storage_mode = STORAGE_MODE, storager = None):
         self.storage_mode = storage_mode
         self.raw_records = {}
+        self.record_visibility = {} # {scene_id: scene.visibility}
+        self.private_records = {} # {scene_id: [[position, line, visible_to]]} event log lines that are not scene records, logged after `position` records
         self.record_storage = storager
+        # The record storage is the shared event log: every line is stored once, with the characters who saw it,
+        # and each character's memory is a view of it instead of a storage of its own
+        self.event_log = storager if storage_mode else None
 
         if "scenes" in config and isinstance(config["scenes"], dict):
             for sid, s in config["scenes"].items():
@@ -141,7 +172,7 @@ class World:
             self.narrative = background["narrative"]
         # print("yaml_print_background", background)
         for cid, char in background.get("characters").items():    
-            self.characters.update({cid: CharacterLLM(config = {"id": cid, "profile": char}, storage_mode = storage_mode)})
+            self.characters.update({cid: CharacterLLM(config = {"id": cid, "profile": char}, storage_mode = storage_mode, world = self)})
         self.player = self.characters[background.get("player")]
         if "context" in background and isinstance(background["context"], dict):
             for cid, message in background["context"].items():
@@ -167,13 +198,14 @@ class World:
     def save(self):
         save_id = self.id+str(datetime.datetime.now().strftime("_%m%d_%H%M%S"))
         write_json(self.state, f'{self.save_dir}/{save_id}.yml')
+        self.save_memory_snapshots(save_id)
         return save_id
 
     def load(self, save_id):
         state = read_json(f'{self.save_dir}/{save_id}.yml')
         if "characters" in state:
             for cid, char in state["characters"].items():
-                self.characters[cid].load(char)
+                self.characters[cid].load(char, self.memory_snapshot_prefix(save_id, cid))
         if "scenes" in state:
             for sid, s in state["scenes"].items():
                 self.add_scene(sid)
@@ -183,11 +215,79 @@ class World:
         if "raw_records" in state:
             for sid, record in state["raw_records"].items():
                 self.scenes[sid].record = record
+                self.record_visibility[sid] = self.scenes[sid].visibility = state.get("record_visibility", {}).get(sid) or [None] * len(record)
+            self.private_records = state.get("private_records", {})
             if self.storage_mode:
-                self.record_storage.reset()
-                self.record_storage.load_dialogues_record(state["raw_records"], current_scene_id="scene"+str(self.scene_cnt))
+                self.load_event_log(save_id, "scene"+str(self.scene_cnt))
+
+    def event_log_records(self):
+        """
+        What the record storage holds, as load_dialogues_record input: the scene records, plus the private records
+        at the place they were logged when the storage is the shared event log, so a rebuild gives the chunks of the
+        live session. Returns (records, visibility).
+        """
+        records = {sid: list(record) for sid, record in self.raw_records.items()}
+        visibility = {sid: [self.record_visible_to(viewers) for viewers in self.record_visibility.get(sid) or [None] * len(record)]
+                      for sid, record in self.raw_records.items()}
+        if self.event_log is None:
+            return records, visibility
+        # Lines logged before the first scene (the characters' context) come first, as they did live
+        records = {**{sid: [] for sid in self.private_records if sid not in records}, **records}
+        for sid, private in self.private_records.items():
+            lines, viewers = [], []
+            record, record_viewers = records.get(sid, []), visibility.get(sid, [])
+            j = 0
+            for i in range(len(record) + 1):
+                while j < len(private) and private[j][0] <= i:
+                    lines.append(private[j][1])
+                    viewers.append(private[j][2])
+                    j += 1
+                if i < len(record):
+                    lines.append(record[i])
+                    viewers.append(record_viewers[i])
+            records[sid], visibility[sid] = lines + [line for _, line, _ in private[j:]], viewers + [v for _, _, v in private[j:]]
+        return records, visibility
+
+    def log_private(self, scene_id, line, visible_to):
+        """Logs a line that is not a scene record (e.g. a character's context) into the event log, for visible_to only."""
+        self.private_records.setdefault(scene_id, []).append([len(self.raw_records.get(scene_id, [])), line, sorted(visible_to)])
+        if self.event_log is not None:
+            self.event_log.add_piece(line, layer = "event", tag = "conversation", scene_id = scene_id, visible_to = visible_to)
+
+    def withdraw_private_records(self, scene_id):
+        """Drops the private records logged after scene records that were withdrawn."""
+        if scene_id in self.private_records:
+            kept = len(self.raw_records.get(scene_id, []))
+            self.private_records[scene_id] = [entry for entry in self.private_records[scene_id] if entry[0] <= kept]
+
+    def rebuild_event_log(self, current_scene_id):
+        records, visibility = self.event_log_records()
+        self.record_storage.reset()
+        self.record_storage.load_dialogues_record(records, current_scene_id=current_scene_id, visibility=visibility)
+
+    def load_event_log(self, save_id, current_scene_id):
+        """Restores the record storage from the snapshot of the save, or rebuilds it from the records."""
+        records, visibility = self.event_log_records()
+        if not self.record_storage.load_snapshot(self.memory_snapshot_prefix(save_id), records, current_scene_id, visibility):
+            self.rebuild_event_log(current_scene_id)
+
+    def memory_snapshot_prefix(self, save_id, cid=None):
+        """Memory snapshots are stored next to the save, in {save_id}.memory/ (one per character plus the record storage)."""
+        name = "record" if cid is None else "character_" + "".join(c if c.isalnum() or c in "-_." else "_" for c in cid)
+        return os.path.join(self.save_dir, f"{save_id}.memory", name)
+
+    def save_memory_snapshots(self, save_id):
+        if not self.storage_mode:
+            return
+        if self.record_storage:
+            records, visibility = self.event_log_records()
+            self.record_storage.save_snapshot(self.memory_snapshot_prefix(save_id), records, "scene"+str(self.scene_cnt), visibility)
+        for cid, char in self.characters.items():
+            if char.storage_mode and char.event_log is None:
+                char.storage.save_snapshot(self.memory_snapshot_prefix(save_id, cid), char.memory, char.loc)
 
     def add_characters(self, char):
+        char.join_world(self)
         self.characters.update({char.id: char})
         for sid, scene in self.scenes.items():
             scene.add_character(char)
@@ -203,7 +303,7 @@ class World:
         """Add a new scene to the world."""
         last_scene = self.scenes[f"scene{self.scene_cnt}"] if len(self.scenes) else None
         if self.storage_mode and last_scene:
-                self.record_storage.summarize(last_scene.id)
+                self.record_storage.summarize(last_scene.id, background=True)
         if not scene_id:
             scene_id = f"scene{self.scene_cnt + 1}"
             self.scene_cnt += 1
@@ -230,6 +330,7 @@ class World:
         for cid, _ in scene.characters.items():
             self.update_view(cid)
         self.raw_records.update({scene.id: scene.record})
+        self.record_visibility.update({scene.id: scene.visibility})
 
 
     @property
@@ -237,6 +338,8 @@ class World:
         state = {
             "id": self.id,
             "raw_records": self.raw_records,
+            "record_visibility": self.record_visibility,
+            "private_records": self.private_records,
             "characters": {k: v.state for k, v in self.characters.items()},
             "scenes": {k: v.state for k, v in self.scenes.items()},
             "scene_cnt": self.scene_cnt,
@@ -260,12 +363,19 @@ class World:
         for char_id in self.characters:
             self.characters[char_id].to_do = True if char_id == action["aid"] else False
 
+    def log_leave(self, src, trg):
+        """src leaves the conversation with trg: logged once for the two of them, each remembering it in their own words."""
+        if self.event_log is not None:
+            visible_to = [char.id for char in (trg, src) if char.status != "/faint/"]
+            self.log_private(src.loc, action_to_text({"a": src.id, "x": "-leave", "b": trg.id}), visible_to)
+        trg.update_memory(src.id, "-leave", trg.id, logged=True)
+        src.update_memory(src.id, "-leave", trg.id, logged=True)
+
     def _calculate(self, aid, x, bid=None, cid=None, **kwargs):
         src = self.characters[aid]
         if x == "-leave":
             trg = src.interact_with
-            trg.update_memory(src.id, "-leave", src.interact_with.id)
-            src.update_memory(src.id, "-leave", src.interact_with.id)
+            self.log_leave(src, trg)
             trg.interact_with = None
             trg.to_do = None
             src.interact_with = None
@@ -279,8 +389,7 @@ class World:
                 src.interact(x, cid, **kwargs)
             else:
                 trg = src.interact_with
-                trg.update_memory(src.id, "-leave", src.interact_with.id)
-                src.update_memory(src.id, "-leave", src.interact_with.id)
+                self.log_leave(src, trg)
                 trg.interact_with = None
                 trg.to_do = None
                 src.interact_with = self.characters[bid]
@@ -296,7 +405,9 @@ class World:
                 self.characters[bid].interact_with = src
                 src.interact(x, cid, **kwargs)
         scene = self.scenes[src.loc]
-        self.update_dialogues_record(scene, aid, x, bid, cid, **kwargs)
+        # Only the two characters of the interaction heard it
+        visible_to = [src.id] + ([src.interact_with.id] if src.interact_with else [])
+        self.update_dialogues_record(scene, aid, x, bid, cid, visible_to=visible_to, **kwargs)
 
     def calculate(self, aid, x, bid=None, cid=None, **kwargs):
         print(f"calculate, aid = {aid}, x = {x}, bid = {bid}, cid = {cid}, kwargs = {kwargs}")
@@ -310,8 +421,9 @@ class World:
             # print("v1_from", src.id, src.loc)
             scene = self.scenes[src.loc]
             for t in scene.characters:
-                self.characters[t].update_memory(src.id, x, bid, content=kwargs["content"])
-            self.update_dialogues_record(scene, aid, x, bid, cid, **kwargs)
+                self.characters[t].update_memory(src.id, x, bid, content=kwargs["content"], logged=True)
+            visible_to = [t for t in scene.characters if self.characters[t].status != "/faint/"]
+            self.update_dialogues_record(scene, aid, x, bid, cid, visible_to=visible_to, **kwargs)
         elif mode == "v3":
             if isinstance(bid, list):
                 if bid == []:
@@ -323,15 +435,21 @@ class World:
         if aid != self.player.id:
             self.timestamp += 1
 
-    def update_dialogues_record(self, scene, a="", x="", b="", c="", y="", **kwargs):
+    @staticmethod
+    def record_visible_to(visible_to):
+        """Event log visibility of a scene record: the characters who saw it, and the director (None: everyone)."""
+        return None if visible_to is None else list(visible_to) + [RECORD_VIEWER]
+
+    def update_dialogues_record(self, scene, a="", x="", b="", c="", y="", visible_to=None, **kwargs):
+        """visible_to: the characters who saw the action; their memories retrieve it from the shared event log."""
         # m = {"a": a, "x": x, "b": b, "c": c, "y": y}
         # m.update(kwargs)
         # scene.record.append(action_to_text(m))
         if self.storage_mode:
             m = {"a": a, "x": x, "b": b, "c": c, "y": y}
             m.update(kwargs)
-            self.record_storage.add_piece(action_to_text(m), layer = "event", tag="conversation", scene_id=scene.id)
-        scene.update_dialogues_record(a, x, b, c, y, **kwargs)
+            self.record_storage.add_piece(action_to_text(m), layer = "event", tag="conversation", scene_id=scene.id, visible_to=self.record_visible_to(visible_to))
+        scene.update_dialogues_record(a, x, b, c, y, visible_to=visible_to, **kwargs)
             
             
 class Character:
@@ -386,7 +504,7 @@ class Character:
     def get_available_acts(self):
         pass
 
-    def update_memory(self, a="", x="", b="", c="", y="", **kwargs):
+    def update_memory(self, a="", x="", b="", c="", y="", logged=False, **kwargs):
         """Update the character's memory with a new action."""
         if self.status == "/faint/":
             return
@@ -438,7 +556,7 @@ class Character:
         self.recent_memory = []
 
 class CharacterLLM(Character):
-    def __init__(self, id=None, config={}, storage_mode=STORAGE_MODE, retrieve_threshold=RETRIEVE_THRESHOLD):
+    def __init__(self, id=None, config={}, storage_mode=STORAGE_MODE, retrieve_threshold=RETRIEVE_THRESHOLD, world=None):
         super().__init__(id, config)
         self.plan = []
         self.decision = []
@@ -452,8 +570,10 @@ class CharacterLLM(Character):
         self.memory = {}
         
         self.storage_mode = storage_mode
+        self.world = world
+        self.event_log = world.event_log if world is not None else None # shared event log (the world's record storage), None for a storage of its own
         if self.storage_mode:
-            self.storage = MemoryStorage()
+            self.storage = self.event_log if self.event_log is not None else MemoryStorage()
         else:
             self.storage = None
         self.retrieve_threshold = retrieve_threshold
@@ -461,12 +581,30 @@ class CharacterLLM(Character):
 
     def clear_memory(self):
         self.recent_memory = []
-        if self.storage_mode:
+        if self.storage_mode and self.event_log is None:
             self.storage.reset()
         self.memory = {}
 
+    def join_world(self, world):
+        """Moves a character made outside the world to its shared event log; what it remembers is logged as its private lines."""
+        if self.world is world or world.event_log is None:
+            self.world = world
+            return
+        self.world, self.event_log = world, world.event_log
+        if self.storage_mode:
+            for sid, lines in self.memory.items():
+                for line in lines:
+                    world.log_private(sid, self.private_line(line), [self.id])
+            self.storage = self.event_log
 
-    def load(self, state):
+    @property
+    def memory_viewer(self):
+        """Viewer id for retrieval: the shared event log is filtered to what this character saw."""
+        return self.id if self.event_log is not None else None
+
+
+    def load(self, state, snapshot_prefix=None):
+        """snapshot_prefix: memory snapshot written with the save; the storage is rebuilt from the records if it is unusable."""
         self.status = state["status"]
         self.loc = state["loc"]
         self.view = state["view"]
@@ -474,9 +612,11 @@ class CharacterLLM(Character):
         self.recent_memory = state["recent_memory"]
         self.motivation = state["motivation"]
         self.plan = state["plan"]
-        if self.storage_mode:
-            self.storage.reset()
-            self.storage.load_dialogues_record(state["memory"], current_scene_id=self.loc)
+        # With a shared event log, the world restores it after loading the characters
+        if self.storage_mode and self.event_log is None:
+            if not (snapshot_prefix and self.storage.load_snapshot(snapshot_prefix, state["memory"], self.loc)):
+                self.storage.reset()
+                self.storage.load_dialogues_record(state["memory"], current_scene_id=self.loc)
 
     @property
     def state(self):
@@ -491,7 +631,7 @@ class CharacterLLM(Character):
             "plan": self.plan,
             "profile": self.profile,
             "motivation": self.motivation,
-            "chunks": self.storage.all_chunks_values() if self.storage_mode else [],
+            "chunks": self.storage.all_chunks_values(viewer=self.memory_viewer) if self.storage_mode else [],
             "last_retrieved": self.last_retrieved
         }
         return state
@@ -510,24 +650,54 @@ class CharacterLLM(Character):
                 memory_list.extend(memory_dict[scene_id])
         return memory_list
 
-    def get_memory(self, query=None, scene_id=None):
+    def memory_query(self, query=None):
+        """The query get_memory retrieves with (by default the last record), or None when the whole record fits."""
         if self.storage_mode and len(self.get_memory_list_from_dict()) >= self.retrieve_threshold:
-            if not query:
-                query = self.get_memory_list_from_dict()[-1]
-            retrieved = self.storage.retrieve(query, ["event"], scene_id)
-            self.last_retrieved = []
-            records = "The script records are too long, so we get some chunks which may be relevant to the current dialogues from the record storage.\n"
-            for _, last_list in retrieved.items():
-                records += "\n\nChunk:"
-                for last in last_list:
-                    self.last_retrieved.append({"Score": last['score'], "Info": last["chunk"].text})
-                    records += f"\n{last['chunk'].to_text()}"
-            return records
+            return query or self.get_memory_list_from_dict()[-1]
+        return None
+
+    def get_memory(self, query=None, scene_id=None):
+        query = self.memory_query(query)
+        if query is not None:
+            retrieved = self.storage.retrieve(query, self.storage.recall_layers, scene_id, viewer=self.memory_viewer)
+            return self.format_retrieved(retrieved)
         return dumps(self.get_memory_list_from_dict())
+
+    @staticmethod
+    def get_memories(characters, scene_id=None):
+        """get_memory of several characters, with all their retrievals batched (see memory.memory.retrieve_many)."""
+        memories = {}
+        retrieving = [(char, char.memory_query()) for char in characters]
+        retrieving = [(char, query) for char, query in retrieving if query is not None]
+        if retrieving:
+            requests = [(char.storage, query, char.memory_viewer) for char, query in retrieving]
+            for (char, _), retrieved in zip(retrieving, retrieve_many(requests, retrieving[0][0].storage.recall_layers, scene_id)):
+                memories[char.id] = char.format_retrieved(retrieved)
+        return [memories[char.id] if char.id in memories else dumps(char.get_memory_list_from_dict()) for char in characters]
+
+    async def aget_memory(self, query=None, scene_id=None):
+        """Async version of get_memory: the query is embedded without blocking the event loop."""
+        query = self.memory_query(query)
+        if query is not None:
+            retrieved = await self.storage.aretrieve(query, self.storage.recall_layers, scene_id, viewer=self.memory_viewer)
+            return self.format_retrieved(retrieved)
+        return dumps(self.get_memory_list_from_dict())
+
+    def format_retrieved(self, retrieved):
+        records, self.last_retrieved = format_retrieved_records(retrieved, MEMORY_TOKEN_BUDGET)
+        return records
         
-    def into_memory(self, text, layer="event", tag=""):
+    def private_line(self, text, tag=""):
+        return f"{self.id} 's {tag} memory: {text}"
+
+    def into_memory(self, text, layer="event", tag="", logged=False):
+        """logged: the world already put the line into the shared event log, visible to everyone who saw it."""
         if self.storage_mode:
-            self.storage.add_piece(f"{self.id} 's {tag} memory: {text}", layer = layer, tag = tag, scene_id = self.loc)
+            if self.event_log is None:
+                self.storage.add_piece(self.private_line(text, tag), layer = layer, tag = tag, scene_id = self.loc)
+            elif not logged:
+                # Only this character knows the line
+                self.world.log_private(self.loc, self.private_line(text, tag), [self.id])
         if self.loc not in self.memory:
             self.memory.update({self.loc: [text]})
         else:
@@ -545,8 +715,8 @@ class CharacterLLM(Character):
             f.write(content)
 
 
-    def update_memory(self, a="", x="", b="", c="", y="", **kwargs):
-        """Update the character's memory with a new action."""
+    def update_memory(self, a="", x="", b="", c="", y="", logged=False, **kwargs):
+        """Update the character's memory with a new action. logged: see into_memory."""
         if self.status == "/faint/":
             return
         if kwargs.get("text"):
@@ -563,7 +733,7 @@ class CharacterLLM(Character):
             b = "你" if not ENGLISH_MODE else "you"
         m = {"a": a, "x": x, "b": b, "c": c, "y": y}
         m.update(kwargs)
-        self.into_memory(action_to_text(m))
+        self.into_memory(action_to_text(m), logged=logged)
         self.recent_memory.append(action_to_text(m))
         if len(self.recent_memory) > RECENT_MEMORY_LEN:
             self.recent_memory = self.recent_memory[-RECENT_MEMORY_LEN:]
@@ -628,7 +798,7 @@ class CharacterLLM(Character):
         prompt = self.prompt_v2.format(
             id=self.id,
             profile=self.profile,
-            memory=self.get_memory(scene_id=scene_id),
+            memory=await self.aget_memory(scene_id=scene_id),
             narrative = narrative,
             scene_info = info,
             view=dumps(self.view),
@@ -655,8 +825,8 @@ class CharacterLLM(Character):
         if x == "-speak":
             print(f"interact, x: {x}, cid: {cid}, kwargs: {kwargs}")
             trg = self.interact_with
-            trg.update_memory(self.id, "-speak", trg.id, content=kwargs["content"])
-            self.update_memory(self.id, "-speak", trg.id, content=kwargs["content"])
+            trg.update_memory(self.id, "-speak", trg.id, content=kwargs["content"], logged=True)
+            self.update_memory(self.id, "-speak", trg.id, content=kwargs["content"], logged=True)
             trg.to_do = True
             self.to_do = False            
 
@@ -686,12 +856,14 @@ class DramaLLM(World):
             "player_name": self.player.id,
             "background_narrative": self.narrative,
             "raw_records": self.raw_records,
+            "record_visibility": self.record_visibility,
+            "private_records": self.private_records,
             "characters": {k: v.state for k, v in self.characters.items()},
             "scenes": {k: v.state for k, v in self.scenes.items()},
             "scene_cnt": self.scene_cnt,
             "script": self.script,
             "nc": self.nc,
-            "chunks": self.record_storage.all_chunks_values() if self.storage_mode else [],
+            "chunks": self.record_storage.all_chunks_values(viewer=RECORD_VIEWER) if self.storage_mode else [],
             "last_retrieved": self.last_retrieved,
         }
         return state
@@ -717,14 +889,8 @@ class DramaLLM(World):
             )
         else:
             # do rag to get the relevant records
-            retrieved = self.record_storage.retrieve(all_records[-1], ["event"], "scene"+str(self.scene_cnt))
-            self.last_retrieved = []
-            records = "The script records are too long, so we get some chunks which may be relevant to the current dialogues from the record storage.\n"
-            for _, last_list in retrieved.items():
-                records += "\n\nChunk:"
-                for last in last_list:
-                    self.last_retrieved.append({"Score": last['score'], "Info": last["chunk"].text})
-                    records += f"\n{last['chunk'].to_text()}"
+            retrieved = self.record_storage.retrieve(all_records[-1], self.record_storage.recall_layers, "scene"+str(self.scene_cnt), viewer=RECORD_VIEWER)
+            records, self.last_retrieved = format_retrieved_records(retrieved, RECORDS_TOKEN_BUDGET)
             # logger.info(f"last retrieve {self.last_retrieved}")
             
             prompt = self.prompt_v1.format(
@@ -780,14 +946,8 @@ class DramaLLM(World):
             )
         else:
             # do rag to get the relevant records
-            retrieved = self.record_storage.retrieve(all_records[-1], ["event"], "scene"+str(self.scene_cnt))
-            self.last_retrieved = []
-            records = "The script records are too long, so we get some chunks which may be relevant to the current dialogues from the record storage.\n"
-            for _, last_list in retrieved.items():
-                records += "\n\nChunk:"
-                for last in last_list:
-                    self.last_retrieved.append({"Score": last['score'], "Info": last["chunk"].text})
-                    records += f"\n{last['chunk'].to_text()}"
+            retrieved = self.record_storage.retrieve(all_records[-1], self.record_storage.recall_layers, "scene"+str(self.scene_cnt), viewer=RECORD_VIEWER)
+            records, self.last_retrieved = format_retrieved_records(retrieved, RECORDS_TOKEN_BUDGET)
             # logger.info(f"last retrieve {self.last_retrieved}")
 
             prompt = self.prompt_v2.format(
@@ -840,14 +1000,8 @@ class DramaLLM(World):
             )
         else:
             # do rag to get the relevant records
-            retrieved = self.record_storage.retrieve(all_records[-1], ["event"], "scene"+str(self.scene_cnt))
-            self.last_retrieved = []
-            records = "The script records are too long, so we get some chunks which may be relevant to the current dialogues from the record storage.\n"
-            for _, last_list in retrieved.items():
-                records += "\n\nChunk:"
-                for last in last_list:
-                    self.last_retrieved.append({"Score": last['score'], "Info": last["chunk"].text})
-                    records += f"\n{last['chunk'].to_text()}"
+            retrieved = self.record_storage.retrieve(all_records[-1], self.record_storage.recall_layers, "scene"+str(self.scene_cnt), viewer=RECORD_VIEWER)
+            records, self.last_retrieved = format_retrieved_records(retrieved, RECORDS_TOKEN_BUDGET)
             
             prompt = self.prompt_v2_plus.format(
                 narrative = self.narrative,
@@ -917,14 +1071,8 @@ class DramaLLM(World):
             )
         else:
             # do rag to get the relevant records
-            retrieved = self.record_storage.retrieve(all_records[-1], ["event"], "scene"+str(self.scene_cnt))
-            self.last_retrieved = []
-            records = "The script records are too long, so we get some chunks which may be relevant to the current dialogues from the record storage.\n"
-            for _, last_list in retrieved.items():
-                records += "\n\nChunk:"
-                for last in last_list:
-                    self.last_retrieved.append({"Score": last['score'], "Info": last["chunk"].text})
-                    records += f"\n{last['chunk'].to_text()}"
+            retrieved = await self.record_storage.aretrieve(all_records[-1], self.record_storage.recall_layers, "scene"+str(self.scene_cnt), viewer=RECORD_VIEWER)
+            records, self.last_retrieved = format_retrieved_records(retrieved, RECORDS_TOKEN_BUDGET)
             
             prompt = self.prompt_v2_plus.format(
                 narrative = self.narrative,
@@ -1015,14 +1163,8 @@ class DramaLLM(World):
             )
         else:
             # do rag to get the relevant records
-            retrieved = self.record_storage.retrieve(all_records[-1], ["event"], "scene"+str(self.scene_cnt))
-            self.last_retrieved = []
-            records = "The script records are too long, so we get some chunks which may be relevant to the current dialogues from the record storage.\n"
-            for _, last_list in retrieved.items():
-                records += "\n\nChunk:"
-                for last in last_list:
-                    self.last_retrieved.append({"Score": last['score'], "Info": last["chunk"].text})
-                    records += f"\n{last['chunk'].to_text()}"
+            retrieved = self.record_storage.retrieve(all_records[-1], self.record_storage.recall_layers, "scene"+str(self.scene_cnt), viewer=RECORD_VIEWER)
+            records, self.last_retrieved = format_retrieved_records(retrieved, RECORDS_TOKEN_BUDGET)
             
             director_prompt = self.prompt_v2_plus.format(
                 narrative = self.narrative,
@@ -1057,13 +1199,13 @@ class DramaLLM(World):
         all_memories_info = []
         director_instructions = []
 
-        for char_id, char in self.scenes["scene"+str(self.scene_cnt)].characters.items():
-            if char_id != self.player.id:
-                all_characters_info.append(f"**{char_id}**: {char.profile}")
-                scene_key = "scene" + str(self.scene_cnt)
-                memory_content = char.get_memory(scene_id=scene_key)
-                memory_info = f"**{char_id}的记忆**: {memory_content}" if not ENGLISH_MODE else f"**{char_id}'s memory**: {memory_content}"
-                all_memories_info.append(memory_info)
+        npcs = [char for char_id, char in self.scenes["scene"+str(self.scene_cnt)].characters.items() if char_id != self.player.id]
+        # One batched retrieval for every NPC instead of one retrieval each
+        memory_contents = CharacterLLM.get_memories(npcs, scene_id="scene" + str(self.scene_cnt))
+        for char, memory_content in zip(npcs, memory_contents):
+            all_characters_info.append(f"**{char.id}**: {char.profile}")
+            memory_info = f"**{char.id}的记忆**: {memory_content}" if not ENGLISH_MODE else f"**{char.id}'s memory**: {memory_content}"
+            all_memories_info.append(memory_info)
 
         for actor_info in director_response[actor_list_key]:
             char_name_key = "角色" if not ENGLISH_MODE else "Character"
@@ -1125,9 +1267,9 @@ class DramaLLM(World):
             char.to_do = False
             char.decision = []
         ans = self.scenes["scene"+str(self.scene_cnt)].withdraw(self.player.id)
+        self.withdraw_private_records("scene"+str(self.scene_cnt))
         if self.storage_mode:
-            self.record_storage.reset()
-            self.record_storage.load_dialogues_record(self.raw_records, current_scene_id=self.player.loc)
+            self.rebuild_event_log(self.player.loc)
         return ans
 
     def back_scene(self):
@@ -1152,8 +1294,7 @@ class DramaLLM(World):
             for cid, motivation in character_list.items():
                 self.update_view(cid)
         if self.storage_mode:
-            self.record_storage.reset()
-            self.record_storage.load_dialogues_record(self.raw_records, current_scene_id="scene"+str(self.scene_cnt))
+            self.rebuild_event_log("scene"+str(self.scene_cnt))
 
 
     def next_scene(self, scene_id = None):
@@ -1169,13 +1310,14 @@ class DramaLLM(World):
     def save(self):
         save_id = self.id+str(datetime.datetime.now().strftime("_%m%d_%H%M%S"))
         write_json(self.state, f'{self.save_dir}/{save_id}.yml')
+        self.save_memory_snapshots(save_id)
         return save_id
 
     def load(self, save_id):
         state = read_json(f'{self.save_dir}/{save_id}.yml')
         if "characters" in state:
             for cid, char in state["characters"].items():
-                self.characters[cid].load(char)
+                self.characters[cid].load(char, self.memory_snapshot_prefix(save_id, cid))
                 self.characters[cid].interact_with = self.characters[char.get("interact_with")] if char.get("interact_with") in self.characters else None
         if "scenes" in state:
             for sid, s in state["scenes"].items():
@@ -1186,9 +1328,10 @@ class DramaLLM(World):
         if "raw_records" in state:
             for sid, record in state["raw_records"].items():
                 self.raw_records[sid] = self.scenes[sid].record = record
+                self.record_visibility[sid] = self.scenes[sid].visibility = state.get("record_visibility", {}).get(sid) or [None] * len(record)
+            self.private_records = state.get("private_records", {})
             if self.storage_mode:
-                self.record_storage.reset()
-                self.record_storage.load_dialogues_record(state["raw_records"], current_scene_id="scene"+str(self.scene_cnt))
+                self.load_event_log(save_id, "scene"+str(self.scene_cnt))
 
         if "nc" in state:
             self.nc = state["nc"]
@@ -1214,14 +1357,8 @@ class DramaLLM(World):
             )
         else:
             # do rag to get the relevant records
-            retrieved = self.record_storage.retrieve(all_records[-1], ["event"], "scene"+str(self.scene_cnt))
-            self.last_retrieved = []
-            records = "The script records are too long, so we get some chunks which may be relevant to the current dialogues from the record storage.\n"
-            for _, last_list in retrieved.items():
-                records += "\n\nChunk:"
-                for last in last_list:
-                    self.last_retrieved.append({"Score": last['score'], "Info": last["chunk"].text})
-                    records += f"\n{last['chunk'].to_text()}"
+            retrieved = self.record_storage.retrieve(all_records[-1], self.record_storage.recall_layers, "scene"+str(self.scene_cnt), viewer=RECORD_VIEWER)
+            records, self.last_retrieved = format_retrieved_records(retrieved, RECORDS_TOKEN_BUDGET)
             
             prompt = self.prompt_v1_reflect.format(
                 background=self.narrative,
@@ -1265,14 +1402,8 @@ class DramaLLM(World):
             )
         else:
             # do rag to get the relevant records
-            retrieved = self.record_storage.retrieve(all_records[-1], ["event"], "scene"+str(self.scene_cnt))
-            self.last_retrieved = []
-            records = "The script records are too long, so we get some chunks which may be relevant to the current dialogues from the record storage.\n"
-            for _, last_list in retrieved.items():
-                records += "\n\nChunk:"
-                for last in last_list:
-                    self.last_retrieved.append({"Score": last['score'], "Info": last["chunk"].text})
-                    records += f"\n{last['chunk'].to_text()}"
+            retrieved = self.record_storage.retrieve(all_records[-1], self.record_storage.recall_layers, "scene"+str(self.scene_cnt), viewer=RECORD_VIEWER)
+            records, self.last_retrieved = format_retrieved_records(retrieved, RECORDS_TOKEN_BUDGET)
             
             prompt = self.prompt_director_reflect.format(
                 background=self.narrative,
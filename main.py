@@ -244,7 +244,7 @@ class DRAMA:
                                 logger.warning(f"Initial memory for {char_req.id} changed. Consider full script reload for consistency.")
                         else:
                             # New character, add to characters and scenes
-                            character = CharacterLLM(config={"id": char_req.id, "profile": char_req.profile})
+                            character = CharacterLLM(config={"id": char_req.id, "profile": char_req.profile}, storage_mode=self.dramallm.storage_mode, world=self.dramallm)
                             if char_req.initial_memory:
                                 character.update_memory(text=char_req.initial_memory)
                             
@@ -609,7 +609,7 @@ async def get_info(data: InfoRequest, dramaworld: DRAMA = Depends(get_dramaworld
             config = {
                 "profile": dramaworld.dramallm.characters[cid].profile,
                 "memory": dramaworld.dramallm.characters[cid].get_memory_list_from_dict(),
-                "chunks": dramaworld.dramallm.characters[cid].storage.all_chunks_values() if dramaworld.dramallm.characters[cid].storage_mode else None,
+                "chunks": dramaworld.dramallm.characters[cid].storage.all_chunks_values(viewer=dramaworld.dramallm.characters[cid].memory_viewer) if dramaworld.dramallm.characters[cid].storage_mode else None,
                 "retrieved": dramaworld.dramallm.characters[cid].last_retrieved
             }
             if dramaworld.dramallm.mode in ['v2', 'v2_plus', 'v3']:
@@ -618,7 +618,7 @@ async def get_info(data: InfoRequest, dramaworld: DRAMA = Depends(get_dramaworld
         if data.help == "allmemory":
             config = {
                 "allmemory": dramaworld.dramallm.raw_records,
-                "chunks": dramaworld.dramallm.record_storage.all_chunks_values() if dramaworld.dramallm.storage_mode else None,
+                "chunks": dramaworld.dramallm.record_storage.all_chunks_values(viewer=RECORD_VIEWER) if dramaworld.dramallm.storage_mode else None,
                 "retrieved": dramaworld.dramallm.last_retrieved if dramaworld.dramallm.storage_mode else None
             }
         elif data.help == "dramallm":
@@ -645,7 +645,7 @@ async def get_info(data: InfoRequest, dramaworld: DRAMA = Depends(get_dramaworld
             write_json(dramaworld.dramallm.raw_records, f'{dramaworld.dramallm.cache}/record_{save_id}.yaml')            
             config = {
                 "allmemory": dramaworld.dramallm.raw_records,
-                "chunks": dramaworld.dramallm.record_storage.all_chunks_values() if dramaworld.dramallm.storage_mode else None
+                "chunks": dramaworld.dramallm.record_storage.all_chunks_values(viewer=RECORD_VIEWER) if dramaworld.dramallm.storage_mode else None
             }
     logger.info(config)                 
     return config
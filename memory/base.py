@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import numpy as np
-from rank_bm25 import BM25Okapi
-import faiss
-from collections import defaultdict 
 import logging
-from memory.document_processor import DocumentProcessor
+import itertools
+from collections import deque
+from memory.document_processor import tokenize
+from memory.bm25 import IncrementalBM25
+from memory.vector_store import VectorStore
 # --- Setup Logging ---
 logger = logging.getLogger(__name__)
 # Optional: Set a handler if not configured elsewhere (e.g., for standalone testing)
@@ -30,20 +31,42 @@ TAG_WEIGHTS = {
     "summary_conversation": 1.2, # Summaries might be slightly more important than raw convo
     "summary_scene_init": 1.1,
     "summary_scene_objective": 1.3,
+    "summary_rollup": 1.2, # summary of several scene summaries (or of roll-ups), see Summarizer.roll_up_summaries
 
     # archived layer
     "archived_conversation": 0.2, # Low weight for archived items
     "archived_scene_init": 0.1,
     "archived_scene_objective": 0.1,
+    "archived_summary_conversation": 0.2, # summaries that were rolled up
+    "archived_summary_rollup": 0.2,
 }
 TAG_EMBEDDING_WEIGHT = 0.0 # current not used
 TEXT_WEIGHT = 1.0
 IMPORTANCE_ADDITION_WEIGHT = 0.05
 IMPORTANCE_ADDITION_THRESHOLD = 10
+SCENE_RECENCY_ALPHA = 0.25
+CHUNK_EMBEDDING_STRATEGIES = ("full", "pooled") # encode the whole chunk text, or pool the vectors of its pieces
 # --- Global Weights and Definitions ---
 
+_sub_storage_versions = itertools.count() # shared, so a reset storage never reuses a version
+
+def scene_index(scene_id):
+    """Numeric index of a scene id (1 or "scene1" -> 1.0); nan for scene-less or unparsable ids."""
+    if scene_id is None:
+        return np.nan
+    if isinstance(scene_id, (int, float, np.integer, np.floating)):
+        return float(scene_id)
+    try:
+        return float(int(str(scene_id).split("scene")[1]))
+    except (IndexError, ValueError):
+        return np.nan
+
+def visibility_set(visible_to):
+    """Normalized visibility: None (visible to every viewer) or a frozenset of viewer ids."""
+    return None if visible_to is None else frozenset(visible_to)
+
 class MemoryPiece:
-    def __init__(self, piece_id, text="", layer="global", tag="conversation", metadata=None, layer_id=None, scene_id=None):
+    def __init__(self, piece_id, text="", layer="global", tag="conversation", metadata=None, layer_id=None, scene_id=None, visible_to=None):
         self.id = piece_id
         self.text = text
         self.layer = layer
@@ -51,23 +74,27 @@ class MemoryPiece:
         self.metadata = metadata or {}
         self.layer_id = layer_id
         self.scene_id = scene_id
+        self.visible_to = visibility_set(visible_to) # characters who saw the piece, None for everyone
+        self.embedding = None # own vector with the "pooled" chunk embedding strategy, while its stream may pool it again
 
     def __repr__(self):
         return f"MemoryPiece(id={self.id}, layer='{self.layer}', tag='{self.tag}', layer_id={self.layer_id}, scene_id={self.scene_id}, text='{self.text[:30]}...')"
 
 class MemoryChunk:
-    def __init__(self, chunk_id, pieces_list, layer="global", tag=None, metadata=None, layer_id=None, scene_id=None):
+    def __init__(self, chunk_id, pieces_list, layer="global", tag=None, metadata=None, layer_id=None, scene_id=None, visible_to=None):
         self.id = chunk_id
         self.pieces = pieces_list 
         self.text = "\n".join([p.text.strip() for p in pieces_list]) 
         self.layer = layer
         self.metadata = metadata or {}
         self.layer_id = layer_id
-        self.embedding = None
+        self.embedding = None # only set between embedding and indexing, the sub-storage's vector store keeps the vector
         self.scene_id = scene_id
+        self.visible_to = visibility_set(visible_to) # all pieces of a chunk share it, see BaseMemorySubStorage._stream_key
         self.tag = tag if tag else layer 
         self.tag_embedding = None
         self.importance = 0
+        self.bm25_tokens = None # ("layer:text" it was computed from, tokens), see BaseMemorySubStorage._bm25_tokens
         
         self.max_pieces = 5 
         self.max_text_length = 800 
@@ -80,6 +107,13 @@ class MemoryChunk:
         return f"MemoryChunk(id={self.id}, layer='{self.layer}', tag='{self.tag}', layer_id={self.layer_id}, scene_id={self.scene_id}, #pieces={len(self.pieces)}, text='{self.text}, metadata={self.metadata})"
 
     def add_piece(self, piece, embed_model, tag_embeddings, next_layer_id_for_piece):
+        if not self.append_piece(piece, next_layer_id_for_piece):
+            return False
+        self.set_embedding(embed_model, tag_embeddings) 
+        return True
+
+    def append_piece(self, piece, next_layer_id_for_piece):
+        """Appends a piece to the chunk text without re-embedding. Returns False if the chunk is full."""
         if len(self.pieces) > self.max_pieces or \
            len(self.text) + len(piece.text) + 1 > self.max_text_length: 
             logger.info(f"Chunk {self.id} is full (pieces:{len(self.pieces)}/{self.max_pieces}, len:{len(self.text)}/{self.max_text_length}). Cannot add piece {piece.id}.")
@@ -87,7 +121,6 @@ class MemoryChunk:
         piece.layer_id = next_layer_id_for_piece
         self.pieces.append(piece)
         self.text += "\n" + piece.text.strip() 
-        self.set_embedding(embed_model, tag_embeddings) 
         logger.info(f"Added piece {piece.id} to chunk {self.id}. New text length: {len(self.text)}")
         return True
 
@@ -103,278 +136,706 @@ class MemoryChunk:
         # self.embedding = (TEXT_WEIGHT * text_embedding + TAG_EMBEDDING_WEIGHT * self.tag_embedding).astype('float32')
         self.embedding = embed_model.encode(self.text).astype('float32')
 
-    def to_text(self):
+    @staticmethod
+    def set_embeddings(chunks, embed_model, tag_embeddings):
+        """Embeds several chunks with a single batched encode call."""
+        if not chunks:
+            return
+        embeddings = embed_model.encode([chunk.text for chunk in chunks])
+        for chunk, embedding in zip(chunks, embeddings):
+            chunk.embedding = np.asarray(embedding).astype('float32')
+
+    @staticmethod
+    def pieces_to_embed(chunks):
+        """Pieces of the chunks that have no vector of their own yet (each listed once)."""
+        return list({piece.id: piece for chunk in chunks for piece in chunk.pieces if piece.embedding is None}.values())
+
+    @staticmethod
+    def set_pooled_embeddings(chunks, embed_model, tag_embeddings, piece_embeddings=None):
+        """
+        "pooled" strategy: every piece is encoded once (in one batched call) and keeps its vector; a chunk's
+        vector is the mean of its pieces' vectors weighted by their text length, rescaled to their mean norm.
+        tag_embeddings is not used, as in set_embeddings: the chunk vector holds only text.
+        piece_embeddings: vectors already computed for pieces_to_embed(chunks), e.g. by an async encode.
+        """
+        if not chunks:
+            return
+        pieces = MemoryChunk.pieces_to_embed(chunks)
+        if pieces:
+            if piece_embeddings is None:
+                piece_embeddings = embed_model.encode([piece.text.strip() for piece in pieces])
+            for piece, embedding in zip(pieces, piece_embeddings):
+                piece.embedding = np.asarray(embedding).astype('float32')
+        for chunk in chunks:
+            vectors = np.stack([piece.embedding for piece in chunk.pieces])
+            weights = np.array([max(1, len(piece.text.strip())) for piece in chunk.pieces], dtype='float32')
+            pooled = weights @ vectors / weights.sum()
+            norm = np.linalg.norm(pooled)
+            if norm > 0:
+                pooled *= np.linalg.norm(vectors, axis=1).mean() / norm
+            chunk.embedding = pooled.astype('float32')
+
+    def to_text(self, text=None):
+        """text: the part of the chunk to show, e.g. without pieces already shown (default: all of it)."""
+        text = self.text if text is None else text
         # character's profile/conversation memory in a scene
         if "character" in self.metadata:
             scene_id = self.scene_id if self.scene_id else "global"
             return f"""
     {self.metadata["character"]}'s {self.tag} memory chunk in {scene_id}.
-    {self.text}
+    {text}
             """
         # event conversation memory
         else:
             scene_id = self.scene_id if self.scene_id else "global"
             return f"""
     This is a {self.tag} memory chunk in {scene_id}.
-    {self.text}
+    {text}
             """
 
+class ChunkScoringTable:
+    """
+    Scoring features of the chunks of one sub-storage, kept in flat NumPy arrays so that retrieval
+    scores every chunk with one vectorized expression. Rows are kept in sync on insert and removal
+    (the last row moves into a freed slot).
+    """
+    def __init__(self, initial_capacity=64):
+        self.size = 0
+        self.row_of = {} # chunk_id -> row
+        self.visibility_groups = {} # frozenset of viewers -> group index
+        self._allocate(max(1, initial_capacity))
+
+    def _allocate(self, capacity):
+        old_size = self.size
+        arrays = {
+            "chunk_ids": np.full(capacity, -1, dtype='int64'),
+            "importance": np.zeros(capacity),
+            "tag_weight": np.ones(capacity),        # LAYER_WEIGHTS * TAG_WEIGHTS
+            "scene_index": np.full(capacity, np.nan), # see scene_index()
+            "turn_position": np.full(capacity, -1, dtype='int64'), # position among the scene's dialogue chunks
+            "visibility": np.full(capacity, -1, dtype='int64'), # index into visibility_groups, -1 for everyone
+        }
+        for name, array in arrays.items():
+            if old_size:
+                array[:old_size] = getattr(self, name)[:old_size]
+            setattr(self, name, array)
+
+    def __contains__(self, chunk_id):
+        return chunk_id in self.row_of
+
+    def add(self, chunk):
+        if chunk.id in self.row_of:
+            return self.row_of[chunk.id]
+        if self.size == len(self.chunk_ids):
+            self._allocate(len(self.chunk_ids) * 2)
+        row = self.size
+        self.row_of[chunk.id] = row
+        self.chunk_ids[row] = chunk.id
+        self.importance[row] = chunk.importance
+        self.tag_weight[row] = LAYER_WEIGHTS.get(chunk.layer, 1.0) * TAG_WEIGHTS.get(chunk.tag, 1.0)
+        self.scene_index[row] = scene_index(chunk.scene_id)
+        self.turn_position[row] = -1
+        self.visibility[row] = -1 if chunk.visible_to is None else \
+            self.visibility_groups.setdefault(chunk.visible_to, len(self.visibility_groups))
+        self.size += 1
+        return row
+
+    def visible_mask(self, viewer):
+        """Boolean mask over the rows: chunks visible to everyone or to viewer."""
+        groups = [group for viewers, group in self.visibility_groups.items() if viewer in viewers]
+        visibility = self.visibility[:self.size]
+        return (visibility < 0) | np.isin(visibility, groups)
+
+    def remove(self, chunk_id):
+        row = self.row_of.pop(chunk_id, None)
+        if row is None:
+            return False
+        last = self.size - 1
+        if row != last:
+            for array in (self.chunk_ids, self.importance, self.tag_weight, self.scene_index, self.turn_position, self.visibility):
+                array[row] = array[last]
+            self.row_of[int(self.chunk_ids[row])] = row
+        self.size -= 1
+        return True
+
+class ChunkStream:
+    """
+    Chunks and recent pieces sharing one (layer, tag, scene_id, visible_to) key. open_chunk_id is the most recent chunk
+    of the stream (the one new pieces are appended to), recent_pieces the last pieces used for overlap.
+    """
+    def __init__(self, overlap_pieces):
+        self.chunk_ids = set()
+        self.open_chunk_id = None
+        self.recent_pieces = deque(maxlen=overlap_pieces)
+
+    def add_chunk(self, chunk_id):
+        self.chunk_ids.add(chunk_id)
+        if self.open_chunk_id is None or chunk_id > self.open_chunk_id:
+            self.open_chunk_id = chunk_id
+
+    def remove_chunk(self, chunk_id):
+        self.chunk_ids.discard(chunk_id)
+        if chunk_id == self.open_chunk_id:
+            # Fall back to the previous chunk of the stream, as a scan over all chunks would
+            self.open_chunk_id = max(self.chunk_ids) if self.chunk_ids else None
+
+class QueryContext:
+    """
+    Tokenized query and its embedding. Built once per retrieval and shared by every sub-storage queried.
+    relevance caches each sub-storage's BM25 + vector scores for the query at its current version, so the
+    Retriever can reuse a context for a repeated query without encoding or searching again. Only the candidate
+    rows (BM25 hits and vector search results) are kept, so an entry does not grow with the sub-storage.
+    """
+    def __init__(self, query_text, embed_model, embedding=None):
+        self.text = query_text
+        self.tokens = tokenize(query_text)
+        if embedding is None:
+            embedding = embed_model.encode(query_text)
+        self.embedding = np.asarray(embedding).astype('float32')
+        self.relevance = {} # {(id(sub_storage), version, top_k, bm25_weight, vector_weight, viewer): (rows, scores)}
+
+    @classmethod
+    async def acreate(cls, query_text, embed_model):
+        """Like the constructor, but the query is encoded off the event loop when the model supports aencode."""
+        if hasattr(embed_model, "aencode"):
+            return cls(query_text, embed_model, await embed_model.aencode(query_text))
+        return cls(query_text, embed_model)
+
 # --- Base Memory Sub-Storage Class ---
 class BaseMemorySubStorage:
+    candidate_factor = 1 # retrieve() scores top_k * candidate_factor candidates before its final ranking
+
     def __init__(self, parent_storage, embed_model, dimension, tag_embeddings, chunk_max_pieces, chunk_overlap_pieces):
         self.parent_storage = parent_storage
         self.chunks = {}  # {chunk_id: MemoryChunk object}
-        self.all_pieces_ordered = [] # Only for overlap logic within this sub-storage
+        self.streams = {} # {(layer, tag, scene_id, visible_to): ChunkStream}, open chunk and overlap pieces per stream
         self.next_chunk_id_in_layer = 0
-        
-        self.documents_for_bm25 = []  
-        self.chunk_id_to_bm25_internal_idx = {}
-
+        self.version = next(_sub_storage_versions) # changes whenever chunks are indexed or removed, see Retriever
+        self.dirty_chunks = {} # {chunk_id: MemoryChunk} changed since their vector was written, see flush_embeddings
+        self.chunk_embedding = getattr(parent_storage, "chunk_embedding", "full") # see CHUNK_EMBEDDING_STRATEGIES
         self.embed_model = embed_model
         self.dimension = dimension
-        self.faiss_index = faiss.IndexIDMap(faiss.IndexFlatL2(self.dimension)) 
-        self.bm25 = None
+        # L2, in-place updates for the open chunk; precision/truncation and the switch from exact search
+        # to an IVF index for large sub-storages are configured on the MemoryStorage
+        self.vector_store = VectorStore(self.dimension,
+                                        precision=getattr(parent_storage, "vector_precision", "float32"),
+                                        truncate_dim=getattr(parent_storage, "vector_truncate_dim", None),
+                                        ann_threshold=getattr(parent_storage, "vector_ann_threshold", None),
+                                        ann_nprobe=getattr(parent_storage, "vector_ann_nprobe", 16))
+        self.bm25 = IncrementalBM25() # keyed by chunk_id, updated per chunk instead of rebuilt
+        self.scoring_table = ChunkScoringTable()
         self.tag_embeddings = tag_embeddings
 
         self.chunk_max_pieces = chunk_max_pieces 
         self.chunk_overlap_pieces = min(chunk_overlap_pieces, chunk_max_pieces - 1) 
         if self.chunk_overlap_pieces < 0: self.chunk_overlap_pieces = 0
 
-    
-
-    def _create_and_add_new_chunk(self, pieces_list, layer, tag, metadata, scene_id, piece_id_for_logging, layer_id):
+    @staticmethod
+    def _stream_key(item):
+        # Pieces and chunks only merge with the same layer, tag and scene (scene-less only with scene-less),
+        # and only with pieces seen by the same characters, so a chunk never shows a viewer what they did not see.
+        # A scene has one open chunk per viewer set rather than a chunk cut at every change of viewers, which keeps
+        # chunks full when conversations interleave; their number is bounded by the viewer sets of the scene.
+        return (item.layer, item.tag, item.scene_id, item.visible_to)
+
+    def _get_stream(self, item):
+        key = self._stream_key(item)
+        stream = self.streams.get(key)
+        if stream is None:
+            stream = self.streams[key] = ChunkStream(self.chunk_overlap_pieces)
+        return stream
+
+    def _bm25_tokens(self, chunk):
+        # Cached on the chunk and only recomputed when its text or layer changed
+        source = f"{chunk.layer}:{chunk.text}"
+        if chunk.bm25_tokens is None or chunk.bm25_tokens[0] != source:
+            chunk.bm25_tokens = (source, tokenize(source))
+        return chunk.bm25_tokens[1]
+
+    def _create_chunk(self, pieces_list, layer, tag, metadata, scene_id, layer_id, visible_to=None):
         chunk_id = self.parent_storage._get_next_global_chunk_id()
 
         chunk = MemoryChunk(chunk_id, pieces_list=pieces_list, layer=layer, tag=tag, 
-                            metadata=metadata, layer_id=layer_id, scene_id=scene_id)
+                            metadata=metadata, layer_id=layer_id, scene_id=scene_id, visible_to=visible_to)
         
         chunk.max_pieces = self.chunk_max_pieces 
-        chunk.set_embedding(self.embed_model, self.tag_embeddings)
-        
         self.chunks[chunk_id] = chunk
-        
-        bm25_doc_text = f"{layer}:{chunk.text}" 
-        self.documents_for_bm25.append(DocumentProcessor().tokenize_text(bm25_doc_text))
-        self.chunk_id_to_bm25_internal_idx[chunk_id] = len(self.documents_for_bm25) - 1 
+        self._get_stream(chunk).add_chunk(chunk_id)
+        return chunk
 
-        vec = np.array([chunk.embedding]).astype('float32')
-        self.faiss_index.add_with_ids(vec, np.array([chunk_id]))
+    def _index_chunks(self, chunks):
+        """
+        Writes the current tokens of each chunk into BM25 and the scoring table. Chunks that carry an embedding
+        have it written into the vector store; the others are marked dirty and embedded by flush_embeddings.
+        """
+        if not chunks:
+            return
+        self.version = next(_sub_storage_versions)
+        for chunk in chunks:
+            if chunk.embedding is None:
+                self.dirty_chunks[chunk.id] = chunk
+        self._index_vectors([chunk for chunk in chunks if chunk.embedding is not None]) # drops chunk.embedding once written
+        for chunk in chunks:
+            self.scoring_table.add(chunk)
+        for chunk in chunks:
+            self.bm25.update_document(chunk.id, self._bm25_tokens(chunk))
+
+    def _index_vectors(self, chunks):
+        if not chunks:
+            return
+        vecs = np.array([chunk.embedding for chunk in chunks]).astype('float32')
+        self.vector_store.upsert([chunk.id for chunk in chunks], vecs) # existing chunks are updated in place
+        for chunk in chunks:
+            chunk.embedding = None # no second float32 copy on the chunk, use get_chunk_vector()
+            self.dirty_chunks.pop(chunk.id, None)
+
+    def flush_embeddings(self):
+        """
+        Embeds every dirty chunk in one batched encode call and writes the vectors. Ingestion only marks chunks
+        dirty, so a chunk that grows piece by piece is encoded once, when a search, snapshot or vector read needs it.
+        Returns the number of chunks embedded.
+        """
+        if not self.dirty_chunks:
+            return 0
+        chunks = list(self.dirty_chunks.values())
+        if self.chunk_embedding == "pooled":
+            MemoryChunk.set_pooled_embeddings(chunks, self.embed_model, self.tag_embeddings)
+        else:
+            MemoryChunk.set_embeddings(chunks, self.embed_model, self.tag_embeddings)
+        self.version = next(_sub_storage_versions)
+        self._index_vectors(chunks)
+        self._release_piece_vectors(chunks)
+        logger.info(f"[{type(self).__name__}] Embedded {len(chunks)} dirty chunks.")
+        return len(chunks)
+
+    async def aflush_embeddings(self):
+        """Async version of flush_embeddings: the batch is encoded off the event loop when the model supports aencode."""
+        if not self.dirty_chunks or not hasattr(self.embed_model, "aencode"):
+            return self.flush_embeddings()
+        chunks = list(self.dirty_chunks.values())
+        texts = [chunk.text for chunk in chunks]
+        if self.chunk_embedding == "pooled":
+            pieces = MemoryChunk.pieces_to_embed(chunks)
+            piece_embeddings = await self.embed_model.aencode([piece.text.strip() for piece in pieces]) if pieces else []
+            for piece, embedding in zip(pieces, piece_embeddings):
+                piece.embedding = np.asarray(embedding).astype('float32')
+        else:
+            embeddings = await self.embed_model.aencode(texts)
+        # Chunks removed or changed while encoding are not written (a changed one stays dirty)
+        fresh = [i for i, (chunk, text) in enumerate(zip(chunks, texts))
+                 if self.dirty_chunks.get(chunk.id) is chunk and chunk.text == text]
+        if self.chunk_embedding == "pooled":
+            MemoryChunk.set_pooled_embeddings([chunks[i] for i in fresh], self.embed_model, self.tag_embeddings)
+        else:
+            for i in fresh:
+                chunks[i].embedding = np.asarray(embeddings[i]).astype('float32')
+        self.version = next(_sub_storage_versions)
+        self._index_vectors([chunks[i] for i in fresh])
+        self._release_piece_vectors([chunks[i] for i in fresh])
+        return len(fresh)
+
+    def _release_piece_vectors(self, chunks):
+        """
+        "pooled" strategy: drops the vectors of the chunks' pieces that no stream can pool again, i.e. that are
+        neither in its open chunk nor in its overlap pieces. A closed chunk changed later re-encodes its pieces.
+        """
+        if self.chunk_embedding != "pooled":
+            return
+        for chunk in chunks:
+            stream = self.streams.get(self._stream_key(chunk))
+            held = set()
+            if stream is not None:
+                held.update(piece.id for piece in stream.recent_pieces)
+                if stream.open_chunk_id in self.chunks:
+                    held.update(piece.id for piece in self.chunks[stream.open_chunk_id].pieces)
+            for piece in chunk.pieces:
+                if piece.id not in held:
+                    piece.embedding = None
+
+    def _create_and_add_new_chunk(self, pieces_list, layer, tag, metadata, scene_id, piece_id_for_logging, layer_id, visible_to=None):
+        chunk = self._create_chunk(pieces_list, layer, tag, metadata, scene_id, layer_id, visible_to)
+        self._index_chunks([chunk]) # embedded lazily
 
-        self.build_bm25() 
         logger.info(f"[{type(self).__name__}] Created new chunk {chunk.id} (L:{layer}, T:{tag}, S:{scene_id}) with {len(pieces_list)} pieces for piece {piece_id_for_logging}.")
         return chunk
 
+    def _place_piece(self, piece):
+        """
+        Chunking step of add_piece_to_sub_storage: appends the piece to the most recent suitable chunk,
+        or opens a new chunk (with overlap) when there is none or it is full. Nothing is embedded or indexed here.
+        Returns (chunk, created).
+        """
+        stream = self._get_stream(piece)
+
+        most_recent_suitable_chunk = self.chunks.get(stream.open_chunk_id)
+        if most_recent_suitable_chunk and most_recent_suitable_chunk.append_piece(piece, self.next_chunk_id_in_layer):
+            stream.recent_pieces.append(piece)
+            return most_recent_suitable_chunk, False
+
+        # Overlap: the last chunk_overlap_pieces pieces of the same stream
+        pieces_for_new_chunk = list(stream.recent_pieces)
+        pieces_for_new_chunk.append(piece) 
+        stream.recent_pieces.append(piece)
+
+        new_chunk = self._create_chunk(
+            pieces_list=pieces_for_new_chunk, 
+            layer=piece.layer, tag=piece.tag, metadata=piece.metadata, scene_id=piece.scene_id,
+            layer_id=self.next_chunk_id_in_layer, visible_to=piece.visible_to
+        )
+        self.next_chunk_id_in_layer += 1
+        if most_recent_suitable_chunk is not None and most_recent_suitable_chunk.id not in self.dirty_chunks:
+            self._release_piece_vectors([most_recent_suitable_chunk]) # closed and already embedded (a dirty one is released by its flush)
+        logger.info(f"[{type(self).__name__}] Created new chunk {new_chunk.id} (L:{piece.layer}, T:{piece.tag}, S:{piece.scene_id}) with {len(pieces_for_new_chunk)} pieces for piece {piece.id}.")
+        return new_chunk, True
+
     def add_piece_to_sub_storage(self, piece):
-        """Adds a piece to this sub-storage, handling chunking and overlap."""
-        # Update piece's layer_id before storing globally
-        
-        self.all_pieces_ordered.append(piece) 
-
-        found_suitable_chunk = False
-        most_recent_suitable_chunk = None
-
-        for chunk_id_candidate in reversed(sorted(self.chunks.keys())): 
-            chunk = self.chunks[chunk_id_candidate]
-            # Criteria for suitability: same layer, same scene_id (if applicable), same tag
-            # Note: For Global memories (profile, global), scene_id might be None, so check accordingly
-            is_suitable = chunk.layer == piece.layer and chunk.tag == piece.tag
-            if piece.scene_id is not None:
-                is_suitable = is_suitable and (chunk.scene_id == piece.scene_id)
-            elif chunk.scene_id is not None: # piece.scene_id is None, but chunk.scene_id is not
-                is_suitable = False # Cannot merge scene-less with scene-specific chunks
-
-            if is_suitable:
-                most_recent_suitable_chunk = chunk
-                break 
-
-        if most_recent_suitable_chunk:
-            if most_recent_suitable_chunk.add_piece(piece, self.embed_model, self.tag_embeddings, self.next_chunk_id_in_layer):
-                chunk_id = most_recent_suitable_chunk.id
-                vec = np.array([most_recent_suitable_chunk.embedding]).astype('float32')
-                
-                self.faiss_index.remove_ids(np.array([chunk_id])) 
-                self.faiss_index.add_with_ids(vec, np.array([chunk_id])) 
-                
-                bm25_internal_idx = self.chunk_id_to_bm25_internal_idx[chunk_id]
-                self.documents_for_bm25[bm25_internal_idx] = \
-                    DocumentProcessor().tokenize_text(f"{most_recent_suitable_chunk.layer}:{most_recent_suitable_chunk.text}")
-                self.build_bm25() 
-                
-                found_suitable_chunk = True
-        
-        if not found_suitable_chunk:
-            pieces_for_new_chunk = []
-            
-            overlap_count = 0
-            for p_idx in range(len(self.all_pieces_ordered) - 2, -1, -1): 
-                if overlap_count >= self.chunk_overlap_pieces:
-                    break
-                prev_piece = self.all_pieces_ordered[p_idx]
-                # Only include pieces in overlap that match the new chunk's characteristics
-                is_overlap_suitable = prev_piece.layer == piece.layer and prev_piece.tag == piece.tag
-                if piece.scene_id is not None:
-                    is_overlap_suitable = is_overlap_suitable and (prev_piece.scene_id == piece.scene_id)
-                elif prev_piece.scene_id is not None:
-                    is_overlap_suitable = False # Cannot merge scene-less with scene-specific chunks
-                
-                if is_overlap_suitable:
-                    pieces_for_new_chunk.insert(0, prev_piece) 
-                    overlap_count += 1
-            
-            pieces_for_new_chunk.append(piece) 
-
-            new_chunk = self._create_and_add_new_chunk(
-                pieces_list=pieces_for_new_chunk, 
-                layer=piece.layer, tag=piece.tag, metadata=piece.metadata, scene_id=piece.scene_id,
-                piece_id_for_logging=piece.id, layer_id=self.next_chunk_id_in_layer
-            )
-            self.next_chunk_id_in_layer += 1
-            return new_chunk.id # Return the ID of the newly created chunk
+        """Adds a piece to this sub-storage, handling chunking and overlap. The chunk is embedded lazily."""
+        chunk, created = self._place_piece(piece)
+        self._index_chunks([chunk])
+        if created:
+            return chunk.id # Return the ID of the newly created chunk
         return None # Indicate no new chunk was created
 
+    def add_pieces_to_sub_storage(self, pieces):
+        """
+        Bulk version of add_piece_to_sub_storage. All pieces are chunked first, then every touched chunk
+        is indexed once (and embedded lazily). The resulting chunks are the same as adding the pieces one by one.
+        Returns a list aligned with pieces: the new chunk ID a piece opened, or None.
+        """
+        touched_chunks = {}
+        new_chunk_ids = []
+        for piece in pieces:
+            chunk, created = self._place_piece(piece)
+            touched_chunks[chunk.id] = chunk
+            new_chunk_ids.append(chunk.id if created else None)
+
+        chunks = list(touched_chunks.values())
+        self._index_chunks(chunks)
+        logger.info(f"[{type(self).__name__}] Bulk added {len(pieces)} pieces into {len(chunks)} chunks.")
+        return new_chunk_ids
+
     def add_chunk_to_sub_storage(self, piece):
         """Directly adds a new chunk with no overlap from previous chunks."""
         piece.layer_id = self.next_chunk_id_in_layer # Update piece's layer_id
-        self.all_pieces_ordered.append(piece) # Still add to global list for consistency
+        self._get_stream(piece).recent_pieces.append(piece) # Still available as overlap for later chunks
         
         chunk = self._create_and_add_new_chunk(
             pieces_list=[piece], 
             layer=piece.layer, tag=piece.tag, metadata=piece.metadata, scene_id=piece.scene_id,
-            piece_id_for_logging=piece.id, layer_id=self.next_chunk_id_in_layer
+            piece_id_for_logging=piece.id, layer_id=self.next_chunk_id_in_layer, visible_to=piece.visible_to
         )
         self.next_chunk_id_in_layer += 1
         logger.info(f"[{type(self).__name__}] Directly added new chunk {chunk.id} with text '{piece.text[:30]}...'")
         return chunk.id
 
+    def add_existing_chunk(self, chunk):
+        """Indexes an already built chunk (e.g. one moved from another sub-storage), keeping its ID."""
+        self.add_existing_chunks([chunk])
+
+    def add_existing_chunks(self, chunks):
+        """Batch version of add_existing_chunk. Chunks without an embedding are embedded lazily."""
+        for chunk in chunks:
+            self.chunks[chunk.id] = chunk
+            self._get_stream(chunk).add_chunk(chunk.id)
+        self._index_chunks(chunks)
+
+    def update_piece_texts(self, texts):
+        """
+        Replaces the text of pieces in place, texts: {piece_id: new text}. Every chunk holding one of them
+        (overlap included) gets its text rebuilt and is re-indexed, the vector lazily. Returns the updated chunks.
+        """
+        updated = []
+        for chunk in self.chunks.values():
+            pieces = [piece for piece in chunk.pieces if piece.id in texts]
+            if not pieces:
+                continue
+            for piece in pieces:
+                piece.text = texts[piece.id]
+                piece.embedding = None
+            chunk.text = "\n".join([p.text.strip() for p in chunk.pieces])
+            chunk.embedding = None
+            updated.append(chunk)
+        self._index_chunks(updated)
+        return updated
+
     def build_bm25(self):
-        if self.documents_for_bm25:
-            self.bm25 = BM25Okapi(self.documents_for_bm25)
-            logger.info(f"[{type(self).__name__}] BM25 index rebuilt.")
+        """Rebuilds the BM25 index from scratch. Normal inserts and removals keep it up to date incrementally."""
+        self.bm25 = IncrementalBM25()
+        for chunk_id, chunk in self.chunks.items():
+            self.bm25.add_document(chunk_id, self._bm25_tokens(chunk))
+        if not self.chunks:
+            logger.warning(f"[{type(self).__name__}] No documents for BM25. BM25 index is empty.")
         else:
-            self.bm25 = None
-            logger.warning(f"[{type(self).__name__}] No documents for BM25. BM25 index is None.")
+            logger.info(f"[{type(self).__name__}] BM25 index rebuilt.")
             
     def get_chunk(self, chunk_id):
         return self.chunks.get(chunk_id)
 
-    def retrieve(self, query_text, current_scene_id, top_k, bm25_weight, vector_weight, importance_weight):
-        """
-        Retrieves relevant chunks from this sub-storage.
-        This is a base retrieval, specific sub-classes might override or extend this.
-        Returns a list of {'score': score, 'chunk': chunk} dicts.
-        """
-        tokenized_query = DocumentProcessor().tokenize_text(query_text)
-        
-        bm25_scores_by_chunk_id = {}
-        if self.bm25 and self.documents_for_bm25:
-            bm25_scores_raw = self.bm25.get_scores(tokenized_query)
-            for chunk_id, internal_idx in self.chunk_id_to_bm25_internal_idx.items():
-                if internal_idx < len(bm25_scores_raw):
-                    bm25_scores_by_chunk_id[chunk_id] = bm25_scores_raw[internal_idx]
-        else:
-            logger.warning(f"[{type(self).__name__}] BM25 index not built or no documents.")
-
-        query_embedding = self.embed_model.encode(query_text)
-        vec = np.array([query_embedding]).astype('float32')
-        
-        vector_scores_by_chunk_id = defaultdict(float)
-        num_docs_in_faiss = self.faiss_index.ntotal
+    def get_chunk_vector(self, chunk_id):
+        """The indexed (possibly quantized/truncated, returned as float32) vector of a chunk."""
+        if chunk_id in self.dirty_chunks:
+            self.flush_embeddings()
+        return self.vector_store.get_vector(chunk_id)
 
-        if num_docs_in_faiss > 0:
-            actual_faiss_k = min(top_k * 5, num_docs_in_faiss) # Search a larger k to get enough candidates
-            faiss_distances, faiss_chunk_ids = self.faiss_index.search(vec, actual_faiss_k)
-            
-            if faiss_chunk_ids.size > 0:
-                for dist, chunk_id in zip(faiss_distances[0], faiss_chunk_ids[0]):
-                    vector_scores_by_chunk_id[chunk_id] = 1.0 / (dist + 1e-9)
-        else:
-            logger.warning(f"[{type(self).__name__}] FAISS index is empty.")
+    def get_indexed_vector(self, chunk_id):
+        """get_chunk_vector without embedding anything: None for a chunk changed since its last embedding."""
+        return None if chunk_id in self.dirty_chunks else self.vector_store.get_vector(chunk_id)
 
-        scored_chunks_info = []
-        for chunk_id, chunk in self.chunks.items():
-            bm25_s = bm25_scores_by_chunk_id.get(chunk_id, 0.0)
-            vector_s = vector_scores_by_chunk_id.get(chunk_id, 0.0)
+    def snapshot_state(self):
+        """
+        JSON-serializable state of this sub-storage for MemoryStorage.save_snapshot, plus its vectors
+        (rows aligned with state["vector_ids"]). Pieces shared by several chunks are stored once.
+        """
+        self.flush_embeddings()
+        pieces = {}
+        for chunk in self.chunks.values():
+            for piece in chunk.pieces:
+                pieces[piece.id] = piece
+        for stream in self.streams.values():
+            for piece in stream.recent_pieces:
+                pieces[piece.id] = piece
+        def viewers(visible_to):
+            return None if visible_to is None else sorted(visible_to)
+        state = {
+            "next_chunk_id_in_layer": self.next_chunk_id_in_layer,
+            "pieces": [{"id": p.id, "text": p.text, "layer": p.layer, "tag": p.tag, "metadata": p.metadata,
+                        "layer_id": p.layer_id, "scene_id": p.scene_id, "visible_to": viewers(p.visible_to)} for p in pieces.values()],
+            "chunks": [{"id": c.id, "piece_ids": [p.id for p in c.pieces], "text": c.text, "layer": c.layer, "tag": c.tag,
+                        "metadata": c.metadata, "layer_id": c.layer_id, "scene_id": c.scene_id, "visible_to": viewers(c.visible_to),
+                        "importance": c.importance,
+                        "max_pieces": c.max_pieces, "max_text_length": c.max_text_length,
+                        "bm25_tokens": self._bm25_tokens(c)} for c in self.chunks.values()],
+            "table_order": [int(chunk_id) for chunk_id in self.scoring_table.chunk_ids[:self.scoring_table.size]],
+            "vector_ids": [int(chunk_id) for chunk_id in self.vector_store.row_ids[:self.vector_store.ntotal]],
+            "streams": [[layer, tag, scene_id, viewers(visible_to), sorted(stream.chunk_ids), stream.open_chunk_id,
+                         [p.id for p in stream.recent_pieces]]
+                        for (layer, tag, scene_id, visible_to), stream in self.streams.items()],
+        }
+        return state, self.vector_store.get_vectors()
+
+    def restore_state(self, state, vectors):
+        """Inverse of snapshot_state on an empty sub-storage. Nothing is tokenized or embedded."""
+        self.version = next(_sub_storage_versions)
+        pieces = {}
+        for p in state["pieces"]:
+            pieces[p["id"]] = MemoryPiece(p["id"], p["text"], p["layer"], p["tag"], p["metadata"], p["layer_id"], p["scene_id"], p["visible_to"])
+        for c in state["chunks"]:
+            chunk = MemoryChunk(c["id"], [pieces[piece_id] for piece_id in c["piece_ids"]], layer=c["layer"], tag=c["tag"],
+                                metadata=c["metadata"], layer_id=c["layer_id"], scene_id=c["scene_id"], visible_to=c["visible_to"])
+            chunk.text = c["text"]
+            chunk.importance = c["importance"]
+            chunk.max_pieces = c["max_pieces"]
+            chunk.max_text_length = c["max_text_length"]
+            chunk.bm25_tokens = (f"{chunk.layer}:{chunk.text}", c["bm25_tokens"])
+            self.chunks[chunk.id] = chunk
+            self.bm25.add_document(chunk.id, c["bm25_tokens"])
+        self.next_chunk_id_in_layer = state["next_chunk_id_in_layer"]
+
+        # Rows keep their saved order, so ties rank exactly as before the snapshot
+        self.vector_store.upsert(state["vector_ids"], vectors)
+        for chunk_id in state["table_order"]:
+            self.scoring_table.add(self.chunks[chunk_id])
+
+        for layer, tag, scene_id, visible_to, chunk_ids, open_chunk_id, recent_piece_ids in state["streams"]:
+            stream = self.streams[(layer, tag, scene_id, visibility_set(visible_to))] = ChunkStream(self.chunk_overlap_pieces)
+            stream.chunk_ids = set(chunk_ids)
+            stream.open_chunk_id = open_chunk_id
+            stream.recent_pieces.extend(pieces[piece_id] for piece_id in recent_piece_ids)
+
+    def get_scene_chunks(self, scene_id, tags=None):
+        """Chunks of one scene (optionally only the given tags) in chronological order, looked up through the streams."""
+        chunk_ids = []
+        for (layer, tag, stream_scene_id, _), stream in self.streams.items():
+            if stream_scene_id == scene_id and (tags is None or tag in tags):
+                chunk_ids.extend(stream.chunk_ids)
+        return [self.chunks[chunk_id] for chunk_id in sorted(chunk_ids)]
+
+    def _relevance_scores(self, query_context, top_k, bm25_weight, vector_weight, viewer=None):
+        """
+        bm25_weight * BM25 + vector_weight * vector score of every row, and the rows viewer may see (None: all).
+        Neither depends on importance, so they are cached on the query context until this sub-storage changes.
+        """
+        return self.prefetch_relevance([(query_context, viewer)], top_k, bm25_weight, vector_weight)[0]
 
-            base_score = (bm25_weight * bm25_s) + (vector_weight * vector_s) + (importance_weight * chunk.importance)
-            
-            if base_score <= 1e-6: 
+    def prefetch_relevance(self, requests, top_k, bm25_weight, vector_weight):
+        """
+        _relevance_scores of several (query_context, viewer) pairs. The pairs not cached yet share one multi-row
+        vector search per viewer, among the chunks that viewer saw; each keeps the candidates its own single search
+        would have found.
+        Returns the (scores, visible mask) of every pair, in order; the cache keeps only the nonzero scores.
+        """
+        self.flush_embeddings() # searches need the vectors of the chunks changed since the last retrieval
+        table = self.scoring_table
+        n = table.size
+        results = [None] * len(requests)
+        missing = [] # (index in requests, cache key, visible mask, chunk ids to search among)
+        for i, (query_context, viewer) in enumerate(requests):
+            key = (id(self), self.version, top_k, bm25_weight, vector_weight, viewer)
+            visible = table.visible_mask(viewer) if viewer is not None else None
+            cached = query_context.relevance.get(key)
+            if cached is not None:
+                results[i] = (self._dense_scores(*cached), visible)
                 continue
+            # Entries of older versions of this sub-storage are stale
+            for stale_key in [k for k in query_context.relevance if k[0] == id(self) and k[1] != self.version]:
+                del query_context.relevance[stale_key]
+            # Only the chunks viewer saw are searched, so the candidates stay top_k * 5 however much of the log is hidden
+            among_ids = table.chunk_ids[:n][visible] if visible is not None and not visible.all() else None
+            missing.append((i, key, visible, among_ids))
+        if not missing:
+            return results
+
+        searches = {} # position in missing -> (distances, chunk ids) of its vector search
+        if self.vector_store.ntotal > 0:
+            by_viewer = {}
+            for j, (i, _, _, _) in enumerate(missing):
+                by_viewer.setdefault(requests[i][1], []).append(j)
+            k = min(top_k * 5, self.vector_store.ntotal) # Search a larger k to get enough candidates
+            for positions in by_viewer.values():
+                queries = np.array([requests[missing[j][0]][0].embedding for j in positions]).astype('float32')
+                distances, chunk_ids = self.vector_store.search(queries, k, among_ids=missing[positions[0]][3])
+                searches.update({j: (distances[row], chunk_ids[row]) for row, j in enumerate(positions)})
+        else:
+            logger.warning(f"[{type(self).__name__}] Vector store is empty.")
+        if not len(self.bm25):
+            logger.warning(f"[{type(self).__name__}] BM25 index not built or no documents.")
 
-            # Apply layer/tag specific weights
-            layer_weight = LAYER_WEIGHTS.get(chunk.layer, 1.0) * TAG_WEIGHTS.get(chunk.tag, 1.0)
-            final_score = base_score * layer_weight
-
-            if current_scene_id is not None and chunk.scene_id is not None and chunk.scene_id != current_scene_id:
-                try:
-                    scene_diff = abs(current_scene_id - chunk.scene_id)
-                except:
-                    scene_diff = int(current_scene_id.split("scene")[1]) - int(chunk.scene_id.split("scene")[1])
-                inter_scene_recency_weight = 1.0 / (1 + 0.25 * scene_diff)
-                final_score *= inter_scene_recency_weight
-                logger.info(f"  [{type(self).__name__}] Inter-scene Recency (diff {scene_diff}): {inter_scene_recency_weight:.2f} -> Score: {final_score:.4f}")
-
-            scored_chunks_info.append({'score': final_score, 'chunk': chunk})
-        
+        for j, (i, key, visible, _) in enumerate(missing):
+            query_context = requests[i][0]
+            rows, scores = [], []
+            if len(self.bm25):
+                # Only chunks containing a query word have a non-zero BM25 score
+                bm25_scores = self.bm25.get_sparse_scores(query_context.tokens)
+                rows.append(np.array([table.row_of[chunk_id] for chunk_id in bm25_scores], dtype='int64'))
+                scores.append(bm25_weight * np.array(list(bm25_scores.values()), dtype='float64'))
+
+            if j in searches:
+                distances, chunk_ids = searches[j]
+                found = chunk_ids >= 0
+                rows.append(np.array([table.row_of[int(chunk_id)] for chunk_id in chunk_ids[found]], dtype='int64'))
+                scores.append(vector_weight * (1.0 / (distances[found] + 1e-9)))
+
+            # A row found by both gets bm25 + vector, as in the dense sum
+            candidate_rows, inverse = np.unique(np.concatenate(rows) if rows else np.zeros(0, dtype='int64'), return_inverse=True)
+            candidate_scores = np.zeros(len(candidate_rows))
+            if rows:
+                np.add.at(candidate_scores, inverse, np.concatenate(scores))
+            query_context.relevance[key] = (candidate_rows, candidate_scores)
+            results[i] = (self._dense_scores(candidate_rows, candidate_scores), visible)
+        return results
+
+    def _dense_scores(self, rows, scores):
+        dense = np.zeros(self.scoring_table.size)
+        dense[rows] = scores
+        return dense
+
+    def _hybrid_scores(self, query_context, current_scene_id, top_k, bm25_weight, vector_weight, importance_weight, viewer=None):
+        """
+        Scores every row of self.scoring_table at once:
+        (bm25 + vector + importance) * layer/tag weight * inter-scene recency.
+        Chunks whose base score is not positive, or that viewer (if given) did not see, get -inf.
+        """
+        table = self.scoring_table
+        n = table.size
+        relevance, visible = self._relevance_scores(query_context, top_k, bm25_weight, vector_weight, viewer)
+        base_scores = relevance + (importance_weight * table.importance[:n])
+        # Apply layer/tag specific weights and inter-scene recency
+        final_scores = base_scores * table.tag_weight[:n] * self._inter_scene_weights(np.arange(n), current_scene_id)
+        final_scores[base_scores <= 1e-6] = -np.inf
+        if visible is not None:
+            final_scores[~visible] = -np.inf
+        return final_scores
+
+    def _inter_scene_weights(self, rows, current_scene_id, alpha=SCENE_RECENCY_ALPHA):
+        """1 / (1 + alpha * scene distance) for chunks of other scenes, 1 for the current scene and scene-less chunks."""
+        weights = np.ones(len(rows))
+        current_index = scene_index(current_scene_id)
+        if np.isnan(current_index):
+            return weights
+        scene_diff = np.abs(current_index - self.scoring_table.scene_index[rows])
+        other_scene = scene_diff > 0 # nan (scene-less) compares False
+        weights[other_scene] = 1.0 / (1 + alpha * scene_diff[other_scene])
+        return weights
+
+    @staticmethod
+    def _top_indices(scores, top_k):
+        """Indices of the top_k finite scores, best first (argpartition, then sort only the selected ones)."""
+        valid = np.flatnonzero(scores > -np.inf)
+        if top_k <= 0 or not len(valid):
+            return valid[:0]
+        if top_k < len(valid):
+            valid = valid[np.argpartition(-scores[valid], top_k - 1)[:top_k]]
+        return valid[np.argsort(-scores[valid], kind='stable')]
+
+    def _results_for_rows(self, rows, scores):
+        chunk_ids = self.scoring_table.chunk_ids
+        return [{'score': float(score), 'chunk': self.chunks[int(chunk_ids[row])]} for row, score in zip(rows, scores)]
+
+    def _reinforce(self, retrieved_chunks):
+        """The retrieved chunks are more important: raise their importance by their capped score."""
+        for chunk_info in retrieved_chunks:
+            chunk = chunk_info['chunk']
+            addition = min(chunk_info['score'], IMPORTANCE_ADDITION_THRESHOLD) * IMPORTANCE_ADDITION_WEIGHT
+            chunk.importance += addition
+            row = self.scoring_table.row_of.get(chunk.id)
+            if row is not None:
+                self.scoring_table.importance[row] = chunk.importance
+
+    def retrieve(self, query_text, current_scene_id, top_k, bm25_weight, vector_weight, importance_weight, query_context=None, viewer=None):
+        """
+        Retrieves relevant chunks from this sub-storage.
+        This is a base retrieval, specific sub-classes might override or extend this.
+        query_context: optional QueryContext for query_text, so that several sub-storages share one tokenization and encode.
+        viewer: only retrieve chunks visible to this character (None: every chunk).
+        Returns a list of {'score': score, 'chunk': chunk} dicts.
+        """
+        if query_context is None:
+            query_context = QueryContext(query_text, self.embed_model)
+        scores = self._hybrid_scores(query_context, current_scene_id, top_k, bm25_weight, vector_weight, importance_weight, viewer)
         # Sort and return top_k
-        sorted_by_score = sorted(scored_chunks_info, key=lambda x: x['score'], reverse=True)
-        final_retrieved_chunks = sorted_by_score[:top_k]
-        return final_retrieved_chunks
+        rows = self._top_indices(scores, top_k)
+        return self._results_for_rows(rows, scores[rows])
     
     def remove_chunk(self, chunk_id):
         """
-        Removes a chunk completely from this sub-storage, including its FAISS and BM25 entries.
+        Removes a chunk completely from this sub-storage, including its vector and BM25 entries.
         Returns the removed chunk object if successful, None otherwise.
         """
-        chunk_to_remove = self.chunks.pop(chunk_id, None)
-        if not chunk_to_remove:
-            logger.warning(f"Chunk with ID {chunk_id} not found in {type(self).__name__} for removal.")
-            return None
-
-        # Remove from FAISS index
-        try:
-            self.faiss_index.remove_ids(np.array([chunk_id]))
-            logger.debug(f"[{type(self).__name__}] FAISS entry removed for chunk {chunk_id}.")
-        except Exception as e:
-            logger.error(f"[{type(self).__name__}] Error removing FAISS entry for chunk {chunk_id}: {e}")
-            # Continue even if FAISS removal fails, as chunk is already popped from self.chunks
-
-        # Remove from BM25 related structures
-        bm25_internal_idx = self.chunk_id_to_bm25_internal_idx.pop(chunk_id, None)
-        if bm25_internal_idx is not None and bm25_internal_idx < len(self.documents_for_bm25):
-            # Remove the document from the list. This will shift subsequent indices.
-            self.documents_for_bm25.pop(bm25_internal_idx)
-            # Rebuild the chunk_id_to_bm25_internal_idx map because indices have shifted
-            self.chunk_id_to_bm25_internal_idx = {}
-            for i, doc_tokens in enumerate(self.documents_for_bm25):
-                # This assumes chunk_id can be extracted from doc_tokens or that BM25 internal order
-                # directly maps to how we populate. A more robust way is to store chunk_id with doc.
-                # For simplicity here, we assume re-mapping all after a pop.
-                # A better approach would be to store a list of (chunk_id, tokenized_doc)
-                # and rebuild from that list.
-                # For now, we'll iterate through existing chunks to rebuild.
-                pass # Will rebuild completely below
-            
-            # Rebuild BM25 map based on remaining chunks in self.chunks
-            self.chunk_id_to_bm25_internal_idx = {}
-            temp_docs = []
-            for i, c_id in enumerate(sorted(self.chunks.keys())): # Iterate sorted keys to keep some order
-                chunk = self.chunks[c_id]
-                temp_docs.append(DocumentProcessor().tokenize_text(f"{chunk.layer}:{chunk.text}"))
-                self.chunk_id_to_bm25_internal_idx[c_id] = i
-            self.documents_for_bm25 = temp_docs # Update the document list
-            self.build_bm25() # Rebuild BM25 index after document change
-            logger.debug(f"[{type(self).__name__}] BM25 document and index rebuilt after removing chunk {chunk_id}.")
-        else:
-            logger.warning(f"[{type(self).__name__}] BM25 internal index for chunk {chunk_id} not found or out of bounds. BM25 may be inconsistent or not need rebuild for this removal.")
-
-        # Remove from all_pieces_ordered
-        # This is tricky as all_pieces_ordered maintains a chronological list of ALL pieces,
-        # not just ones currently in chunks. If a chunk is removed, its pieces are still in all_pieces_ordered.
-        # For a true "remove" from the *sub-storage's perspective*, you might also want to remove pieces.
-        # However, for the purpose of overlap, it might be fine to leave them, or you could implement
-        # a more complex piece tracking. For now, we'll keep it simple and not remove individual pieces from all_pieces_ordered.
-        # This means all_pieces_ordered will still contain pieces from removed chunks.
-        # If this causes issues for overlap logic or memory, a more sophisticated solution is needed.
-        
-        logger.info(f"[{type(self).__name__}] Chunk {chunk_id} completely removed.")
-        return chunk_to_remove
\ No newline at end of file
+        removed_chunks = self.remove_chunks([chunk_id])
+        return removed_chunks[0] if removed_chunks else None
+
+    def remove_chunks(self, chunk_ids):
+        """
+        Removes several chunks at once. Every index drops a removed row by moving its last row into the
+        freed slot, so the cost is proportional to the removed chunks, not to the size of the sub-storage.
+        Returns the removed chunk objects, in the order of chunk_ids.
+        """
+        removed_chunks = []
+        for chunk_id in chunk_ids:
+            chunk_to_remove = self.chunks.pop(chunk_id, None)
+            if not chunk_to_remove:
+                logger.warning(f"Chunk with ID {chunk_id} not found in {type(self).__name__} for removal.")
+                continue
+            removed_chunks.append(chunk_to_remove)
+            self.dirty_chunks.pop(chunk_id, None)
+        if not removed_chunks:
+            return removed_chunks
+
+        self.version = next(_sub_storage_versions)
+        removed_ids = [chunk.id for chunk in removed_chunks]
+        removed_vectors = self.vector_store.remove_ids(removed_ids)
+        if removed_vectors != len(removed_ids):
+            logger.warning(f"[{type(self).__name__}] Only {removed_vectors} of {len(removed_ids)} vector entries found for removal.")
+
+        for chunk in removed_chunks:
+            self.scoring_table.remove(chunk.id)
+            # Remove from BM25: only the removed chunk's postings are touched
+            if not self.bm25.remove_document(chunk.id):
+                logger.warning(f"[{type(self).__name__}] BM25 entry for chunk {chunk.id} not found. BM25 may be inconsistent.")
+            # The stream falls back to its previous chunk. Recent pieces are kept for overlap, as before.
+            stream = self.streams.get(self._stream_key(chunk))
+            if stream is not None:
+                stream.remove_chunk(chunk.id)
+
+        logger.info(f"[{type(self).__name__}] Removed {len(removed_chunks)} chunks: {removed_ids}.")
+        return removed_chunks
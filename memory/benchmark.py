@@ -0,0 +1,208 @@
+"""
+Micro-benchmarks of the memory operations on synthetic dialogue.
+
+    python -m memory.benchmark [--sizes 10 1000 100000] [--languages en zh] [--output benchmark.json]
+
+For every size and language a MemoryStorage is filled with that many generated dialogue lines spread
+over several scenes (add_piece), then add_chunk, retrieve, summarize_scene_events and remove_chunk are
+timed on it. Embeddings come from a deterministic hashing embedder and summaries from a stand-in LLM, so
+the numbers measure the memory code only and are comparable across commits (same seed, same data).
+Every operation reports count, throughput, p50/p99 latency and the peak Python memory it allocated
+(tracemalloc, which also slows the timed code down; pass --no-memory for latency only).
+"""
+import re
+import sys
+import json
+import time
+import zlib
+import random
+import logging
+import argparse
+import platform
+import tracemalloc
+import subprocess
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = [10, 100, 1000, 10000] # add 100000 for the large end (tens of minutes)
+
+EN_SPEAKERS = ["Alice", "Bob", "Carol", "Dave", "Eve", "Frank", "Grace"]
+EN_WORDS = ("door train ticket clock waiting room letter doctor station night window rain coffee secret "
+            "money brother promise police murder train key bag storm silence phone map name lie truth").split()
+ZH_SPEAKERS = ["张三", "李四", "王五", "赵六", "孙七", "周八", "吴九"]
+ZH_WORDS = ("门 火车 车票 时钟 候车室 信 医生 车站 夜晚 窗户 雨 咖啡 秘密 钱 哥哥 承诺 警察 "
+            "凶手 钥匙 包 暴风雨 沉默 电话 地图 名字 谎言 真相 我们 今天 已经 为什么 不知道").split()
+
+class StandInEmbedder:
+    """Deterministic SentenceTransformer stand-in: hashed, signed bag of words (CJK text by character), L2-normalized."""
+    def __init__(self, dimension=384):
+        self.dimension = dimension
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    def _encode_one(self, text):
+        vector = np.zeros(self.dimension, dtype='float32')
+        for token in re.findall(r"[一-鿿]|\w+", text.lower()):
+            h = zlib.crc32(token.encode('utf-8'))
+            vector[h % self.dimension] += 1.0 if h & 1 << 31 else -1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def encode(self, sentences, **kwargs):
+        if isinstance(sentences, str):
+            return self._encode_one(sentences)
+        if not len(sentences):
+            return np.zeros((0, self.dimension), dtype='float32')
+        return np.stack([self._encode_one(text) for text in sentences])
+
+class StandInLLM:
+    """Deterministic LLM stand-in for the Summarizer: the summary is the start of the text to summarize."""
+    def __init__(self, summary_chars=200):
+        self.summary_chars = summary_chars
+        self.calls = 0
+
+    def query(self, prompt, sys=None, **kwargs):
+        self.calls += 1
+        return "Summary: " + " ".join(prompt.split())[:self.summary_chars]
+
+    async def aquery(self, prompt, sys=None, **kwargs):
+        return self.query(prompt, sys, **kwargs)
+
+def synthetic_dialogue(num_pieces, num_scenes=5, language="en", seed=0):
+    """{scene_id: [line, ...]} with num_pieces generated lines split evenly over num_scenes scenes."""
+    rng = random.Random(f"{seed}-{language}-{num_pieces}")
+    speakers, words = (ZH_SPEAKERS, ZH_WORDS) if language == "zh" else (EN_SPEAKERS, EN_WORDS)
+    separator, colon, end = ("", "：", "。") if language == "zh" else (" ", ": ", ".")
+    num_scenes = max(1, min(num_scenes, num_pieces))
+    records = {}
+    for i in range(num_pieces):
+        line = separator.join(rng.choice(words) for _ in range(rng.randint(4, 16)))
+        records.setdefault(f"scene{i * num_scenes // num_pieces + 1}", []).append(f"{rng.choice(speakers)}{colon}{line}{end}")
+    return records
+
+def _summary(latencies, seconds, peak_bytes):
+    latencies_ms = np.asarray(latencies) * 1000
+    return {
+        "count": len(latencies),
+        "total_s": seconds,
+        "throughput_per_s": len(latencies) / seconds if seconds > 0 else None,
+        "p50_ms": float(np.percentile(latencies_ms, 50)) if len(latencies) else None,
+        "p99_ms": float(np.percentile(latencies_ms, 99)) if len(latencies) else None,
+        "peak_memory_bytes": peak_bytes,
+    }
+
+def _measure(calls, trace_memory):
+    """Runs every zero-argument callable in calls, timing each; returns the operation summary."""
+    latencies = []
+    if trace_memory:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    for call in calls:
+        call_start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - call_start)
+    seconds = time.perf_counter() - start
+    peak_bytes = tracemalloc.get_traced_memory()[1] - baseline if trace_memory else None
+    return _summary(latencies, seconds, peak_bytes)
+
+def install_stand_ins(dimension=384):
+    """Makes every MemoryStorage use the stand-in embedder and the Summarizer the stand-in LLM."""
+    import models
+    from memory.memory import ModelSingleton
+    from memory.embedding_service import EmbeddingService
+    ModelSingleton._instance = EmbeddingService(StandInEmbedder(dimension))
+    models._global_llm_service = StandInLLM()
+
+def _warm_up(language, seed=0):
+    """One untimed ingestion and retrieval, so one-time costs (e.g. loading the tokenizer dictionary) are not measured."""
+    from memory.memory import MemoryStorage
+    storage = MemoryStorage()
+    for scene_id, lines in synthetic_dialogue(10, 1, language, seed).items():
+        storage.add_pieces(lines, "event", tag="conversation", scene_id=scene_id)
+        storage.retrieve(lines[0], ["event"], scene_id)
+
+def benchmark_storage(num_pieces, language="en", num_scenes=5, samples=200, seed=0, trace_memory=True):
+    """Times every memory operation on a storage holding num_pieces synthetic lines; returns {operation: summary}."""
+    from memory.memory import MemoryStorage
+    records = synthetic_dialogue(num_pieces, num_scenes, language, seed)
+    scene_ids = list(records)
+    current_scene_id = scene_ids[-1]
+    # Queries and direct chunks are lines of the same distribution that are not in the storage
+    extra_lines = [line for lines in synthetic_dialogue(2 * samples, 1, language, seed + 1).values() for line in lines]
+    rng = random.Random(seed)
+    storage = MemoryStorage()
+    operations = {}
+
+    operations["add_piece"] = _measure(
+        [lambda text=text, scene_id=scene_id: storage.add_piece(text, "event", tag="conversation", scene_id=scene_id)
+         for scene_id, lines in records.items() for text in lines], trace_memory)
+    # Pieces are embedded lazily, so the encoding add_piece deferred is a separate cost
+    operations["flush_embeddings"] = _measure([storage.flush_embeddings], trace_memory)
+    operations["add_chunk"] = _measure(
+        [lambda text=text: storage.add_chunk(text, "global", tag="scene_init", scene_id=current_scene_id)
+         for text in extra_lines[:samples]], trace_memory)
+    operations["retrieve"] = _measure(
+        [lambda text=text: storage.retrieve(text, ["event", "summary", "archive"], current_scene_id)
+         for text in extra_lines[samples:]], trace_memory)
+    operations["summarize_scene_events"] = _measure(
+        [lambda scene_id=scene_id: storage.summarizer.summarize_scene_events(scene_id) for scene_id in scene_ids[:-1]], trace_memory)
+    removable_ids = list(storage.event_storage.chunks)
+    operations["remove_chunk"] = _measure(
+        [lambda chunk_id=chunk_id: storage.event_storage.remove_chunk(chunk_id)
+         for chunk_id in rng.sample(removable_ids, min(samples, len(removable_ids)))], trace_memory)
+    return operations
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(sizes=DEFAULT_SIZES, languages=("en", "zh"), num_scenes=5, samples=200, seed=0, dimension=384, trace_memory=True):
+    """Runs benchmark_storage for every size and language; returns the JSON-serializable report."""
+    install_stand_ins(dimension)
+    if trace_memory:
+        tracemalloc.start()
+    results = []
+    try:
+        for language in languages:
+            _warm_up(language, seed)
+            for size in sizes:
+                start = time.perf_counter()
+                operations = benchmark_storage(size, language, num_scenes, samples, seed, trace_memory)
+                results.append({"size": size, "language": language, "operations": operations})
+                print(f"[benchmark] {language} {size} pieces done in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return {
+        "meta": {"commit": _git_commit(), "python": platform.python_version(), "platform": platform.platform(),
+                 "num_scenes": num_scenes, "samples": samples, "seed": seed, "dimension": dimension,
+                 "trace_memory": trace_memory, "created": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "results": results,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the memory operations on synthetic dialogue.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="pieces per storage")
+    parser.add_argument("--languages", nargs="+", default=["en", "zh"], choices=["en", "zh"])
+    parser.add_argument("--scenes", type=int, default=5, help="scenes the pieces are spread over")
+    parser.add_argument("--samples", type=int, default=200, help="timed calls of add_chunk, retrieve and remove_chunk")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dimension", type=int, default=384, help="stand-in embedding dimension")
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc (faster, no peak memory)")
+    parser.add_argument("--output", default="benchmark.json")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING) # the memory modules log every piece, and warn about the empty layers
+    report = run_benchmarks(args.sizes, args.languages, args.scenes, args.samples, args.seed, args.dimension, not args.no_memory)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    for result in report["results"]:
+        for operation, summary in result["operations"].items():
+            print(f"{result['language']} {result['size']:>6} {operation:<22} " + "  ".join(
+                f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}" for key, value in summary.items()))
+    print(f"Saved to {args.output}", file=sys.stderr)
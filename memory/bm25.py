@@ -0,0 +1,166 @@
+import math
+import logging
+from collections import Counter, defaultdict
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class IncrementalBM25:
+    """
+    Okapi BM25 over a mutable corpus.
+
+    Keeps an inverted index (word -> {doc_id: term frequency}) together with document lengths
+    and a histogram of document frequencies, so adding, replacing or removing one document only
+    touches that document's postings. get_scores() returns the same values as
+    rank_bm25.BM25Okapi built over the current documents (in insertion order, see doc_ids).
+    """
+    def __init__(self, k1=1.5, b=0.75, epsilon=0.25):
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+
+        self.doc_ids = []           # row -> doc_id, the order of get_scores()
+        self.doc_id_to_row = {}
+        self.doc_len = []           # row -> number of tokens
+        self.doc_freqs = []         # row -> Counter of tokens
+        self.postings = defaultdict(dict) # word -> {doc_id: term frequency}
+        self.total_len = 0
+        self.df_histogram = Counter() # document frequency -> number of words with it
+
+        self._idf_params = None     # (avgdl, epsilon * average_idf), reset on every mutation
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.doc_id_to_row
+
+    @property
+    def corpus_size(self):
+        return len(self.doc_ids)
+
+    def add_document(self, doc_id, tokens):
+        if doc_id in self.doc_id_to_row:
+            self.update_document(doc_id, tokens)
+            return
+        freqs = Counter(tokens)
+        self.doc_id_to_row[doc_id] = len(self.doc_ids)
+        self.doc_ids.append(doc_id)
+        self.doc_len.append(len(tokens))
+        self.doc_freqs.append(freqs)
+        self.total_len += len(tokens)
+        for word, tf in freqs.items():
+            self._add_posting(word, doc_id, tf)
+        self._idf_params = None
+
+    def update_document(self, doc_id, tokens):
+        """Replaces the tokens of an existing document, touching only the words that changed."""
+        row = self.doc_id_to_row.get(doc_id)
+        if row is None:
+            self.add_document(doc_id, tokens)
+            return
+        old_freqs = self.doc_freqs[row]
+        new_freqs = Counter(tokens)
+        for word in old_freqs.keys() - new_freqs.keys():
+            self._remove_posting(word, doc_id)
+        for word, tf in new_freqs.items():
+            if word in old_freqs:
+                self.postings[word][doc_id] = tf
+            else:
+                self._add_posting(word, doc_id, tf)
+        self.total_len += len(tokens) - self.doc_len[row]
+        self.doc_len[row] = len(tokens)
+        self.doc_freqs[row] = new_freqs
+        self._idf_params = None
+
+    def remove_document(self, doc_id):
+        """Removes a document. The last row is moved into the freed slot, so this is O(len(doc))."""
+        row = self.doc_id_to_row.pop(doc_id, None)
+        if row is None:
+            return False
+        for word in self.doc_freqs[row]:
+            self._remove_posting(word, doc_id)
+        self.total_len -= self.doc_len[row]
+
+        last = len(self.doc_ids) - 1
+        if row != last:
+            moved_id = self.doc_ids[last]
+            self.doc_ids[row] = moved_id
+            self.doc_len[row] = self.doc_len[last]
+            self.doc_freqs[row] = self.doc_freqs[last]
+            self.doc_id_to_row[moved_id] = row
+        self.doc_ids.pop()
+        self.doc_len.pop()
+        self.doc_freqs.pop()
+        self._idf_params = None
+        return True
+
+    def _add_posting(self, word, doc_id, tf):
+        postings = self.postings[word]
+        df = len(postings)
+        if df:
+            self.df_histogram[df] -= 1
+            if not self.df_histogram[df]:
+                del self.df_histogram[df]
+        postings[doc_id] = tf
+        self.df_histogram[df + 1] += 1
+
+    def _remove_posting(self, word, doc_id):
+        postings = self.postings[word]
+        df = len(postings)
+        del postings[doc_id]
+        self.df_histogram[df] -= 1
+        if not self.df_histogram[df]:
+            del self.df_histogram[df]
+        if df > 1:
+            self.df_histogram[df - 1] += 1
+        else:
+            del self.postings[word]
+
+    def _get_idf_params(self):
+        # BM25Okapi floors negative idfs to epsilon * average idf over the whole vocabulary.
+        # Words sharing a document frequency share an idf, so the average only needs the histogram.
+        if self._idf_params is None:
+            n = self.corpus_size
+            vocab_size = sum(self.df_histogram.values())
+            idf_sum = 0.0
+            for df, count in self.df_histogram.items():
+                idf_sum += count * (math.log(n - df + 0.5) - math.log(df + 0.5))
+            average_idf = idf_sum / vocab_size if vocab_size else 0.0
+            avgdl = self.total_len / n if n else 0.0
+            self._idf_params = (avgdl, self.epsilon * average_idf)
+        return self._idf_params
+
+    def idf(self, word):
+        df = len(self.postings.get(word, ()))
+        if not df:
+            return 0.0
+        _, eps = self._get_idf_params()
+        idf = math.log(self.corpus_size - df + 0.5) - math.log(df + 0.5)
+        return eps if idf < 0 else idf
+
+    def get_sparse_scores(self, query):
+        """Returns {doc_id: score} for the documents containing at least one query word; all others score 0."""
+        scores = defaultdict(float)
+        if not self.doc_ids:
+            return scores
+        avgdl, _ = self._get_idf_params()
+        for q in query:
+            postings = self.postings.get(q)
+            if not postings:
+                continue
+            idf = self.idf(q)
+            for doc_id, tf in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self.doc_len[self.doc_id_to_row[doc_id]] / avgdl)
+                scores[doc_id] += idf * (tf * (self.k1 + 1) / (tf + norm))
+        return scores
+
+    def get_scores(self, query):
+        """Returns a numpy array of scores aligned with self.doc_ids."""
+        scores = np.zeros(self.corpus_size)
+        for doc_id, score in self.get_sparse_scores(query).items():
+            scores[self.doc_id_to_row[doc_id]] = score
+        return scores
+
+    def get_scores_by_id(self, query):
+        return dict(zip(self.doc_ids, self.get_scores(query)))
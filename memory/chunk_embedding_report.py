@@ -0,0 +1,99 @@
+"""
+Retrieval quality and ingestion cost of the chunk embedding strategies: "full" (encode the whole chunk text)
+and "pooled" (encode every piece once, pool the piece vectors).
+
+    python -m memory.chunk_embedding_report [script.yaml ...]
+
+Feeds the lines of the given scripts (default: every script in script/) one by one into an
+EventMemorySubStorage and flushes the embeddings after every line, as if each line were followed by a
+retrieval (the most encoding either strategy does). Every tenth line is then used as a query: hit@k is
+how often the vector search finds a chunk holding that line, overlap@k how much the pooled results agree
+with the full ones.
+"""
+import os
+import sys
+import glob
+import time
+import logging
+import numpy as np
+from memory.base import MemoryPiece, CHUNK_EMBEDDING_STRATEGIES
+from memory.layers import EventMemorySubStorage
+from memory.vector_report import _script_lines
+
+logger = logging.getLogger(__name__)
+
+class _ReportStorage:
+    """The parts of MemoryStorage a sub-storage uses: the chunk id counter and the embedding strategy."""
+    def __init__(self, chunk_embedding):
+        self.chunk_embedding = chunk_embedding
+        self.next_global_chunk_id = 0
+
+    def _get_next_global_chunk_id(self):
+        new_id = self.next_global_chunk_id
+        self.next_global_chunk_id += 1
+        return new_id
+
+class _CountingEmbedder:
+    """Counts the encode calls, texts and characters that go through an embedder."""
+    def __init__(self, embedder):
+        self.embedder = embedder
+        self.calls = 0
+        self.texts = 0
+        self.chars = 0
+
+    def get_sentence_embedding_dimension(self):
+        return self.embedder.get_sentence_embedding_dimension()
+
+    def encode(self, sentences, **kwargs):
+        batch = [sentences] if isinstance(sentences, str) else list(sentences)
+        self.calls += 1
+        self.texts += len(batch)
+        self.chars += sum(len(text) for text in batch)
+        return self.embedder.encode(sentences, **kwargs)
+
+def _ingest(lines, embedder, chunk_embedding, scene_size=50, flush_every=1):
+    storage = EventMemorySubStorage(_ReportStorage(chunk_embedding), embedder, embedder.get_sentence_embedding_dimension(), {}, 5, 1)
+    start = time.perf_counter()
+    for i, line in enumerate(lines):
+        storage.add_piece_to_sub_storage(MemoryPiece(i, line, "event", "conversation", scene_id=f"scene{i // scene_size + 1}"))
+        if (i + 1) % flush_every == 0:
+            storage.flush_embeddings()
+    storage.flush_embeddings()
+    return storage, time.perf_counter() - start
+
+def report_chunk_embeddings(lines, embedder, top_k=5, flush_every=1):
+    """Returns one dict per strategy: ingestion throughput, encode work and retrieval quality."""
+    queries = lines[::10]
+    query_vectors = np.asarray(embedder.encode(queries), dtype='float32')
+    rows, found_ids = [], {}
+    for strategy in CHUNK_EMBEDDING_STRATEGIES:
+        counter = _CountingEmbedder(embedder)
+        storage, seconds = _ingest(lines, counter, strategy, flush_every=flush_every)
+        _, ids = storage.vector_store.search(query_vectors, top_k)
+        chunks_of_line = {}
+        for chunk in storage.chunks.values():
+            for piece in chunk.pieces:
+                chunks_of_line.setdefault(piece.text, set()).add(chunk.id)
+        found_ids[strategy] = ids
+        rows.append({
+            "strategy": strategy,
+            "lines_per_s": len(lines) / seconds,
+            "encode_calls": counter.calls,
+            "encoded_texts": counter.texts,
+            "encoded_chars": counter.chars,
+            f"hit@{top_k}": float(np.mean([bool(chunks_of_line[query] & set(ids_row)) for query, ids_row in zip(queries, ids)])),
+        })
+    for row in rows:
+        row[f"overlap@{top_k}_with_full"] = float(np.mean(
+            [len(set(a) & set(b)) / top_k for a, b in zip(found_ids[row["strategy"]], found_ids["full"])]))
+    return rows
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    from sentence_transformers import SentenceTransformer
+    paths = sys.argv[1:] or sorted(glob.glob(os.path.join("script", "*.yaml")))
+    lines = _script_lines(paths)
+    model = SentenceTransformer("all-MiniLM-L6-v2")
+    print(f"{len(lines)} lines, {len(lines[::10])} queries")
+    for row in report_chunk_embeddings(lines, model):
+        print("  ".join(f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}" for key, value in row.items()))
@@ -0,0 +1,57 @@
+import re
+import math
+import logging
+
+logger = logging.getLogger(__name__)
+
+_CJK = re.compile(r"[　-〿㐀-䶿一-鿿＀-￯]")
+
+def estimate_tokens(text):
+    """
+    Rough LLM token count without a tokenizer: one token per CJK character (or full-width punctuation),
+    one per four other characters. Close enough to keep prompt fields within a budget.
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+def assemble_context(retrieved, token_budget=None):
+    """
+    Decides what of a retrieval result goes into a prompt field.
+    retrieved: {sub-storage name: [{'score': score, 'chunk': chunk}, ...]} as returned by MemoryStorage.retrieve
+    token_budget: max estimate_tokens of the kept chunks as rendered by to_text (None or 0: no limit)
+
+    Chunks are taken by descending score across all sub-storages. A chunk only contributes the pieces no
+    better chunk contributed already (consecutive chunks overlap by chunk_overlap_pieces), as many of them
+    as still fit the budget; chunks left with nothing are dropped.
+
+    Returns {sub-storage name: [{'score', 'chunk', 'text'}, ...]} with the same names and order as retrieved,
+    where text is the part of the chunk that was kept.
+    """
+    items = [(name, item) for name, results in retrieved.items() for item in results]
+    items.sort(key=lambda name_item: name_item[1]['score'], reverse=True)
+    used_pieces = set()
+    remaining = token_budget or math.inf
+    kept = {name: [] for name in retrieved}
+    for name, item in items:
+        lines = []
+        header_cost = estimate_tokens(item['chunk'].to_text("")) # what the prompt wraps around the kept lines
+        for piece in item['chunk'].pieces:
+            if piece.id in used_pieces:
+                continue
+            line = piece.text.strip()
+            cost = estimate_tokens(line) + 1 + (0 if lines else header_cost) # + the line break
+            if cost > remaining:
+                break
+            used_pieces.add(piece.id)
+            lines.append(line)
+            remaining -= cost
+        if lines:
+            kept[name].append({'score': item['score'], 'chunk': item['chunk'], 'text': "\n".join(lines)})
+        if remaining <= 0:
+            break
+    dropped = len(items) - sum(len(results) for results in kept.values())
+    if dropped:
+        logger.info(f"[assemble_context] Kept {len(items) - dropped} of {len(items)} retrieved chunks within {token_budget} tokens.")
+    return kept
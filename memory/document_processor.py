@@ -2,8 +2,61 @@ import os
 import jieba
 import re
 import json
+from functools import lru_cache
 from typing import List, Dict, Optional
 
+TOKENIZER_CACHE_SIZE = int(os.getenv("TOKENIZER_CACHE_SIZE") or 20000)
+# Mixed Chinese/English text: tokenize Chinese runs with jieba and English words with the regex in one pass,
+# instead of running jieba over the whole text. Slightly different tokens for mixed text, so off by default.
+TOKENIZER_FAST_MIXED = bool(os.getenv("TOKENIZER_FAST_MIXED") and os.getenv("TOKENIZER_FAST_MIXED").lower() in ["true", "1", "t", "y", "yes"])
+
+# 过滤停用词和短词
+STOPWORDS = frozenset({"的", "了", "和", "是", "在", "有", "与", "为", "以", "及", "对", "上", "中", "下", 
+            "the", "a", "an", "and", "or", "but", "is", "are", "was", "were", 
+            "be", "been", "being", "in", "on", "at", "to", "for", "with", "by",
+            "about", "against", "between", "into", "through", "during", "before",
+            "after", "above", "below", "from", "up", "down", "of", "off", "over",
+            "under", "again", "further", "then", "once", "here", "there", "when",
+            "where", "why", "how", "all", "any", "both", "each", "few", "more",
+            "most", "other", "some", "such", "no", "nor", "not", "only", "own",
+            "same", "so", "than", "too", "very", "can", "will", "just", "should",
+            "now", "d", "ll", "m", "o", "re", "s", "t", "ve", "y", "ain", "aren",
+            "couldn", "didn", "doesn", "hadn", "hasn", "haven", "isn", "ma",
+            "mightn", "mustn", "needn", "shan", "shouldn", "wasn", "weren", "won"})
+_WORD_RE = re.compile(r'\b\w+\b')
+_CJK_RE = re.compile('[\u4e00-\u9fff]')
+_MIXED_RE = re.compile('[\u4e00-\u9fff]+|[^\W\u4e00-\u9fff]+')
+_jieba_ready = False
+
+def _jieba_cut(text):
+    global _jieba_ready
+    if not _jieba_ready:
+        jieba.initialize() # loads the dictionary once instead of on the first cut of every process path
+        _jieba_ready = True
+    return jieba.lcut(text)
+
+@lru_cache(maxsize=TOKENIZER_CACHE_SIZE)
+def tokenize(text: str) -> tuple:
+    """
+    Cached tokenizer shared by BM25 indexing and queries. Returns an immutable tuple, so cached results
+    can be handed out without copying.
+    """
+    # 对中文文本使用jieba分词
+    if _CJK_RE.search(text):  # 检测是否包含中文字符
+        if TOKENIZER_FAST_MIXED:
+            words = []
+            for run in _MIXED_RE.findall(text):
+                if _CJK_RE.match(run):
+                    words.extend(_jieba_cut(run))
+                else:
+                    words.append(run)
+        else:
+            words = _jieba_cut(text)
+    else:
+        # 对英文文本使用正则表达式
+        words = _WORD_RE.findall(text)
+    return tuple(word for word in words if len(word) >= 2 and word.lower() not in STOPWORDS)
+
 class DocumentProcessor:
     """文档处理类"""
   
@@ -33,27 +86,4 @@ class DocumentProcessor:
         Returns:
             Tokenized文本列表
         """
-        # 对中文文本使用jieba分词
-        if any('\u4e00' <= char <= '\u9fff' for char in text):  # 检测是否包含中文字符
-            words = list(jieba.cut(text))
-        else:
-            # 对英文文本使用正则表达式
-            words = re.findall(r'\b\w+\b', text)
-        
-        # 过滤停用词和短词
-        stopwords = {"的", "了", "和", "是", "在", "有", "与", "为", "以", "及", "对", "上", "中", "下", 
-                    "the", "a", "an", "and", "or", "but", "is", "are", "was", "were", 
-                    "be", "been", "being", "in", "on", "at", "to", "for", "with", "by",
-                    "about", "against", "between", "into", "through", "during", "before",
-                    "after", "above", "below", "from", "up", "down", "of", "off", "over",
-                    "under", "again", "further", "then", "once", "here", "there", "when",
-                    "where", "why", "how", "all", "any", "both", "each", "few", "more",
-                    "most", "other", "some", "such", "no", "nor", "not", "only", "own",
-                    "same", "so", "than", "too", "very", "can", "will", "just", "should",
-                    "now", "d", "ll", "m", "o", "re", "s", "t", "ve", "y", "ain", "aren",
-                    "couldn", "didn", "doesn", "hadn", "hasn", "haven", "isn", "ma",
-                    "mightn", "mustn", "needn", "shan", "shouldn", "wasn", "weren", "won"}
-        
-        words = [word for word in words if len(word) >= 2 and word.lower() not in stopwords]
-        
-        return words
\ No newline at end of file
+        return list(tokenize(text))
\ No newline at end of file
@@ -0,0 +1,156 @@
+import os
+import atexit
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class EmbeddingCache:
+    """
+    Process-wide LRU cache of text embeddings keyed by (model name, sha1 of the text).
+    Optionally persisted to cache_dir as one .npz file per model.
+    """
+    def __init__(self, max_entries=50000, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict() # {(model_name, digest): read-only float32 vector}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def text_digest(text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def get(self, model_name, text):
+        key = (model_name, self.text_digest(text))
+        with self._lock:
+            vec = self._entries.get(key)
+            if vec is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vec
+
+    def put(self, model_name, text, vec):
+        vec = np.array(vec, dtype='float32')
+        vec.setflags(write=False) # shared between all storages, never mutate in place
+        key = (model_name, self.text_digest(text))
+        with self._lock:
+            self._entries[key] = vec
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return vec
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def stats(self):
+        return {"entries": len(self._entries), "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses}
+
+    def _model_file(self, model_name):
+        safe_name = "".join(c if c.isalnum() or c in "-_." else "_" for c in model_name)
+        return os.path.join(self.cache_dir, f"{safe_name}.npz")
+
+    def save(self):
+        if not self.cache_dir:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with self._lock:
+            by_model = {}
+            for (model_name, digest), vec in self._entries.items():
+                by_model.setdefault(model_name, ([], []))
+                by_model[model_name][0].append(digest)
+                by_model[model_name][1].append(vec)
+        for model_name, (digests, vecs) in by_model.items():
+            np.savez(self._model_file(model_name), digests=np.array(digests), vectors=np.stack(vecs))
+        logger.info(f"Saved {len(self._entries)} cached embeddings to {self.cache_dir}")
+
+    def load(self, model_name):
+        if not self.cache_dir or not os.path.exists(self._model_file(model_name)):
+            return 0
+        try:
+            data = np.load(self._model_file(model_name))
+        except Exception as e:
+            logger.warning(f"Failed to load embedding cache for {model_name}: {e}")
+            return 0
+        with self._lock:
+            for digest, vec in zip(data["digests"], data["vectors"]):
+                vec = vec.astype('float32')
+                vec.setflags(write=False)
+                self._entries[(model_name, str(digest))] = vec
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        logger.info(f"Loaded {len(data['digests'])} cached embeddings for {model_name} from {self.cache_dir}")
+        return len(data["digests"])
+
+class CachedEmbedder:
+    """
+    Wraps a SentenceTransformer so that every encode goes through the shared EmbeddingCache.
+    Identical texts are encoded once per process; misses of a batch are encoded in one call.
+    The cache holds default encodings: an encode with options that change the vectors (normalize_embeddings,
+    precision, prompt, ...) goes to the model directly.
+    """
+    CACHE_NEUTRAL_KWARGS = {"batch_size", "show_progress_bar", "device"} # encode options that do not change the vectors
+
+    def __init__(self, model, model_name, cache):
+        self.model = model
+        self.model_name = model_name
+        self.cache = cache
+        self.cache.load(model_name)
+
+    def get_sentence_embedding_dimension(self):
+        return self.model.get_sentence_embedding_dimension()
+
+    def encode(self, sentences, **kwargs):
+        if not set(kwargs) <= self.CACHE_NEUTRAL_KWARGS:
+            return self.model.encode(sentences, **kwargs)
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+
+        results = [None] * len(texts)
+        missing = {} # {text: [indices]}, deduplicates texts within the batch
+        for i, text in enumerate(texts):
+            vec = self.cache.get(self.model_name, text)
+            if vec is None:
+                missing.setdefault(text, []).append(i)
+            else:
+                results[i] = vec
+
+        if missing:
+            encoded = self.model.encode(list(missing.keys()), **kwargs)
+            for (text, indices), vec in zip(missing.items(), encoded):
+                vec = self.cache.put(self.model_name, text, vec)
+                for i in indices:
+                    results[i] = vec
+
+        if single:
+            return results[0]
+        if not results:
+            return np.zeros((0, self.get_sentence_embedding_dimension()), dtype='float32')
+        return np.stack(results)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+# Global embedding cache shared by every MemoryStorage
+_global_embedding_cache = None
+
+def init_embedding_cache(max_entries=50000, cache_dir=None):
+    global _global_embedding_cache
+    _global_embedding_cache = EmbeddingCache(max_entries, cache_dir)
+    if cache_dir:
+        atexit.register(_global_embedding_cache.save)
+    return _global_embedding_cache
+
+def get_embedding_cache():
+    global _global_embedding_cache
+    if _global_embedding_cache is None:
+        init_embedding_cache()
+    return _global_embedding_cache
@@ -0,0 +1,105 @@
+import time
+import queue
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class EmbeddingService:
+    """
+    Runs encodes of an embedder (a CachedEmbedder around the SentenceTransformer) off the event loop.
+
+    aencode() hands the texts to a worker thread and awaits the result, so the loop keeps serving other
+    coroutines (e.g. the characters of av2_plus_react gathered in parallel). Requests arriving within
+    batch_wait_ms of each other are merged into one batched encode call, up to max_batch_size texts.
+    encode() is the plain blocking call for synchronous code; both share one lock on the model.
+    """
+    def __init__(self, embedder, max_batch_size=64, batch_wait_ms=5):
+        self.embedder = embedder
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait_ms / 1000.0
+        self._requests = queue.Queue() # (list of texts, Future)
+        self._model_lock = threading.Lock()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self.batches = 0 # batched encode calls made by the worker
+        self.requests = 0 # aencode requests served by the worker
+
+    def get_sentence_embedding_dimension(self):
+        return self.embedder.get_sentence_embedding_dimension()
+
+    def encode(self, sentences, **kwargs):
+        with self._model_lock:
+            return self.embedder.encode(sentences, **kwargs)
+
+    def submit(self, sentences):
+        """Queues texts for the worker; returns a concurrent.futures.Future of the same result as encode()."""
+        self._ensure_worker()
+        future = Future()
+        single = isinstance(sentences, str)
+        self._requests.put(([sentences] if single else list(sentences), future, single))
+        return future
+
+    async def aencode(self, sentences):
+        return await asyncio.wrap_future(self.submit(sentences))
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="embedding-service", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            batch = [self._requests.get()]
+            size = len(batch[0][0])
+            deadline = time.monotonic() + self.batch_wait
+            # Micro-batching: keep collecting until the wait window closes or the batch is full
+            while size < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request[0])
+            self._encode_batch(batch)
+
+    def _encode_batch(self, batch):
+        texts = [text for texts, _, _ in batch for text in texts]
+        try:
+            embeddings = self.encode(texts) if texts else np.zeros((0, self.get_sentence_embedding_dimension()), dtype='float32')
+        except Exception as e:
+            logger.error(f"[EmbeddingService] Batched encode of {len(texts)} texts failed: {e}")
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.requests += len(batch)
+        start = 0
+        for texts, future, single in batch:
+            result = embeddings[start:start + len(texts)]
+            start += len(texts)
+            future.set_result(result[0] if single else result)
+
+    def __getattr__(self, name):
+        return getattr(self.embedder, name)
+
+# Global embedding service wrapping the shared embedder
+_global_embedding_service = None
+
+def init_embedding_service(embedder, max_batch_size=64, batch_wait_ms=5):
+    global _global_embedding_service
+    _global_embedding_service = EmbeddingService(embedder, max_batch_size, batch_wait_ms)
+    return _global_embedding_service
+
+def get_embedding_service():
+    global _global_embedding_service
+    return _global_embedding_service
@@ -0,0 +1,91 @@
+import re
+import math
+import logging
+import numpy as np
+from memory.document_processor import tokenize
+
+logger = logging.getLogger(__name__)
+
+_SENTENCE_END = re.compile(r"(?<=[.!?。！？…])(?![.!?。！？…])\s*") # after a run of end marks ("...", "?!")
+_WORD = re.compile(r"\w")
+_SPEAKER = re.compile(r"^\s*([^:：\n]{1,30})[:：]")
+REDUNDANCY_THRESHOLD = 0.7 # token overlap (Jaccard) above which a sentence repeats one already picked
+
+def split_sentences(piece_text):
+    """Sentences of a piece. A dialogue line keeps its speaker ("Alice: ...") on every sentence."""
+    sentences = [sentence.strip() for sentence in _SENTENCE_END.split(piece_text.strip()) if _WORD.search(sentence)]
+    speaker = _SPEAKER.match(piece_text)
+    if speaker:
+        sentences = sentences[:1] + [f"{speaker.group(0).strip()} {sentence}" for sentence in sentences[1:]]
+    return sentences
+
+def _normalized(scores):
+    low, high = scores.min(), scores.max()
+    return (scores - low) / (high - low) if high > low else np.ones_like(scores)
+
+def extractive_summary(chunks, sub_storage, ratio=0.3, max_chars=None):
+    """
+    Summary of chunks built from their own sentences, without an LLM.
+
+    Sentences are ranked by centrality within the chunks, from what the sub-storage already computed:
+    - lexical: the BM25 idf of the words a sentence shares with the other sentences (frequent words weigh little)
+    - semantic: cosine between the sentence's vector and the mean vector of the chunks, where a sentence has the
+      vector of its piece ("pooled" strategy) or of the chunks holding it. Only vectors already indexed are read,
+      so nothing is encoded for the summary: sentences of chunks not embedded yet are ranked lexically only
+    The best ones are taken, skipping near repeats, until ratio of the text (or max_chars) is reached, and are
+    returned in their original order.
+    """
+    pieces = list({piece.id: piece for chunk in chunks for piece in chunk.pieces}.values()) # overlap counted once
+    chunks_of_piece = {}
+    for chunk in chunks:
+        for piece in chunk.pieces:
+            chunks_of_piece.setdefault(piece.id, []).append(chunk.id)
+    sentences, sentence_pieces = [], []
+    for piece in pieces:
+        for sentence in split_sentences(piece.text):
+            sentences.append(sentence)
+            sentence_pieces.append(piece)
+    if len(sentences) <= 1:
+        return "\n".join(sentences)
+
+    # Lexical centrality
+    tokens = [set(tokenize(sentence)) for sentence in sentences]
+    sentence_freq = {}
+    for words in tokens:
+        for word in words:
+            sentence_freq[word] = sentence_freq.get(word, 0) + 1
+    idf = {word: sub_storage.bm25.idf(word) or 1.0 for word in sentence_freq} # unseen words count as rare-ish
+    lexical = np.array([sum(idf[word] * (sentence_freq[word] - 1) for word in words) / math.sqrt(len(words)) if words else 0.0
+                        for words in tokens])
+
+    # Semantic centrality
+    chunk_vectors = {chunk.id: sub_storage.get_indexed_vector(chunk.id) for chunk in chunks}
+    chunk_vectors = {chunk_id: vector for chunk_id, vector in chunk_vectors.items() if vector is not None}
+    if chunk_vectors:
+        centroid = np.mean(list(chunk_vectors.values()), axis=0)
+        centroid /= np.linalg.norm(centroid) or 1.0
+        semantic = np.zeros(len(sentences))
+        has_vector = np.zeros(len(sentences), dtype=bool)
+        for i, piece in enumerate(sentence_pieces):
+            vectors = [chunk_vectors[chunk_id] for chunk_id in chunks_of_piece[piece.id] if chunk_id in chunk_vectors]
+            vector = piece.embedding[:len(centroid)] if piece.embedding is not None else np.mean(vectors, axis=0) if vectors else None
+            if vector is not None:
+                semantic[i] = float(vector @ centroid) / (np.linalg.norm(vector) or 1.0)
+                has_vector[i] = True
+        semantic[has_vector] = _normalized(semantic[has_vector])
+        scores = np.where(has_vector, 0.5 * _normalized(lexical) + 0.5 * semantic, _normalized(lexical))
+    else:
+        scores = _normalized(lexical)
+
+    total_chars = sum(len(sentence) for sentence in sentences)
+    target_chars = max_chars if max_chars else max(1, int(total_chars * ratio))
+    picked, picked_chars = [], 0
+    for i in np.argsort(-scores, kind="stable"):
+        if picked and picked_chars + len(sentences[i]) > target_chars:
+            continue # a shorter sentence may still fit
+        if any(len(tokens[i] & tokens[j]) > REDUNDANCY_THRESHOLD * max(1, len(tokens[i] | tokens[j])) for j in picked):
+            continue
+        picked.append(i)
+        picked_chars += len(sentences[i])
+    logger.debug(f"[extractive_summary] Kept {len(picked)} of {len(sentences)} sentences ({picked_chars}/{total_chars} chars).")
+    return "\n".join(sentences[i] for i in sorted(picked))
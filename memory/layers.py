@@ -1,4 +1,5 @@
-from memory.base import BaseMemorySubStorage, IMPORTANCE_ADDITION_WEIGHT, IMPORTANCE_ADDITION_THRESHOLD
+from memory.base import BaseMemorySubStorage, QueryContext, scene_index
+import numpy as np
 from collections import defaultdict
 import logging
 
@@ -13,115 +14,149 @@ class GlobalMemorySubStorage(BaseMemorySubStorage):
         super().__init__(parent_storage, embed_model, dimension, tag_embeddings, chunk_max_pieces, chunk_overlap_pieces)
         self.supported_tags = ["profile", "scene_init", "scene_objective"]
 
-    def retrieve(self, query_text, current_scene_id, top_k, bm25_weight, vector_weight, importance_weight):
+    def retrieve(self, query_text, current_scene_id, top_k, bm25_weight, vector_weight, importance_weight, query_context=None, viewer=None):
         # Global memories don't have scene-specific recency, so pass None for current_scene_id to super
-        final_retrieved_chunks = super().retrieve(query_text, None, top_k, bm25_weight, vector_weight, importance_weight)
-        
-        for chunk_info in final_retrieved_chunks:
-            chunk = chunk_info['chunk']
-            chunk.importance += min(chunk_info['score'], IMPORTANCE_ADDITION_THRESHOLD) * IMPORTANCE_ADDITION_WEIGHT # the retrieved chunks are more important
+        final_retrieved_chunks = super().retrieve(query_text, None, top_k, bm25_weight, vector_weight, importance_weight, query_context, viewer)
+        self._reinforce(final_retrieved_chunks) # the retrieved chunks are more important
         return final_retrieved_chunks
 
 
 class EventMemorySubStorage(BaseMemorySubStorage):
+    candidate_factor = 2 # re-ranked by recency after the hybrid score
+
     def __init__(self, parent_storage, embed_model, dimension, tag_embeddings, chunk_max_pieces, chunk_overlap_pieces):
         super().__init__(parent_storage, embed_model, dimension, tag_embeddings, chunk_max_pieces, chunk_overlap_pieces)
         self.supported_tags = ["conversation", "action", "thought", "archived_conversation", "archived_scene_init", "archived_scene_objective"]
         self.scene_conversation_chunks = defaultdict(list) # Ordered list of conversation chunk IDs per scene
+        self.dialogue_chunk_positions = {} # {chunk_id: (scene_id, index in scene_conversation_chunks[scene_id])}
+
+    def _track_dialogue_chunk(self, piece, new_chunk_id):
+        if new_chunk_id is not None and piece.layer == "conversation":
+            scene_chunk_ids = self.scene_conversation_chunks[piece.scene_id]
+            row = self.scoring_table.row_of.get(new_chunk_id)
+            if row is not None:
+                self.scoring_table.turn_position[row] = len(scene_chunk_ids)
+            self.dialogue_chunk_positions[new_chunk_id] = (piece.scene_id, len(scene_chunk_ids))
+            scene_chunk_ids.append(new_chunk_id)
 
     def add_piece_to_sub_storage(self, piece):
         new_chunk_id = super().add_piece_to_sub_storage(piece)
-        if new_chunk_id is not None and piece.layer == "conversation":
-            self.scene_conversation_chunks[piece.scene_id].append(new_chunk_id)
+        self._track_dialogue_chunk(piece, new_chunk_id)
         return new_chunk_id
 
+    def add_pieces_to_sub_storage(self, pieces):
+        new_chunk_ids = super().add_pieces_to_sub_storage(pieces)
+        for piece, new_chunk_id in zip(pieces, new_chunk_ids):
+            self._track_dialogue_chunk(piece, new_chunk_id)
+        return new_chunk_ids
+
     def add_chunk_to_sub_storage(self, piece):
         new_chunk_id = super().add_chunk_to_sub_storage(piece)
-        if new_chunk_id is not None and piece.layer == "conversation":
-            self.scene_conversation_chunks[piece.scene_id].append(new_chunk_id)
+        self._track_dialogue_chunk(piece, new_chunk_id)
         return new_chunk_id
 
+    def snapshot_state(self):
+        state, vectors = super().snapshot_state()
+        state["scene_conversation_chunks"] = [[scene_id, chunk_ids] for scene_id, chunk_ids in self.scene_conversation_chunks.items()]
+        state["dialogue_chunk_positions"] = [[chunk_id, scene_id, idx] for chunk_id, (scene_id, idx) in self.dialogue_chunk_positions.items()]
+        return state, vectors
+
+    def restore_state(self, state, vectors):
+        super().restore_state(state, vectors)
+        for scene_id, chunk_ids in state.get("scene_conversation_chunks", []):
+            self.scene_conversation_chunks[scene_id] = list(chunk_ids)
+        for chunk_id, scene_id, idx in state.get("dialogue_chunk_positions", []):
+            self.dialogue_chunk_positions[chunk_id] = (scene_id, idx)
+            row = self.scoring_table.row_of.get(chunk_id)
+            if row is not None:
+                self.scoring_table.turn_position[row] = idx
+
     def get_dialogue_turns_ago(self, current_scene_id, chunk_id):
         if current_scene_id not in self.scene_conversation_chunks:
             return 0
         
-        scene_dialogue_chunk_ids = self.scene_conversation_chunks[current_scene_id]
-        try:
-            idx = scene_dialogue_chunk_ids.index(chunk_id)
-            turns_ago = len(scene_dialogue_chunk_ids) - 1 - idx
-            return turns_ago
-        except ValueError:
+        chunk_scene_id, idx = self.dialogue_chunk_positions.get(chunk_id, (None, None))
+        if idx is None or chunk_scene_id != current_scene_id:
             return 0
-
-    def retrieve(self, query_text, current_scene_id, top_k, bm25_weight, vector_weight, importance_weight):
-        raw_results = super().retrieve(query_text, current_scene_id, top_k * 2, bm25_weight, vector_weight, importance_weight) # Get more candidates
-        
-        final_results = []
-        for item in raw_results:
-            chunk = item['chunk']
-            final_score = item['score']
-
-            # Apply inter-scene recency (if applicable for events)
-            if current_scene_id is not None and chunk.scene_id is not None and chunk.scene_id != current_scene_id:
-                try:
-                    scene_diff = abs(current_scene_id - chunk.scene_id)
-                except:
-                    scene_diff = int(current_scene_id.split("scene")[1]) - int(chunk.scene_id.split("scene")[1])                
-                inter_scene_recency_weight = 1.0 / (1 + SCENE_TURN_ALPHA * scene_diff)
-                final_score *= inter_scene_recency_weight
-                logger.info(f"  [EventMemorySubStorage] Inter-scene Recency (diff {scene_diff}): {inter_scene_recency_weight:.2f} -> Score: {final_score:.4f}")
-            
-            # Apply intra-scene dialogue recency specifically for conversation chunks within the current scene
-            if current_scene_id is not None and chunk.scene_id == current_scene_id and \
-               (chunk.layer == "conversation" or chunk.layer.startswith("summary_conversation")): # Also consider summary conversation as related to recency
-                dialogue_turns_ago = self.get_dialogue_turns_ago(current_scene_id, chunk.id)
-                if dialogue_turns_ago > 0: 
-                    intra_scene_dialogue_weight = 1.0 / (1 + DIALOGUE_TRUN_BETA * dialogue_turns_ago)
-                    final_score *= max(0.2, intra_scene_dialogue_weight) 
-                    logger.info(f"  [EventMemorySubStorage] Intra-Scene Recency (Turns ago: {dialogue_turns_ago}): {intra_scene_dialogue_weight:.4f} -> Score: {final_score:.4f}")
-            
-            final_results.append({'score': final_score, 'chunk': chunk})
-        
-        # Re-sort after applying specific weights
-        final_results_sorted = sorted(final_results, key=lambda x: x['score'], reverse=True)[:top_k]
-
-
-        for chunk_info in final_results_sorted:
-            chunk = chunk_info['chunk']
-            chunk.importance += min(chunk_info['score'], IMPORTANCE_ADDITION_THRESHOLD) * IMPORTANCE_ADDITION_WEIGHT # the retrieved chunks are more important
+        turns_ago = len(self.scene_conversation_chunks[current_scene_id]) - 1 - idx
+        return turns_ago
+
+    def _intra_scene_weights(self, rows, current_scene_id):
+        """Dialogue recency inside the current scene: 1 / (1 + beta * turns ago), floored at 0.2."""
+        weights = np.ones(len(rows))
+        if current_scene_id is None or current_scene_id not in self.scene_conversation_chunks:
+            return weights
+        turn_position = self.scoring_table.turn_position[rows]
+        in_current_scene = (self.scoring_table.scene_index[rows] == scene_index(current_scene_id)) & (turn_position >= 0)
+        turns_ago = len(self.scene_conversation_chunks[current_scene_id]) - 1 - turn_position
+        recent = in_current_scene & (turns_ago > 0)
+        weights[recent] = np.maximum(0.2, 1.0 / (1 + DIALOGUE_TRUN_BETA * turns_ago[recent]))
+        return weights
+
+    def retrieve(self, query_text, current_scene_id, top_k, bm25_weight, vector_weight, importance_weight, query_context=None, viewer=None):
+        if query_context is None:
+            query_context = QueryContext(query_text, self.embed_model)
+        scores = self._hybrid_scores(query_context, current_scene_id, top_k * self.candidate_factor, bm25_weight, vector_weight, importance_weight, viewer)
+        rows = self._top_indices(scores, top_k * self.candidate_factor) # Get more candidates
+
+        # Apply inter-scene recency (if applicable for events) and intra-scene dialogue recency
+        # for conversation chunks within the current scene, then re-rank the candidates
+        final_scores = scores[rows] * self._inter_scene_weights(rows, current_scene_id, SCENE_TURN_ALPHA) \
+                                    * self._intra_scene_weights(rows, current_scene_id)
+        order = self._top_indices(final_scores, top_k)
+        final_results_sorted = self._results_for_rows(rows[order], final_scores[order])
+
+        self._reinforce(final_results_sorted) # the retrieved chunks are more important
         return final_results_sorted
 
 class SummaryMemorySubStorage(BaseMemorySubStorage):
+    candidate_factor = 2 # re-ranked by recency after the hybrid score
+
     def __init__(self, parent_storage, embed_model, dimension, tag_embeddings, chunk_max_pieces, chunk_overlap_pieces):
         super().__init__(parent_storage, embed_model, dimension, tag_embeddings, chunk_max_pieces, chunk_overlap_pieces)
         self.supported_tags = ["summary_conversation", "summary_scene_init", "summary_scene_objective"]
 
-    def retrieve(self, query_text, current_scene_id, top_k, bm25_weight, vector_weight, importance_weight):
+    def retrieve(self, query_text, current_scene_id, top_k, bm25_weight, vector_weight, importance_weight, query_context=None, viewer=None):
         # Summary memories might also benefit from inter-scene recency if they are scene-specific
-        raw_results = super().retrieve(query_text, current_scene_id, top_k * 2, bm25_weight, vector_weight, importance_weight)
-        
-        final_results = []
-        for item in raw_results:
-            chunk = item['chunk']
-            final_score = item['score']
-
-            if current_scene_id is not None and chunk.scene_id is not None and chunk.scene_id != current_scene_id:
-                try:
-                    scene_diff = abs(current_scene_id - chunk.scene_id)
-                except:
-                    scene_diff = int(current_scene_id.split("scene")[1]) - int(chunk.scene_id.split("scene")[1])                
-                inter_scene_recency_weight = 1.0 / (1 + SCENE_TURN_ALPHA * scene_diff)
-                final_score *= inter_scene_recency_weight
-                logger.info(f"  [SummaryMemorySubStorage] Inter-scene Recency (diff {scene_diff}): {inter_scene_recency_weight:.2f} -> Score: {final_score:.4f}")
-            
-            final_results.append({'score': final_score, 'chunk': chunk})
-        
-        final_results_sorted = sorted(final_results, key=lambda x: x['score'], reverse=True)[:top_k]
-
-        for chunk_info in final_results_sorted:
-            chunk = chunk_info['chunk']
-            chunk.importance += min(chunk_info['score'], IMPORTANCE_ADDITION_THRESHOLD) * IMPORTANCE_ADDITION_WEIGHT # the retrieved chunks are more important
-        return final_results_sorted
+        if query_context is None:
+            query_context = QueryContext(query_text, self.embed_model)
+        scores = self._hybrid_scores(query_context, current_scene_id, top_k * self.candidate_factor, bm25_weight, vector_weight, importance_weight, viewer)
+        rows = self._top_indices(scores, top_k * self.candidate_factor)
+
+        final_scores = scores[rows] * self._inter_scene_weights(rows, current_scene_id, SCENE_TURN_ALPHA)
+        order = self._top_indices(final_scores, top_k)
+        final_results_sorted = self._results_for_rows(rows[order], final_scores[order])
+
+        self._reinforce(final_results_sorted) # the retrieved chunks are more important
+        return self._descend(final_results_sorted, query_context)
+
+    def _descend(self, results, query_context):
+        """
+        Hierarchical summaries (see Summarizer.roll_up_summaries): a retrieved roll-up is replaced by its child
+        closest to the query, level by level, as long as that child is closer than its parent, i.e. the query
+        asks for more detail than the coarser summary has. Only the children on the way are compared, and the
+        result keeps the roll-up's score. The children live in the archive storage; only their indexed vectors are
+        compared, so a retrieval never embeds the archive (aretrieve embeds it beforehand, off the event loop).
+        """
+        archive = getattr(self.parent_storage, "archive_storage", None)
+        if archive is None or not any(result['chunk'].metadata.get("child_chunk_ids") for result in results):
+            return results
+        query = np.asarray(query_context.embedding, dtype='float32')[:self.vector_store.stored_dimension]
+        def distance(vector):
+            return np.inf if vector is None else float(np.sum((vector[:len(query)] - query[:len(vector)]) ** 2))
+
+        descended = []
+        for result in results:
+            chunk = result['chunk']
+            chunk_distance = distance(self.get_indexed_vector(chunk.id))
+            while chunk.metadata.get("child_chunk_ids"):
+                children = [archive.chunks[child_id] for child_id in chunk.metadata["child_chunk_ids"] if child_id in archive.chunks]
+                best = min(((distance(archive.get_indexed_vector(child.id)), child) for child in children), key=lambda pair: pair[0], default=None)
+                if best is None or best[0] >= chunk_distance:
+                    break
+                chunk_distance, chunk = best
+            descended.append({'score': result['score'], 'chunk': chunk})
+        return descended
 
 class ArchiveMemorySubStorage(BaseMemorySubStorage):
     def __init__(self, parent_storage, embed_model, dimension, tag_embeddings, chunk_max_pieces, chunk_overlap_pieces):
@@ -132,11 +167,9 @@ class ArchiveMemorySubStorage(BaseMemorySubStorage):
             "archived_scene_init", "archived_scene_objective" # If you ever archive these types
         ]
     
-    def retrieve(self, query_text, current_scene_id, top_k, bm25_weight, vector_weight, importance_weight):
+    def retrieve(self, query_text, current_scene_id, top_k, bm25_weight, vector_weight, importance_weight, query_context=None, viewer=None):
         # Archival memories typically have low recency, so a flat retrieval might be sufficient.
         # You could add a very low recency penalty here if needed for older archives.
-        final_retrieved_chunks = super().retrieve(query_text, current_scene_id, top_k, bm25_weight, vector_weight, importance_weight)
-        for chunk_info in final_retrieved_chunks:
-            chunk = chunk_info['chunk']
-            chunk.importance += min(chunk_info['score'], IMPORTANCE_ADDITION_THRESHOLD) * IMPORTANCE_ADDITION_WEIGHT # the retrieved chunks are more important
+        final_retrieved_chunks = super().retrieve(query_text, current_scene_id, top_k, bm25_weight, vector_weight, importance_weight, query_context, viewer)
+        self._reinforce(final_retrieved_chunks) # the retrieved chunks are more important
         return final_retrieved_chunks
@@ -1,16 +1,41 @@
 # --- Main Memory Storage (Aggregator) ---
 from memory.layers import GlobalMemorySubStorage, EventMemorySubStorage, SummaryMemorySubStorage, ArchiveMemorySubStorage
-from memory.base import MemoryPiece
-from collections import defaultdict
+from memory.base import MemoryPiece, QueryContext, CHUNK_EMBEDDING_STRATEGIES
+from collections import defaultdict, OrderedDict
 import logging
 from sentence_transformers import SentenceTransformer
 from utils import get_keys
 from memory.base import TAG_WEIGHTS, LAYER_WEIGHTS
 from memory.summarizer import Summarizer
+from memory.embedding_cache import CachedEmbedder, init_embedding_cache
+from memory.summary_cache import get_summary_cache
+from memory.embedding_service import init_embedding_service
 from dotenv import load_dotenv, find_dotenv
 import os   
+import json
+import hashlib
+import numpy as np
 load_dotenv(find_dotenv())
 STORAGE_MODE = bool(os.getenv("STORAGE_MODE") and os.getenv("STORAGE_MODE").lower() in ["true", "1", "t", "y", "yes"])
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE") or 50000)
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR") or None
+EMBEDDING_BATCH_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_WAIT_MS") or 5)
+EMBEDDING_MAX_BATCH_SIZE = int(os.getenv("EMBEDDING_MAX_BATCH_SIZE") or 64)
+VECTOR_PRECISION = os.getenv("VECTOR_PRECISION") or "float32" # float32, float16 or int8
+VECTOR_TRUNCATE_DIM = int(os.getenv("VECTOR_TRUNCATE_DIM") or 0) or None
+VECTOR_ANN_THRESHOLD = int(os.getenv("VECTOR_ANN_THRESHOLD") or 20000) or None # chunks per sub-storage before the IVF index, 0: always exact
+VECTOR_ANN_NPROBE = int(os.getenv("VECTOR_ANN_NPROBE") or 16)
+CHUNK_EMBEDDING = os.getenv("CHUNK_EMBEDDING") or "full" # full or pooled, see MemoryChunk.set_pooled_embeddings
+ROLLING_SUMMARY_CHUNKS = int(os.getenv("ROLLING_SUMMARY_CHUNKS") or 0) # event chunks a scene may hold before its oldest are summarized, 0: only at scene end
+ROLLING_SUMMARY_KEEP = int(os.getenv("ROLLING_SUMMARY_KEEP") or 20) # newest event chunks that stay raw when that happens
+SUMMARY_FANOUT = int(os.getenv("SUMMARY_FANOUT") or 8) # summary chunks per level before they are summarized one level up, 0: never
+SUMMARY_CACHE_SIZE = int(os.getenv("SUMMARY_CACHE_SIZE") or 10000) # summaries kept to skip the LLM for unchanged text, 0 to disable
+SUMMARY_CACHE_DIR = os.getenv("SUMMARY_CACHE_DIR") or None
+SUMMARY_MODE = os.getenv("SUMMARY_MODE") or "llm" # llm, local or hybrid, see memory.summarizer.SUMMARY_MODES
+SUMMARY_LOCAL_RATIO = float(os.getenv("SUMMARY_LOCAL_RATIO") or 0.3) # length of a local summary relative to its source text
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE") or 256) # recent queries whose encoding and scores are reused, 0 to disable
+SUMMARY_VERBATIM_CHARS = int(os.getenv("SUMMARY_VERBATIM_CHARS") or 300) # a scene's leftover lines only some characters saw, shorter than this, are their own summary, 0: always summarize
+SNAPSHOT_VERSION = 2
 # --- Setup Logging ---
 logger = logging.getLogger(__name__)
 
@@ -20,13 +45,29 @@ class ModelSingleton:
     @staticmethod
     def get_instance(embed_model_name="all-MiniLM-L6-v2"):
         if ModelSingleton._instance is None and STORAGE_MODE:
-            ModelSingleton._instance = SentenceTransformer(embed_model_name)
+            # All storages share one model and one embedding cache, so a line heard by several
+            # characters (and the director's record storage) is only encoded once
+            cache = init_embedding_cache(EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_DIR)
+            embedder = CachedEmbedder(SentenceTransformer(embed_model_name), embed_model_name, cache)
+            # Async callers encode through the service's worker thread, micro-batched, off the event loop
+            ModelSingleton._instance = init_embedding_service(embedder, EMBEDDING_MAX_BATCH_SIZE, EMBEDDING_BATCH_WAIT_MS)
         return ModelSingleton._instance
 
 class MemoryStorage:
-    def __init__(self, embed_model_name="all-MiniLM-L6-v2", chunk_max_pieces=5, chunk_overlap_pieces=1):
+    def __init__(self, embed_model_name="all-MiniLM-L6-v2", chunk_max_pieces=5, chunk_overlap_pieces=1,
+                 vector_precision=VECTOR_PRECISION, vector_truncate_dim=VECTOR_TRUNCATE_DIM,
+                 vector_ann_threshold=VECTOR_ANN_THRESHOLD, vector_ann_nprobe=VECTOR_ANN_NPROBE, chunk_embedding=CHUNK_EMBEDDING,
+                 rolling_summary_chunks=ROLLING_SUMMARY_CHUNKS, rolling_summary_keep=ROLLING_SUMMARY_KEEP, summary_fanout=SUMMARY_FANOUT,
+                 summary_mode=SUMMARY_MODE, summary_local_ratio=SUMMARY_LOCAL_RATIO, summary_verbatim_chars=SUMMARY_VERBATIM_CHARS):
+        if chunk_embedding not in CHUNK_EMBEDDING_STRATEGIES:
+            raise ValueError(f"Unsupported chunk embedding '{chunk_embedding}', expected one of {CHUNK_EMBEDDING_STRATEGIES}.")
         self.embed_model = ModelSingleton.get_instance(embed_model_name)
         self.dimension = self.embed_model.get_sentence_embedding_dimension()
+        self.vector_precision = vector_precision # read by the sub-storages' vector stores
+        self.vector_truncate_dim = vector_truncate_dim
+        self.vector_ann_threshold = vector_ann_threshold
+        self.vector_ann_nprobe = vector_ann_nprobe
+        self.chunk_embedding = chunk_embedding
         self.tag_embeddings = {}
         self._preload_tag_embeddings()
 
@@ -45,8 +86,12 @@ class MemoryStorage:
             "archive": self.archive_storage
         }
 
-        self.summarizer = Summarizer(self)
-        self.retriever = Retriever(self)
+        # The summary cache is shared by all storages, so the scenes summarized again after a reset or a load skip the LLM
+        summary_cache = get_summary_cache(SUMMARY_CACHE_SIZE, SUMMARY_CACHE_DIR) if SUMMARY_CACHE_SIZE else None
+        self.summarizer = Summarizer(self, rolling_max_chunks=rolling_summary_chunks, rolling_keep_chunks=rolling_summary_keep,
+                                     summary_fanout=summary_fanout, summary_cache=summary_cache,
+                                     mode=summary_mode, local_ratio=summary_local_ratio, verbatim_chars=summary_verbatim_chars)
+        self.retriever = Retriever(self, cache_size=RETRIEVAL_CACHE_SIZE)
         # self.tag_to_storage_map = {}
         # for storage_type, sub_storage in self.all_sub_storages.items():
         #     for tag in sub_storage.supported_tags:
@@ -54,6 +99,9 @@ class MemoryStorage:
 
     def reset(self, chunk_max_pieces=5, chunk_overlap_pieces=1):
         logger.info("Resetting memory storage...")
+        self.summarizer.cancel_pending() # summaries of the old records must not land in the new storages
+        for query_context in self.retriever.cache.values():
+            query_context.relevance.clear() # scores of the old sub-storages; the query encodings stay valid
         self.next_piece_id = 0
         self.next_global_chunk_id = 0 # <--- NEW: Global chunk ID counter
         self.global_storage = GlobalMemorySubStorage(self, self.embed_model, self.dimension, self.tag_embeddings, chunk_max_pieces, chunk_overlap_pieces)
@@ -68,6 +116,83 @@ class MemoryStorage:
             "archive": self.archive_storage
         }
 
+    @staticmethod
+    def records_fingerprint(dialogues_record, current_scene_id, visibility=None):
+        """Identifies the load_dialogues_record input a snapshot stands for."""
+        content = json.dumps([dialogues_record, current_scene_id, visibility], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+    def save_snapshot(self, path_prefix, dialogues_record=None, current_scene_id=None, visibility=None):
+        """
+        Writes the whole storage to {path_prefix}.json (chunks, pieces, BM25 tokens, importance, summaries)
+        and {path_prefix}.{sub_storage}.npy (vectors), so load_snapshot can restore it without
+        embedding or summarizing anything. dialogues_record/current_scene_id/visibility are the records this
+        storage holds; load_snapshot only accepts the snapshot for the same records.
+        """
+        os.makedirs(os.path.dirname(path_prefix) or ".", exist_ok=True)
+        snapshot = {
+            "version": SNAPSHOT_VERSION,
+            "fingerprint": self.records_fingerprint(dialogues_record, current_scene_id, visibility),
+            "next_piece_id": self.next_piece_id,
+            "next_global_chunk_id": self.next_global_chunk_id,
+            "chunk_max_pieces": self.global_storage.chunk_max_pieces,
+            "chunk_overlap_pieces": self.global_storage.chunk_overlap_pieces,
+            "dimension": self.dimension,
+            "vector_truncate_dim": self.vector_truncate_dim,
+            "chunk_embedding": self.chunk_embedding,
+            "pending_summaries": list(self.summarizer.pending.keys()),
+            "pending_rolling_summaries": list(self.summarizer.rolling.keys()),
+            "vector_indexes": self.vector_indexes(), # informational, the indexes are rebuilt from the vectors on load
+            "sub_storages": {},
+        }
+        for name, sub_storage in self.all_sub_storages.items():
+            state, vectors = sub_storage.snapshot_state()
+            np.save(f"{path_prefix}.{name}.npy", np.ascontiguousarray(vectors, dtype='float32'))
+            snapshot["sub_storages"][name] = state
+        # The json is written last and atomically: a snapshot without it is never loaded
+        with open(f"{path_prefix}.json.tmp", "w", encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(f"{path_prefix}.json.tmp", f"{path_prefix}.json")
+        logger.info(f"Saved memory snapshot with {len(self.all_chunks())} chunks to {path_prefix}")
+
+    def load_snapshot(self, path_prefix, dialogues_record=None, current_scene_id=None, visibility=None):
+        """
+        Restores a snapshot written by save_snapshot. The vectors are memory-mapped and copied into the
+        vector stores; nothing is embedded or summarized. Returns False (leaving the storage untouched)
+        if there is no usable snapshot for these records, in which case the caller rebuilds with
+        reset() and load_dialogues_record().
+        """
+        if not os.path.exists(f"{path_prefix}.json"):
+            return False
+        try:
+            with open(f"{path_prefix}.json", encoding='utf-8') as f:
+                snapshot = json.load(f)
+            if snapshot.get("version") != SNAPSHOT_VERSION or snapshot.get("dimension") != self.dimension \
+               or snapshot.get("vector_truncate_dim") != self.vector_truncate_dim \
+               or snapshot.get("chunk_embedding", "full") != self.chunk_embedding:
+                logger.info(f"Memory snapshot {path_prefix} is incompatible. Rebuilding instead.")
+                return False
+            if snapshot["fingerprint"] != self.records_fingerprint(dialogues_record, current_scene_id, visibility):
+                logger.info(f"Memory snapshot {path_prefix} does not match the records. Rebuilding instead.")
+                return False
+            vectors = {name: np.load(f"{path_prefix}.{name}.npy", mmap_mode='r') for name in snapshot["sub_storages"]}
+        except Exception as e:
+            logger.warning(f"Failed to read memory snapshot {path_prefix}: {e}")
+            return False
+
+        self.reset(snapshot["chunk_max_pieces"], snapshot["chunk_overlap_pieces"])
+        self.next_piece_id = snapshot["next_piece_id"]
+        self.next_global_chunk_id = snapshot["next_global_chunk_id"]
+        for name, state in snapshot["sub_storages"].items():
+            self.all_sub_storages[name].restore_state(state, vectors[name])
+        # Summaries still running in the background when the snapshot was taken are redone
+        for scene_id in snapshot.get("pending_summaries", []):
+            self.summarizer.summarize_scene_events_in_background(scene_id)
+        for scene_id in snapshot.get("pending_rolling_summaries", []):
+            self.summarizer.roll_scene_events(scene_id)
+        logger.info(f"Loaded memory snapshot with {len(self.all_chunks())} chunks from {path_prefix}")
+        return True
+
     def _get_next_global_chunk_id(self): # <--- NEW method
         new_id = self.next_global_chunk_id
         self.next_global_chunk_id += 1
@@ -86,44 +211,83 @@ class MemoryStorage:
         
         return self.all_sub_storages[layer]
 
-    def load_dialogues_record(self, dialogues_record, current_scene_id):
+    def load_dialogues_record(self, dialogues_record, current_scene_id, visibility=None):
         '''
         输入参数：dialogues_record，一个dict，key是scene_id，value是list，list中每个元素是一个str，表示对话记录
         输出：None
         功能：将对话记录加载到memory中，每个对话记录作为一个piece，
         当前场景的对话记录添加到event_storage中，
         对其他场景的对话记录每个场景进行总结summary，将总结添加到summary_storage中，将其他场景的原始对话添加到archive_storage中
+        visibility: optional dict, key是scene_id，value是与对话记录对齐的list，每个元素是看到这条记录的角色列表（None表示所有人）
         '''
         logger.info(f"Loading dialogues record from empty memory storage...The current scene id is {current_scene_id}")
+        visibility = visibility or {}
         for scene_id, dialogues in dialogues_record.items():
-            if scene_id == current_scene_id:
-                for dialogue in dialogues:
-                    self.add_piece(dialogue, "event", tag="conversation", scene_id=scene_id)
-            else:
-                for dialogue in dialogues:
-                    self.add_piece(dialogue, "event", tag="conversation", scene_id=scene_id)
-                self.summarizer.summarize_scene_events(scene_id)
-
-    def add_piece(self, text, layer, tag=None, metadata=None, scene_id=None):
+            scene_visibility = visibility.get(scene_id) or [None] * len(dialogues)
+            # Bulk ingestion: chunk every run of lines seen by the same characters first, then embed and index them once
+            start = 0
+            while start < len(dialogues):
+                end = start + 1
+                while end < len(dialogues) and scene_visibility[end] == scene_visibility[start]:
+                    end += 1
+                self.add_pieces(dialogues[start:end], "event", tag="conversation", scene_id=scene_id, visible_to=scene_visibility[start])
+                start = end
+            if scene_id != current_scene_id:
+                # In the background when an event loop is running; the raw chunks serve retrieval meanwhile
+                self.summarizer.summarize_scene_events_in_background(scene_id)
+
+    def new_piece_id(self):
+        """Allocates the ID of a piece, e.g. for a caller that needs it before add_piece(piece_id=...)."""
         piece_id = self.next_piece_id
         self.next_piece_id += 1
+        return piece_id
+
+    def add_piece(self, text, layer, tag=None, metadata=None, scene_id=None, visible_to=None, piece_id=None):
+        """
+        visible_to: the characters who saw the piece (None: everyone), see retrieve(viewer=...).
+        piece_id: an ID from new_piece_id (None: a new one).
+        """
+        if piece_id is None:
+            piece_id = self.new_piece_id()
         
-        piece = MemoryPiece(piece_id, text, layer, tag, metadata, layer_id=None, scene_id=scene_id)
+        piece = MemoryPiece(piece_id, text, layer, tag, metadata, layer_id=None, scene_id=scene_id, visible_to=visible_to)
         
         sub_storage = self._get_sub_storage_for_layer(layer)
         added_piece = sub_storage.add_piece_to_sub_storage(piece)
         logger.info(f"Added piece {piece_id} to {layer} storage, the added piece is {added_piece}")
+        if layer == "event":
+            self.summarizer.roll_scene_events(scene_id)
         return added_piece
     
+    def add_pieces(self, texts, layer, tag=None, metadata=None, scene_id=None, visible_to=None):
+        """
+        Adds several pieces of the same layer/tag/scene at once.
+        Chunks are the same as calling add_piece for each text, but embedding and indexing are batched.
+        Returns a list with the new chunk ID opened by each piece, or None.
+        """
+        pieces = []
+        for text in texts:
+            pieces.append(MemoryPiece(self.next_piece_id, text, layer, tag, metadata, layer_id=None, scene_id=scene_id, visible_to=visible_to))
+            self.next_piece_id += 1
+        if not pieces:
+            return []
+
+        sub_storage = self._get_sub_storage_for_layer(layer)
+        added_pieces = sub_storage.add_pieces_to_sub_storage(pieces)
+        logger.info(f"Added pieces {pieces[0].id}-{pieces[-1].id} to {layer} storage, the new chunks are {[c for c in added_pieces if c is not None]}")
+        if layer == "event":
+            self.summarizer.roll_scene_events(scene_id)
+        return added_pieces
+
     def delete_piece(self, piece_id, text=None):
         pass
     #TODO: Withdrawal is not available by delete_piece for memory storage now.
 
-    def add_chunk(self, text, layer, tag=None, metadata=None, scene_id=None):
+    def add_chunk(self, text, layer, tag=None, metadata=None, scene_id=None, visible_to=None):
         piece_id = self.next_piece_id
         self.next_piece_id += 1
         
-        single_piece = MemoryPiece(piece_id, text, layer, tag, metadata, layer_id=None, scene_id=scene_id)
+        single_piece = MemoryPiece(piece_id, text, layer, tag, metadata, layer_id=None, scene_id=scene_id, visible_to=visible_to)
         
         sub_storage = self._get_sub_storage_for_layer(layer)
         return sub_storage.add_chunk_to_sub_storage(single_piece)
@@ -135,13 +299,26 @@ class MemoryStorage:
             all_chunks.update(sub_storage.chunks)
         return list(all_chunks.values())
     
-    def all_chunks_values(self):
-        """Returns all chunks from all sub-storages for inspection."""
+    def all_chunks_values(self, viewer=None):
+        """Returns all chunks from all sub-storages for inspection (only those visible to viewer, if given)."""
         all_chunks = {}
         for sub_storage in self.all_sub_storages.values():
             all_chunks.update(sub_storage.chunks)
-        return [chunk.state for chunk in list(all_chunks.values())]
+        return [chunk.state for chunk in list(all_chunks.values())
+                if viewer is None or chunk.visible_to is None or viewer in chunk.visible_to]
     
+    def flush_embeddings(self):
+        """Embeds the chunks changed since their last embedding, in every sub-storage. Searches and snapshots do this themselves."""
+        return sum(sub_storage.flush_embeddings() for sub_storage in self.all_sub_storages.values())
+
+    def vector_footprint(self):
+        """Bytes held by the vector stores, per sub-storage."""
+        return {name: sub_storage.vector_store.nbytes for name, sub_storage in self.all_sub_storages.items()}
+
+    def vector_indexes(self):
+        """Search index of every sub-storage: exact "flat", or "ivf" once it outgrew vector_ann_threshold."""
+        return {name: sub_storage.vector_store.index_info for name, sub_storage in self.all_sub_storages.items()}
+
     def get_chunk(self, chunk_id):
         """Attempts to get a chunk by ID from any sub-storage."""
         for sub_storage in self.all_sub_storages.values():
@@ -150,33 +327,136 @@ class MemoryStorage:
                 return chunk
         return None
     
-    def retrieve(self, input_text: str, desired_sub_storages: list[str], current_scene_id=None):
+    @property
+    def recall_layers(self):
+        """Sub-storages to retrieve the event lines from: with rolling summaries, the old lines of the current scene are only in the summary one."""
+        return ["event", "summary"] if self.summarizer.rolling_max_chunks else ["event"]
+
+    def retrieve(self, input_text: str, desired_sub_storages: list[str], current_scene_id=None, viewer=None):
         """
         Retrieve memories from multiple sub-storages.
         input_text: the query text
         desired_sub_storages: a list of sub-storage names to retrieve from
         current_scene_id: the current scene id
+        viewer: a character id to retrieve only what that character saw (None: everything)
 
         Returns a list of {'score': score, 'chunk': chunk} dicts.
         """
         logger.info(f"Retrieving memories from memory storage...The current scene id is {current_scene_id}, the desired sub-storages are {desired_sub_storages}")
-        return self.retriever.retrieve_layered(input_text, desired_sub_storages, current_scene_id)
+        return self.retriever.retrieve_layered(input_text, desired_sub_storages, current_scene_id, viewer=viewer)
+
+    def retrieve_many(self, input_texts: list[str], desired_sub_storages: list[str], current_scene_id=None, viewers=None, embeddings=None):
+        """
+        retrieve for several queries at once: the queries are encoded in one batch and every sub-storage
+        searches them with one multi-row vector search. Results are the same as calling retrieve per query.
+        viewers: optional list aligned with input_texts (see retrieve)
+        embeddings: optional {query text: embedding} already encoded by the caller (see retrieve_many below)
+
+        Returns one {sub-storage name: [{'score': score, 'chunk': chunk}, ...]} dict per query.
+        """
+        logger.info(f"Retrieving {len(input_texts)} queries from memory storage...The current scene id is {current_scene_id}, the desired sub-storages are {desired_sub_storages}")
+        return self.retriever.retrieve_layered_many(input_texts, desired_sub_storages, current_scene_id, viewers, embeddings)
+
+    async def aretrieve(self, input_text: str, desired_sub_storages: list[str], current_scene_id=None, viewer=None):
+        """Async version of retrieve: the query is encoded off the event loop."""
+        logger.info(f"Retrieving memories from memory storage...The current scene id is {current_scene_id}, the desired sub-storages are {desired_sub_storages}")
+        return await self.retriever.aretrieve_layered(input_text, desired_sub_storages, current_scene_id, viewer=viewer)
 
-    def summarize(self, scene_id, summary_tag="summary_conversation"):
+    def summarize(self, scene_id, summary_tag="summary_conversation", background=False):
         """
         Summarize memories from multiple sub-storages.
+        background: schedule the summarization on the running event loop and return at once.
+        Returns the asyncio.Task of the scene's summarization still running in the background, if any.
         """
         logger.info(f"Summarizing memories from memory storage...The scene id is {scene_id}")
+        if background:
+            return self.summarizer.summarize_scene_events_in_background(scene_id, summary_tag=summary_tag)
         return self.summarizer.summarize_scene_events(scene_id, summary_tag=summary_tag)
 
+def retrieve_many(requests, desired_sub_storages: list[str], current_scene_id=None):
+    """
+    Batched retrieval across storages, e.g. the memories of every character in a scene.
+    requests: list of (storage, query) or (storage, query, viewer) tuples.
+    The queries of all storages sharing an embedding model are encoded in one batch, and each storage
+    answers its queries with MemoryStorage.retrieve_many. Returns one result dict per request, in order.
+    """
+    requests = [(request[0], request[1], request[2] if len(request) > 2 else None) for request in requests]
+    by_storage = {} # {id(storage): (storage, [request index, ...])}
+    for i, (storage, _, _) in enumerate(requests):
+        by_storage.setdefault(id(storage), (storage, []))[1].append(i)
+
+    to_encode = {} # {id(embed_model): (embed_model, {query text: None})}
+    for storage, indices in by_storage.values():
+        texts = storage.retriever.uncached([requests[i][1] for i in indices])
+        to_encode.setdefault(id(storage.embed_model), (storage.embed_model, {}))[1].update(dict.fromkeys(texts))
+    embeddings = {model_id: dict(zip(texts, embed_model.encode(list(texts)))) if texts else {}
+                  for model_id, (embed_model, texts) in to_encode.items()}
+
+    results = [None] * len(requests)
+    for storage, indices in by_storage.values():
+        found = storage.retrieve_many([requests[i][1] for i in indices], desired_sub_storages, current_scene_id,
+                                      [requests[i][2] for i in indices], embeddings.get(id(storage.embed_model)))
+        for i, result in zip(indices, found):
+            results[i] = result
+    return results
+
 # --- Retriever Class (modified to use sub-storages) ---
 class Retriever:
-    def __init__(self, storage, top_k=5, bm25_weight=0.3, vector_weight=0.5, importance_weight=0.2):
+    def __init__(self, storage, top_k=5, bm25_weight=0.3, vector_weight=0.5, importance_weight=0.2, cache_size=256):
         self.storage = storage # This is now the main MemoryStorage aggregating sub-storages
         self.top_k = top_k
         self.bm25_weight = bm25_weight
         self.vector_weight = vector_weight
         self.importance_weight = importance_weight
+        # LRU of QueryContexts by query text. A repeated query is not encoded again, and every sub-storage that
+        # has not changed since (same version) reuses its BM25 + vector scores; importance, recency and the
+        # top-k selection are recomputed each time, so results and importance updates are the same as uncached.
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    @staticmethod
+    def _desired_names(desired_sub_storages):
+        if not desired_sub_storages or not isinstance(desired_sub_storages, list):
+            return ["event"]
+        return desired_sub_storages
+
+    def _cached_query_context(self, input_text):
+        if not self.cache_size or input_text not in self.cache:
+            self.cache_misses += 1
+            return None
+        self.cache_hits += 1
+        self.cache.move_to_end(input_text)
+        return self.cache[input_text]
+
+    def uncached(self, input_texts):
+        """The distinct input_texts without a cached QueryContext, i.e. the ones a retrieval would encode."""
+        return [text for text in dict.fromkeys(input_texts) if not self.cache_size or text not in self.cache]
+
+    def query_contexts(self, input_texts, embeddings=None):
+        """
+        QueryContexts of input_texts, from the cache where possible. The others take their embedding from
+        embeddings ({text: embedding}) if given there, and are otherwise encoded together in one batch.
+        """
+        contexts = {text: self._cached_query_context(text) for text in dict.fromkeys(input_texts)}
+        embeddings = dict(embeddings or {})
+        to_encode = [text for text, context in contexts.items() if context is None and text not in embeddings]
+        if to_encode:
+            embeddings.update(zip(to_encode, self.storage.embed_model.encode(to_encode)))
+        for text, context in contexts.items():
+            if context is None:
+                contexts[text] = self._cache_query_context(QueryContext(text, self.storage.embed_model, embeddings[text]))
+        return [contexts[text] for text in input_texts]
+
+    def _cache_query_context(self, query_context):
+        if not self.cache_size:
+            return query_context
+        self.cache[query_context.text] = query_context
+        self.cache.move_to_end(query_context.text)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return query_context
 
     # def retrieve_layered_draft(self, input_text, current_scene_id=None, desired_layers=None):
     #     if desired_layers is None:
@@ -251,20 +531,50 @@ class Retriever:
     #             logger.info(f"   No memories retrieved for layer '{layer}'.")
 
     #     return final_layered_results
-    def retrieve_layered(self, input_text: str, desired_sub_storages: list[str] = None, current_scene_id=None):
+    async def aretrieve_layered(self, input_text: str, desired_sub_storages: list[str] = None, current_scene_id=None, viewer=None):
+        """Async version of retrieve_layered: only the query encode is awaited, scoring is synchronous NumPy."""
+        query_context = self._cached_query_context(input_text) or \
+            self._cache_query_context(await QueryContext.acreate(input_text, self.storage.embed_model))
+        # The chunks changed since the last retrieval are embedded off the event loop as well,
+        # including the archived children summary retrieval descends to (see SummaryMemorySubStorage._descend)
+        names = self._desired_names(desired_sub_storages)
+        for sub_storage_name in names + (["archive"] if "summary" in names and "archive" not in names else []):
+            await self.storage.all_sub_storages[sub_storage_name].aflush_embeddings()
+        return self.retrieve_layered(input_text, desired_sub_storages, current_scene_id, query_context=query_context, viewer=viewer)
+
+    def retrieve_layered_many(self, input_texts: list[str], desired_sub_storages: list[str] = None, current_scene_id=None, viewers=None, embeddings=None):
+        """
+        retrieve_layered for several queries (with their viewers): one batched encode, then one multi-row vector
+        search per sub-storage for all of them. Ranking, importance updates and results stay per query, in order.
+        """
+        viewers = viewers or [None] * len(input_texts)
+        query_contexts = self.query_contexts(input_texts, embeddings)
+        for sub_storage_name in self._desired_names(desired_sub_storages):
+            sub_storage = self.storage.all_sub_storages[sub_storage_name]
+            sub_storage.prefetch_relevance(list(zip(query_contexts, viewers)), self.top_k * sub_storage.candidate_factor,
+                                           self.bm25_weight, self.vector_weight)
+        return [self.retrieve_layered(query_context.text, desired_sub_storages, current_scene_id, query_context=query_context, viewer=viewer)
+                for query_context, viewer in zip(query_contexts, viewers)]
+
+    def retrieve_layered(self, input_text: str, desired_sub_storages: list[str] = None, current_scene_id=None, query_context=None, viewer=None):
         """
         Retrieve memories from multiple sub-storages.
         input_text: the query text
         desired_sub_storages: a list of sub-storage names to retrieve from
         current_scene_id: the current scene id
+        query_context: optional QueryContext of input_text (see aretrieve_layered)
+        viewer: only chunks visible to this character (None: every chunk)
 
         Returns a list of {'score': score, 'chunk': chunk} dicts.
         """
         sub_storage_query_list = []
-        if not desired_sub_storages or not isinstance(desired_sub_storages, list):
-            desired_sub_storages = ["event"]
+        desired_sub_storages = self._desired_names(desired_sub_storages)
         for sub_storage_name in desired_sub_storages:
             sub_storage_query_list.append(self.storage.all_sub_storages[sub_storage_name])
+        # Tokenize and encode the query once for all sub-storages (or reuse it from the cache)
+        if query_context is None:
+            query_context = self._cached_query_context(input_text) or \
+                self._cache_query_context(QueryContext(input_text, self.storage.embed_model))
         # Perform independent retrieval for each relevant sub-storage
         all_results_combined = {}
         for sub_storage in sub_storage_query_list:
@@ -277,7 +587,9 @@ class Retriever:
                 top_k=self.top_k, # Fetch more to allow for final filtering/re-ranking
                 bm25_weight=self.bm25_weight, 
                 vector_weight=self.vector_weight,
-                importance_weight=self.importance_weight
+                importance_weight=self.importance_weight,
+                query_context=query_context,
+                viewer=viewer
             )
             
             # Since sub_storage.retrieve already returns a sorted list of {'score': score, 'chunk': chunk}
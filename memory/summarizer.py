@@ -1,121 +1,484 @@
+import asyncio
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from utils import logger
 from models import get_llm_service
-import numpy as np
-from memory.document_processor import DocumentProcessor
+from memory.extractive_summary import extractive_summary
+
+SUMMARIZED_TAGS = ["conversation", "action", "thought"]
+ROLLUP_TAG = "summary_rollup" # summaries of summaries, see roll_up_summaries
+# llm: the LLM writes every summary; local: extractive summaries only (no LLM call);
+# hybrid: extractive summaries at once, replaced by the LLM's in the background (llm without a running event loop)
+SUMMARY_MODES = ("llm", "local", "hybrid")
+
+def summary_level(chunk):
+    """1 for scene summaries, n + 1 for the roll-up of level n summaries."""
+    return chunk.metadata.get("summary_level", 1)
+
+def _current_task():
+    try:
+        return asyncio.current_task()
+    except RuntimeError:
+        return None
 
 class Summarizer:
-    def __init__(self, memory_storage, summary_chunk_size=5):
+    def __init__(self, memory_storage, summary_chunk_size=5, max_parallel_summaries=8, rolling_max_chunks=None, rolling_keep_chunks=None,
+                 summary_fanout=None, summary_cache=None, mode="llm", local_ratio=0.3, verbatim_chars=None):
+        if mode not in SUMMARY_MODES:
+            raise ValueError(f"Unsupported summary mode '{mode}', expected one of {SUMMARY_MODES}.")
         self.memory_storage = memory_storage
         self.summary_chunk_size = summary_chunk_size # Number of original event chunks to summarize at once
-        
-    def _generate_summary_text(self, text_to_summarize):
-        """Generates a summary for a given text using a GPT-4o model."""
-        prompt = f"""
+        self.max_parallel_summaries = max_parallel_summaries # Thread count for summaries when no event loop is running
+        self.pending = {} # {scene_id: asyncio.Task} background summarizations not applied yet
+        # Rolling summarization within a scene (see roll_scene_events); None or 0 disables it
+        self.rolling_max_chunks = rolling_max_chunks
+        self.rolling_keep_chunks = (rolling_max_chunks or 0) // 2 if rolling_keep_chunks is None else rolling_keep_chunks
+        self.rolling = {} # {scene_id: asyncio.Task} background rolling summarizations not applied yet
+        self.folding = set() # IDs of the event chunks those are summarizing (and of summary chunks being rolled up)
+        self.summary_fanout = summary_fanout # summary chunks per level before they are rolled up, None or 0: never
+        self.summary_cache = summary_cache # SummaryCache of earlier summaries, None: always ask the LLM
+        self.mode = mode
+        self.local_ratio = local_ratio # length of a local summary relative to its source text
+        self.verbatim_chars = verbatim_chars # per-viewer leftover batches shorter than this are their own summary, None or 0: never
+
+    def _summary_prompt(self, text_to_summarize):
+        return f"""
         Summarize the following text:
         {text_to_summarize}
         """
-        return get_llm_service().query(prompt)
+
+    def _generate_summary_text(self, text_to_summarize):
+        """Generates a summary for a given text using a GPT-4o model, or takes it from the summary cache."""
+        prompt = self._summary_prompt(text_to_summarize)
+        summary = self.summary_cache.get(prompt) if self.summary_cache is not None else None
+        if summary is None:
+            summary = get_llm_service().query(prompt)
+            if self.summary_cache is not None:
+                self.summary_cache.put(prompt, summary)
+        return summary
+
+    async def _agenerate_summary_text(self, text_to_summarize):
+        prompt = self._summary_prompt(text_to_summarize)
+        summary = self.summary_cache.get(prompt) if self.summary_cache is not None else None
+        if summary is None:
+            summary = await get_llm_service().aquery(prompt)
+            if self.summary_cache is not None:
+                self.summary_cache.put(prompt, summary)
+        return summary
+
+    def _generate_summary_texts(self, texts):
+        """Summarizes every batch text in parallel threads; results keep the order of texts."""
+        if len(texts) <= 1:
+            return [self._generate_summary_text(text) for text in texts]
+        with ThreadPoolExecutor(max_workers=min(len(texts), self.max_parallel_summaries)) as executor:
+            return list(executor.map(self._generate_summary_text, texts))
+
+    def _cached_summary_texts(self, texts):
+        """The cached LLM summaries of all texts, or None if one is missing."""
+        if self.summary_cache is None:
+            return None
+        summaries = [self.summary_cache.get(self._summary_prompt(text)) for text in texts]
+        return None if None in summaries else summaries
+
+    def _current_mode(self):
+        """The mode to summarize in now: hybrid needs a running event loop for its refinements."""
+        if self.mode != "hybrid":
+            return self.mode
+        try:
+            asyncio.get_running_loop()
+            return "hybrid"
+        except RuntimeError:
+            return "llm"
+
+    def _summarize_locally(self, scene_id, batches, summary_tag, after=None):
+        """
+        local and hybrid modes: applies extractive summaries of the batches at once (LLM summaries cached
+        for exactly these batches are used instead). In hybrid mode, returns the asyncio.Task asking the LLM for
+        the summaries that replace the extractive ones, None otherwise. That task also waits for the task after.
+        """
+        event_storage = self.memory_storage.event_storage
+        mode = self._current_mode()
+        if mode == "hybrid":
+            cached_texts = self._cached_summary_texts(["\n".join([c.text for c in batch]) for batch in batches])
+            if cached_texts is not None:
+                self._apply_summaries(scene_id, event_storage, batches, cached_texts, summary_tag)
+                return asyncio.get_running_loop().create_task(self.aroll_up_summaries())
+        summary_texts = [extractive_summary(batch, event_storage, self.local_ratio) for batch in batches]
+        piece_ids = self._apply_summaries(scene_id, event_storage, batches, summary_texts, summary_tag)
+        if mode != "hybrid":
+            self.roll_up_summaries()
+            return None
+        return asyncio.get_running_loop().create_task(
+            self._arefine_summaries(scene_id, self.memory_storage.summary_storage, batches, piece_ids, after))
+
+    async def _arefine_summaries(self, scene_id, summary_storage, batches, piece_ids, after=None):
+        """hybrid mode: replaces the extractive summaries (pieces piece_ids) of batches by the LLM's."""
+        summary_texts = await asyncio.gather(
+            *(self._agenerate_summary_text("\n".join([c.text for c in batch])) for batch in batches))
+        if self.memory_storage.summary_storage is not summary_storage:
+            logger.info(f"Memory storage was reset while refining the summaries of scene {scene_id}. Dropping them.")
+            return
+        summary_storage.update_piece_texts({piece_id: text for piece_id, text in zip(piece_ids, summary_texts) if text})
+        logger.info(f"Refined {len(piece_ids)} local summaries of scene {scene_id}.")
+        if after is not None:
+            await asyncio.wait([after]) # an earlier refinement this one replaced in pending/rolling
+        await self.aroll_up_summaries()
+
+    def _scene_chunks(self, scene_id):
+        """The scene's active conversation, action and thought chunks in chronological order, minus those a rolling summarization is folding."""
+        return [chunk for chunk in self.memory_storage.event_storage.get_scene_chunks(scene_id, tags=SUMMARIZED_TAGS)
+                if chunk.id not in self.folding]
+
+    def _collect_batches(self, scene_id, chunks=None):
+        """
+        Returns the scene's event chunks (or the given ones) grouped by summary_chunk_size, in chronological order.
+        A batch only holds chunks seen by the same characters, so its summary keeps their visibility.
+        """
+        event_chunks_to_summarize = self._scene_chunks(scene_id) if chunks is None else chunks
+        chunks_by_visibility = {}
+        for chunk in event_chunks_to_summarize:
+            chunks_by_visibility.setdefault(chunk.visible_to, []).append(chunk)
+        return [chunks[i:i + self.summary_chunk_size]
+                for chunks in chunks_by_visibility.values()
+                for i in range(0, len(chunks), self.summary_chunk_size)]
+
+    def _apply_verbatim(self, scene_id, batches, summary_tag):
+        """
+        Grouping by visibility leaves a scene one partial batch per viewer set. Where several viewer sets share the
+        scene, the partial batches of lines only some characters saw (e.g. a character's private context line) are
+        stored as their own summary when shorter than verbatim_chars, rather than costing an LLM call each.
+        Returns the batches left to summarize.
+        """
+        if not self.verbatim_chars or len({batch[0].visible_to for batch in batches}) <= 1:
+            return batches
+        verbatim = [batch for batch in batches
+                    if batch[0].visible_to is not None and len(batch) < self.summary_chunk_size
+                    and len("\n".join([c.text for c in batch])) < self.verbatim_chars]
+        if not verbatim:
+            return batches
+        self._apply_summaries(scene_id, self.memory_storage.event_storage, verbatim,
+                              ["\n".join([c.text for c in batch]) for batch in verbatim], summary_tag)
+        return [batch for batch in batches if all(batch is not kept for kept in verbatim)]
 
     def summarize_scene_events(self, scene_id, summary_tag="summary_conversation"):
         """
         Summarizes events for a given scene_id, stores them in summary_storage,
         and then MOVES the original chunks to archive_storage.
-        
+        The LLM calls of all batches run in parallel; this returns once they are applied.
+        If the scene is already being summarized in the background, nothing is done here and that asyncio.Task is
+        returned: its summaries are only applied once it is done (await it, or wait_pending). A hybrid mode
+        refinement is returned the same way. Returns None otherwise.
+
         Args:
             scene_id (int): The ID of the scene whose events are to be summarized.
             summary_tag (str): The tag to assign to the generated summary chunks.
         """
         logger.info(f"Attempting to summarize and move events for scene ID: {scene_id}")
+        if scene_id in self.pending:
+            logger.warning(f"Scene {scene_id} is already being summarized in the background; its summaries are applied when that task is done.")
+            return self.pending[scene_id]
 
-        event_chunks_to_summarize = []
-        for chunk_id, chunk in self.memory_storage.event_storage.chunks.items():
-            # Only consider active conversation, action, thought chunks for summarization
-            if chunk.scene_id == scene_id and \
-               chunk.tag in ["conversation", "action", "thought"]:
-                event_chunks_to_summarize.append(chunk)
-        
-        if not event_chunks_to_summarize:
+        batches = self._apply_verbatim(scene_id, self._collect_batches(scene_id), summary_tag)
+        if not batches:
             logger.info(f"No active event chunks found for scene ID: {scene_id}. Skipping summarization.")
-            return
+            return None
+
+        if self._current_mode() != "llm":
+            return self._track_background(scene_id, self._summarize_locally(scene_id, batches, summary_tag))
+        event_storage = self.memory_storage.event_storage
+        summary_texts = self._generate_summary_texts(["\n".join([c.text for c in batch]) for batch in batches])
+        self._apply_summaries(scene_id, event_storage, batches, summary_texts, summary_tag)
+        self.roll_up_summaries()
+        return None
+
+    async def _asummarize_batches(self, scene_id, event_storage, batches, summary_tag):
+        summary_texts = await asyncio.gather(
+            *(self._agenerate_summary_text("\n".join([c.text for c in batch])) for batch in batches))
+        self._apply_summaries(scene_id, event_storage, batches, summary_texts, summary_tag)
+        await self.aroll_up_summaries()
+
+    def summarize_scene_events_in_background(self, scene_id, summary_tag="summary_conversation"):
+        """
+        Schedules the summarization of a scene on the running event loop and returns immediately.
+        The chunks to summarize are fixed now; until the summaries arrive they stay in the event storage,
+        so retrieval keeps using the raw event chunks. Without a running loop this is summarize_scene_events.
+        Returns the asyncio.Task, or None if nothing was scheduled.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.summarize_scene_events(scene_id, summary_tag)
+            return None
+
+        if scene_id in self.pending:
+            logger.info(f"Scene {scene_id} is already being summarized in the background. Skipping.")
+            return self.pending[scene_id]
+        batches = self._apply_verbatim(scene_id, self._collect_batches(scene_id), summary_tag)
+        if not batches:
+            logger.info(f"No active event chunks found for scene ID: {scene_id}. Skipping summarization.")
+            return None
+        if self._current_mode() != "llm":
+            return self._track_background(scene_id, self._summarize_locally(scene_id, batches, summary_tag))
 
-        # Sort chunks by their global ID to ensure chronological order
-        event_chunks_to_summarize.sort(key=lambda c: c.id)
+        logger.info(f"Summarizing {len(batches)} batches of scene {scene_id} in the background.")
+        task = loop.create_task(self._asummarize_batches(scene_id, self.memory_storage.event_storage, batches, summary_tag))
+        return self._track_background(scene_id, task)
+
+    def _track_background(self, scene_id, task):
+        """Registers a background summarization (or refinement) of a scene in pending. Returns the task."""
+        if task is not None:
+            self.pending[scene_id] = task
+            task.add_done_callback(lambda t: self._on_background_done(scene_id, t))
+        return task
+
+    def _rolling_chunks(self, scene_id):
+        """
+        The chunks a rolling summarization folds now: once the scene holds more than rolling_max_chunks event
+        chunks, all of them but the newest rolling_keep_chunks and the open ones (still receiving pieces).
+        """
+        chunks = self._scene_chunks(scene_id)
+        if len(chunks) <= self.rolling_max_chunks:
+            return []
+        event_storage = self.memory_storage.event_storage
+        open_ids = {stream.open_chunk_id for stream in event_storage.streams.values()}
+        return [chunk for chunk in chunks[:len(chunks) - self.rolling_keep_chunks] if chunk.id not in open_ids]
+
+    def roll_scene_events(self, scene_id, summary_tag="summary_conversation"):
+        """
+        Rolling summarization, checked whenever events are added: folds the oldest event chunks of a scene
+        that grew past rolling_max_chunks into summaries and archives them, as summarize_scene_events does
+        for a whole scene, so the event layer stays bounded during very long scenes.
+        LLM summaries run in the background on the running event loop. Without one nothing is rolled, since
+        add_piece must not wait for the LLM: the chunks are summarized with the rest of the scene when it ends.
+        Returns the asyncio.Task, or None if nothing was scheduled.
+        """
+        if not self.rolling_max_chunks or scene_id in self.pending:
+            return None
+        mode = self._current_mode()
+        if mode == "llm":
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return None
+        # Local summaries are applied at once, so in hybrid mode only the refinements pile up
+        if scene_id in self.rolling and mode != "hybrid":
+            return None
+        chunks = self._rolling_chunks(scene_id)
+        if not chunks:
+            return None
+        batches = self._apply_verbatim(scene_id, self._collect_batches(scene_id, chunks), summary_tag)
+        if not batches:
+            return None
+        logger.info(f"Rolling summarization of {len(chunks)} event chunks of scene {scene_id} in {len(batches)} batches.")
+        event_storage = self.memory_storage.event_storage
+        if mode != "llm":
+            task = self._summarize_locally(scene_id, batches, summary_tag, after=self.rolling.get(scene_id))
+            if task is not None:
+                self.rolling[scene_id] = task
+                task.add_done_callback(lambda t: self._on_rolling_done(scene_id, set(), t))
+            return task
+
+        chunk_ids = {chunk.id for chunk in chunks}
+        self.folding |= chunk_ids
+        task = loop.create_task(self._asummarize_batches(scene_id, event_storage, batches, summary_tag))
+        self.rolling[scene_id] = task
+        task.add_done_callback(lambda t: self._on_rolling_done(scene_id, chunk_ids, t))
+        return task
+
+    def _on_rolling_done(self, scene_id, chunk_ids, task):
+        if self.rolling.get(scene_id) is task:
+            del self.rolling[scene_id]
+            self.folding -= chunk_ids
+        if task.cancelled():
+            logger.info(f"Rolling summarization of scene {scene_id} was cancelled.")
+        elif task.exception() is not None:
+            logger.error(f"Rolling summarization of scene {scene_id} failed: {task.exception()}")
+
+    def _on_background_done(self, scene_id, task):
+        if self.pending.get(scene_id) is task:
+            del self.pending[scene_id]
+        if task.cancelled():
+            logger.info(f"Background summarization of scene {scene_id} was cancelled.")
+        elif task.exception() is not None:
+            logger.error(f"Background summarization of scene {scene_id} failed: {task.exception()}")
+
+    async def wait_pending(self):
+        """Waits until every background summarization (rolling ones included) has been applied."""
+        while self.pending or self.rolling:
+            await asyncio.gather(*list(self.pending.values()), *list(self.rolling.values()), return_exceptions=True)
+
+    def cancel_pending(self):
+        """Cancels the background summarizations, e.g. when the storage is reset."""
+        for task in list(self.pending.values()) + list(self.rolling.values()):
+            task.cancel()
+        self.pending.clear()
+        self.rolling.clear()
+        self.folding.clear()
+
+    def _apply_summaries(self, scene_id, event_storage, batches, summary_texts, summary_tag):
+        """
+        Stores the summary of every batch in summary_storage and moves the summarized chunks to archive_storage.
+        Returns the IDs of the summary pieces, in the order of batches.
+        """
+        if self.memory_storage.event_storage is not event_storage:
+            logger.info(f"Memory storage was reset while summarizing scene {scene_id}. Dropping the summaries.")
+            return []
 
         chunks_to_move = [] # Collect chunks that were summarized and need moving
+        piece_ids = []
+        for batch_of_chunks, summary_text in zip(batches, summary_texts):
+            logger.debug(f"Summarized batch of {len(batch_of_chunks)} chunks from scene {scene_id} (IDs: {[c.id for c in batch_of_chunks]})")
 
-        # Group chunks by summary_chunk_size and generate summaries
-        for i in range(0, len(event_chunks_to_summarize), self.summary_chunk_size):
-            batch_of_chunks = event_chunks_to_summarize[i:i + self.summary_chunk_size]
-            
-            combined_text = "\n".join([c.text for c in batch_of_chunks])
-            
-            logger.debug(f"Summarizing batch of {len(batch_of_chunks)} chunks from scene {scene_id} (IDs: {[c.id for c in batch_of_chunks]})")
-            
-            summary_text = self._generate_summary_text(combined_text)
-            
             # Add generated summary as a piece to the SummaryMemorySubStorage
             # The add_piece method will handle creating a new chunk in summary_storage
+            piece_id = self.memory_storage.new_piece_id() # kept to refine the summary later (hybrid mode)
+            piece_ids.append(piece_id)
             self.memory_storage.add_piece(
                 text=summary_text,
                 layer="summary",
                 tag=summary_tag,
                 metadata={"source_scene_id": scene_id, "source_chunk_ids": [c.id for c in batch_of_chunks]},
-                scene_id=scene_id 
+                scene_id=scene_id,
+                visible_to=batch_of_chunks[0].visible_to,
+                piece_id=piece_id
             )
             logger.debug(f"Added summary piece for scene {scene_id}: {summary_text[:100]}...")
 
             # Collect chunks that were part of this summary batch for moving
             chunks_to_move.extend(batch_of_chunks)
-        
+
         # --- Moving Original Chunks to Archive ---
-        logger.info(f"Moving {len(chunks_to_move)} original chunks for scene {scene_id} to archive storage.")
-        for original_chunk in chunks_to_move:
-            # 1. Remove from EventMemorySubStorage
-            removed_chunk = self.memory_storage.event_storage.remove_chunk(original_chunk.id)
-            
-            if removed_chunk:
-                # 2. Update its layer and tag to 'archived_'
-                archived_layer = f"archived_{removed_chunk.layer}"
-                archived_tag = f"archived_{removed_chunk.tag}"
-
-                # Ensure these new layers/tags are preloaded in the tag_embeddings
-                if archived_layer not in self.memory_storage.tag_embeddings:
-                    self.memory_storage.tag_embeddings[archived_layer] = \
-                        self.memory_storage.embed_model.encode(archived_layer).astype('float32')
-                if archived_tag not in self.memory_storage.tag_embeddings:
-                    self.memory_storage.tag_embeddings[archived_tag] = \
-                        self.memory_storage.embed_model.encode(archived_tag).astype('float32')
-
-                removed_chunk.layer = archived_layer
-                removed_chunk.tag = archived_tag
-                removed_chunk.set_embedding(self.memory_storage.embed_model, self.memory_storage.tag_embeddings)
-                
-                # 3. Add to ArchiveMemorySubStorage
-                # Note: We're directly adding the modified chunk object.
-                # _create_and_add_new_chunk would create a brand new chunk with a new ID.
-                # If we want to preserve the original chunk ID, we need to adapt _create_and_add_new_chunk
-                # or have a specific method in ArchiveMemorySubStorage to add existing chunks.
-                # For simplicity and preserving ID, we'll adapt BaseMemorySubStorage's internal add.
-                
-                # We need to manually add to archive_storage's internal dicts/indices
-                # This bypasses the normal chunking logic of add_piece/add_chunk
-                archive_storage = self.memory_storage.archive_storage
-                archive_storage.chunks[removed_chunk.id] = removed_chunk
-
-                bm25_doc_text = f"{removed_chunk.layer}:{removed_chunk.text}" 
-                archive_storage.documents_for_bm25.append(DocumentProcessor().tokenize_text(bm25_doc_text))
-                # Update the mapping for BM25 with the new index
-                archive_storage.chunk_id_to_bm25_internal_idx[removed_chunk.id] = len(archive_storage.documents_for_bm25) - 1 
-
-                vec = np.array([removed_chunk.embedding]).astype('float32')
-                archive_storage.faiss_index.add_with_ids(vec, np.array([removed_chunk.id]))
-
-                logger.info(f"Chunk {removed_chunk.id} (Layer: {original_chunk.layer}) moved to {removed_chunk.layer} in ArchiveStorage.")
-            else:
-                logger.warning(f"Failed to remove chunk {original_chunk.id} from EventMemorySubStorage during move operation.")
+        self._move_to_archive(self.memory_storage.event_storage, chunks_to_move)
 
-        # Rebuild BM25 for all affected storages after additions/removals/moves
-        self.memory_storage.summary_storage.build_bm25()
-        self.memory_storage.event_storage.build_bm25() # Event storage's BM25 needs to reflect removals
-        self.memory_storage.archive_storage.build_bm25() # Archive storage's BM25 needs to reflect additions
+        # BM25 indices of the summary, event and archive storages are updated incrementally
+        # by add_piece/remove_chunks/add_existing_chunks, so no rebuild is needed here.
         logger.info(f"Finished summarizing and moving events for scene ID: {scene_id}.")
+        return piece_ids
+
+    def _move_to_archive(self, sub_storage, chunks_to_move):
+        """Moves summarized chunks from sub_storage to archive_storage, as archived_<layer>/archived_<tag>, keeping their IDs."""
+        logger.info(f"Moving {len(chunks_to_move)} original chunks from {type(sub_storage).__name__} to archive storage.")
+        # Chunks already embedded take their vector along, so the archive does not encode them again
+        vectors = {c.id: sub_storage.get_indexed_vector(c.id) for c in chunks_to_move}
+        vectors = {chunk_id: np.array(vector, dtype='float32') for chunk_id, vector in vectors.items() if vector is not None} # rows move on removal
+        # 1. Remove from the sub-storage in one batch
+        removed_chunks = sub_storage.remove_chunks([c.id for c in chunks_to_move])
+        if len(removed_chunks) != len(chunks_to_move):
+            logger.warning(f"Failed to remove {len(chunks_to_move) - len(removed_chunks)} chunks from {type(sub_storage).__name__} during move operation.")
+
+        for removed_chunk in removed_chunks:
+            # 2. Update its layer and tag to 'archived_'
+            archived_layer = f"archived_{removed_chunk.layer}"
+            archived_tag = f"archived_{removed_chunk.tag}"
+
+            # Ensure these new layers/tags are preloaded in the tag_embeddings
+            if archived_layer not in self.memory_storage.tag_embeddings:
+                self.memory_storage.tag_embeddings[archived_layer] = \
+                    self.memory_storage.embed_model.encode(archived_layer).astype('float32')
+            if archived_tag not in self.memory_storage.tag_embeddings:
+                self.memory_storage.tag_embeddings[archived_tag] = \
+                    self.memory_storage.embed_model.encode(archived_tag).astype('float32')
+
+            removed_chunk.layer = archived_layer
+            removed_chunk.tag = archived_tag
+            removed_chunk.embedding = vectors.get(removed_chunk.id)
+
+        # 3. Add to ArchiveMemorySubStorage, preserving the original chunk IDs.
+        # This bypasses the normal chunking logic of add_piece/add_chunk; chunks without a vector are embedded lazily.
+        self.memory_storage.archive_storage.add_existing_chunks(removed_chunks)
+        logger.info(f"Chunks {[c.id for c in removed_chunks]} moved to ArchiveStorage.")
+
+    def _rollup_groups(self):
+        """
+        Summary chunks to roll up now, as (level, chunks) groups of summary_fanout chunks: the oldest chunks of
+        every level (and visibility) that holds more than summary_fanout of them. Scene summaries only count
+        once their scene is finished (no event chunks left, no summarization running other than the calling
+        task, whose summaries are in place already).
+        """
+        if not self.summary_fanout:
+            return []
+        event_storage = self.memory_storage.event_storage
+        current_task = _current_task()
+        finished = {}
+        def is_finished(scene_id):
+            if scene_id not in finished:
+                running = any(task is not None and task is not current_task
+                              for task in (self.pending.get(scene_id), self.rolling.get(scene_id)))
+                finished[scene_id] = not running and not event_storage.get_scene_chunks(scene_id, tags=SUMMARIZED_TAGS)
+            return finished[scene_id]
+
+        levels = {}
+        for chunk_id in sorted(self.memory_storage.summary_storage.chunks):
+            chunk = self.memory_storage.summary_storage.chunks[chunk_id]
+            if chunk_id in self.folding or (summary_level(chunk) == 1 and not is_finished(chunk.scene_id)):
+                continue
+            levels.setdefault((summary_level(chunk), chunk.visible_to), []).append(chunk)
+        groups = []
+        for (level, _), chunks in levels.items():
+            while len(chunks) > self.summary_fanout:
+                groups.append((level, chunks[:self.summary_fanout]))
+                chunks = chunks[self.summary_fanout:]
+        return groups
+
+    def roll_up_summaries(self):
+        """
+        Hierarchical summaries: while a summary level holds more than summary_fanout chunks, its oldest ones are
+        summarized into one chunk of the next level (tag ROLLUP_TAG, metadata summary_level/child_chunk_ids) and
+        moved to archive_storage. The summary layer then holds O(summary_fanout * levels) chunks, and
+        SummaryMemorySubStorage.retrieve descends to the children where they fit the query better.
+        """
+        groups = self._rollup_groups()
+        while groups:
+            summary_storage = self.memory_storage.summary_storage
+            # The children are archived with their vectors, which retrieval compares when it descends
+            summary_storage.flush_embeddings()
+            if self.mode == "local":
+                summary_texts = [extractive_summary(chunks, summary_storage, self.local_ratio) for _, chunks in groups]
+            else:
+                summary_texts = self._generate_summary_texts(["\n".join([c.text for c in chunks]) for _, chunks in groups])
+            self._apply_rollups(summary_storage, groups, summary_texts)
+            groups = self._rollup_groups()
+
+    async def aroll_up_summaries(self):
+        """Async version of roll_up_summaries: the roll-ups of a round are summarized concurrently with aquery."""
+        if self.mode == "local":
+            self.roll_up_summaries()
+            return
+        while self._rollup_groups():
+            summary_storage = self.memory_storage.summary_storage
+            # The children are archived with their vectors (see roll_up_summaries); the groups are taken after
+            # the encode, since another roll-up may have run meanwhile
+            await summary_storage.aflush_embeddings()
+            groups = self._rollup_groups()
+            if not groups:
+                return
+            chunk_ids = {c.id for _, chunks in groups for c in chunks}
+            self.folding |= chunk_ids # not rolled up a second time by a concurrent summarization
+            try:
+                summary_texts = await asyncio.gather(
+                    *(self._agenerate_summary_text("\n".join([c.text for c in chunks])) for _, chunks in groups))
+            finally:
+                self.folding -= chunk_ids
+            if not self._apply_rollups(summary_storage, groups, summary_texts):
+                return
+
+    def _apply_rollups(self, summary_storage, groups, summary_texts):
+        """Adds one next-level summary chunk per group and archives the group. Returns False if the storage was reset meanwhile."""
+        if self.memory_storage.summary_storage is not summary_storage:
+            logger.info("Memory storage was reset while rolling up summaries. Dropping them.")
+            return False
+        chunks_to_move = []
+        for (level, chunks), summary_text in zip(groups, summary_texts):
+            chunks = [c for c in chunks if c.id in summary_storage.chunks]
+            if not chunks:
+                continue
+            # A chunk of its own (no overlap), so every roll-up has exactly its group as children
+            self.memory_storage.add_chunk(
+                summary_text, "summary", tag=ROLLUP_TAG,
+                metadata={"summary_level": level + 1, "child_chunk_ids": [c.id for c in chunks],
+                          "source_scene_ids": list(dict.fromkeys(c.scene_id for c in chunks))},
+                scene_id=chunks[-1].scene_id, visible_to=chunks[0].visible_to)
+            chunks_to_move.extend(chunks)
+        self._move_to_archive(summary_storage, chunks_to_move)
+        logger.info(f"Rolled up {len(chunks_to_move)} summary chunks into {len(groups)} higher level summaries.")
+        return True
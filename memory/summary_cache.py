@@ -0,0 +1,121 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class SummaryCache:
+    """
+    Process-wide LRU cache of summaries keyed by the sha1 of the summary prompt, which holds the instruction
+    and the source chunk texts: an unchanged scene summarized again (after withdraw, back_scene or a load,
+    which all reset and reload the storages) gets its summary back without an LLM call.
+    Optionally persisted to cache_dir/summaries.jsonl, appended on every new summary.
+    """
+    FILE_NAME = "summaries.jsonl"
+
+    def __init__(self, max_entries=10000, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict() # {digest: summary text}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def prompt_digest(prompt):
+        return hashlib.sha1(prompt.encode("utf-8")).hexdigest()
+
+    def get(self, prompt):
+        digest = self.prompt_digest(prompt)
+        with self._lock:
+            summary = self._entries.get(digest)
+            if summary is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return summary
+
+    def put(self, prompt, summary):
+        if not summary: # failed or empty answers are asked again next time
+            return summary
+        digest = self.prompt_digest(prompt)
+        with self._lock:
+            self._entries[digest] = summary
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._append(digest, summary)
+        return summary
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def stats(self):
+        return {"entries": len(self._entries), "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses}
+
+    def _file(self):
+        return os.path.join(self.cache_dir, self.FILE_NAME)
+
+    def _append(self, digest, summary):
+        if not self.cache_dir:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self._file(), "a", encoding="utf-8") as f:
+                f.write(json.dumps({"digest": digest, "summary": summary}, ensure_ascii=False) + "\n")
+        except OSError as e:
+            logger.warning(f"Failed to persist summary to {self.cache_dir}: {e}")
+
+    def load(self):
+        """Loads the persisted summaries, then rewrites the file without the entries the LRU dropped."""
+        if not self.cache_dir or not os.path.exists(self._file()):
+            return 0
+        lines = 0
+        with self._lock:
+            try:
+                with open(self._file(), encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except json.JSONDecodeError: # e.g. a line cut short by a crash
+                            continue
+                        lines += 1
+                        self._entries[entry["digest"]] = entry["summary"]
+                        self._entries.move_to_end(entry["digest"])
+            except OSError as e:
+                logger.warning(f"Failed to load summary cache from {self.cache_dir}: {e}")
+                return 0
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            if lines > len(self._entries):
+                self._compact()
+        logger.info(f"Loaded {len(self._entries)} cached summaries from {self.cache_dir}")
+        return len(self._entries)
+
+    def _compact(self):
+        temp_file = self._file() + ".tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            for digest, summary in self._entries.items():
+                f.write(json.dumps({"digest": digest, "summary": summary}, ensure_ascii=False) + "\n")
+        os.replace(temp_file, self._file())
+
+# Global summary cache shared by every Summarizer
+_global_summary_cache = None
+
+def init_summary_cache(max_entries=10000, cache_dir=None):
+    global _global_summary_cache
+    _global_summary_cache = SummaryCache(max_entries, cache_dir)
+    _global_summary_cache.load()
+    return _global_summary_cache
+
+def get_summary_cache(max_entries=10000, cache_dir=None):
+    """The global summary cache, created with these settings on first use."""
+    global _global_summary_cache
+    if _global_summary_cache is None:
+        init_summary_cache(max_entries, cache_dir)
+    return _global_summary_cache
@@ -0,0 +1,110 @@
+"""
+Footprint and retrieval quality of the vector store settings (precision / truncation), and recall vs latency
+of the approximate IVF index large sub-storages switch to.
+
+    python -m memory.vector_report [script.yaml ...]
+
+Embeds the text of the given scripts (default: every script in script/), holds out every tenth line as a
+query and compares each setting's nearest neighbours with the exact float32 search.
+"""
+import os
+import sys
+import glob
+import logging
+import numpy as np
+from memory.vector_store import VectorStore
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SETTINGS = [
+    {"precision": "float32", "truncate_dim": None},
+    {"precision": "float16", "truncate_dim": None},
+    {"precision": "int8", "truncate_dim": None},
+    {"precision": "float32", "truncate_dim": 256},
+    {"precision": "float16", "truncate_dim": 256},
+    {"precision": "int8", "truncate_dim": 256},
+    {"precision": "int8", "truncate_dim": 128},
+]
+
+def _search_ids(embeddings, queries, top_k, precision="float32", truncate_dim=None):
+    store = VectorStore(embeddings.shape[1], initial_capacity=len(embeddings), precision=precision, truncate_dim=truncate_dim)
+    store.upsert(np.arange(len(embeddings)), embeddings)
+    _, ids = store.search(queries, top_k)
+    return store, ids
+
+def report_vector_settings(embeddings, queries, settings=None, top_k=10):
+    """
+    Returns one dict per setting: bytes per stored vector, total bytes for the corpus, and how well its
+    search agrees with exact float32 search (recall@top_k of the exact neighbours, top-1 agreement).
+    """
+    embeddings = np.asarray(embeddings, dtype='float32')
+    queries = np.asarray(queries, dtype='float32')
+    top_k = min(top_k, len(embeddings))
+    _, exact_ids = _search_ids(embeddings, queries, top_k)
+
+    rows = []
+    for setting in settings or DEFAULT_SETTINGS:
+        if setting["truncate_dim"] and setting["truncate_dim"] >= embeddings.shape[1]:
+            continue
+        store, ids = _search_ids(embeddings, queries, top_k, **setting)
+        recall = np.mean([len(set(found) & set(exact)) / top_k for found, exact in zip(ids, exact_ids)])
+        bytes_per_vector = store.nbytes / store.capacity
+        rows.append({
+            "precision": setting["precision"],
+            "dimension": store.stored_dimension,
+            "bytes_per_vector": bytes_per_vector,
+            "total_bytes": bytes_per_vector * len(embeddings),
+            f"recall@{top_k}": float(recall),
+            "top1_agreement": float(np.mean(ids[:, 0] == exact_ids[:, 0])),
+        })
+    return rows
+
+def report_ann_recall(embeddings, queries, nprobes=(1, 4, 16, 64), top_k=10):
+    """
+    Builds the IVF index over the embeddings (as a store past its ann_threshold would) and returns one
+    VectorStore.recall_check row per nprobe: recall@top_k against the exact search and the latency of both.
+    """
+    embeddings = np.asarray(embeddings, dtype='float32')
+    store = VectorStore(embeddings.shape[1], initial_capacity=len(embeddings), ann_threshold=1)
+    store.upsert(np.arange(len(embeddings)), embeddings)
+    rows = []
+    for nprobe in nprobes:
+        store.ann_index.nprobe = min(nprobe, store.ann_index.nlist)
+        rows.append(store.recall_check(queries, min(top_k, len(embeddings))))
+    return rows
+
+def _script_lines(paths):
+    import yaml
+    lines = []
+    def collect(value):
+        if isinstance(value, str):
+            lines.extend(line.strip() for line in value.splitlines() if len(line.strip()) >= 10)
+        elif isinstance(value, dict):
+            for item in value.values():
+                collect(item)
+        elif isinstance(value, list):
+            for item in value:
+                collect(item)
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            collect(yaml.safe_load(f))
+    return list(dict.fromkeys(lines))
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    from sentence_transformers import SentenceTransformer
+    paths = sys.argv[1:] or sorted(glob.glob(os.path.join("script", "*.yaml")))
+    lines = _script_lines(paths)
+    corpus = [line for i, line in enumerate(lines) if i % 10]
+    queries = [line for i, line in enumerate(lines) if not i % 10]
+    model = SentenceTransformer("all-MiniLM-L6-v2")
+    embeddings = model.encode(corpus)
+    query_embeddings = model.encode(queries)
+    print(f"{len(corpus)} vectors, {len(queries)} queries, dimension {embeddings.shape[1]}")
+    def print_row(row):
+        print("  ".join(f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}" for key, value in row.items()))
+    for row in report_vector_settings(embeddings, query_embeddings):
+        print_row(row)
+    print("IVF index:")
+    for row in report_ann_recall(embeddings, query_embeddings):
+        print_row(row)
@@ -0,0 +1,288 @@
+import time
+import logging
+import numpy as np
+import faiss
+
+logger = logging.getLogger(__name__)
+
+VECTOR_PRECISIONS = ("float32", "float16", "int8")
+ANN_RETRAIN_FACTOR = 4 # retrain the IVF index once the store has grown this much since the last training
+ANN_MIN_POINTS_PER_LIST = 39 # faiss wants about this many training points per IVF list
+ANN_MAX_POINTS_PER_LIST = 256 # and uses at most this many, so the training sample is bounded
+SEARCH_BLOCK_ROWS = 16384 # rows dequantized at once by an exact search (or an index build) of a float16/int8 store
+# IVF list encoding per precision: the index stores its vectors as compactly as the matrix does
+ANN_SCALAR_QUANTIZERS = {"float16": faiss.ScalarQuantizer.QT_fp16, "int8": faiss.ScalarQuantizer.QT_8bit}
+
+class VectorStore:
+    """
+    Exact L2 vector store with in-place updates.
+
+    Vectors live in a preallocated matrix with a chunk_id -> row map. Updating the open chunk
+    overwrites its row, a removal moves the last row into the freed slot, and the matrix grows by
+    growth_factor when full, so none of these operations depend on the number of stored chunks.
+    search() has the same interface and results as IndexIDMap(IndexFlatL2).search, and can be limited to some ids.
+
+    precision: "float32" (exact), "float16" (half the memory) or "int8" (a quarter; symmetric scalar
+    quantization with one float32 scale per vector). An exact search dequantizes SEARCH_BLOCK_ROWS rows at a time
+    and merges the top-k of every block, so no full float32 copy of the store is made.
+    truncate_dim: keep only the first truncate_dim components of every vector (and query).
+    ann_threshold: once the store holds this many vectors, search goes through an approximate IVF index
+    (built from the stored vectors, updated on every upsert/removal, retrained as the store grows) probing
+    ann_nprobe lists, whose lists hold float16/int8 stores scalar-quantized as well (IndexIVFScalarQuantizer).
+    None keeps the exact search. The matrix stays the source of truth either way.
+    """
+    def __init__(self, dimension, initial_capacity=64, growth_factor=2.0, precision="float32", truncate_dim=None,
+                 ann_threshold=None, ann_nprobe=16):
+        if precision not in VECTOR_PRECISIONS:
+            raise ValueError(f"Unsupported vector precision '{precision}', expected one of {VECTOR_PRECISIONS}.")
+        self.dimension = dimension
+        self.stored_dimension = min(truncate_dim, dimension) if truncate_dim else dimension
+        self.precision = precision
+        self.growth_factor = growth_factor
+        capacity = max(1, initial_capacity)
+        self.vectors = np.zeros((capacity, self.stored_dimension), dtype=self._storage_dtype)
+        self.scales = np.ones(capacity, dtype='float32') if precision == "int8" else None # int8 only
+        self.row_ids = np.full(capacity, -1, dtype='int64') # row -> chunk_id
+        self.id_to_row = {}
+        self.ntotal = 0
+        self.ann_threshold = ann_threshold
+        self.ann_nprobe = ann_nprobe
+        self.ann_index = None # faiss.IndexIVFFlat (IndexIVFScalarQuantizer below float32) keyed by chunk_id, once ntotal reached ann_threshold
+        self.ann_trained_size = 0
+
+    @property
+    def _storage_dtype(self):
+        return {"float32": 'float32', "float16": 'float16', "int8": 'int8'}[self.precision]
+
+    def __contains__(self, chunk_id):
+        return chunk_id in self.id_to_row
+
+    @property
+    def capacity(self):
+        return self.vectors.shape[0]
+
+    @property
+    def nbytes(self):
+        """Bytes held by the stored vectors (allocated capacity, not only live rows)."""
+        return self.vectors.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    @property
+    def index_info(self):
+        """Which search the store uses now: exact "flat" or approximate "ivf" (with its lists and probes)."""
+        info = {"index": "ivf" if self.ann_index is not None else "flat", "ntotal": self.ntotal}
+        if self.ann_index is not None:
+            info.update({"nlist": self.ann_index.nlist, "nprobe": self.ann_index.nprobe, "trained_size": self.ann_trained_size})
+        return info
+
+    def _grow(self, min_capacity):
+        new_capacity = max(min_capacity, int(self.capacity * self.growth_factor) + 1)
+        vectors = np.zeros((new_capacity, self.stored_dimension), dtype=self._storage_dtype)
+        vectors[:self.ntotal] = self.vectors[:self.ntotal]
+        if self.scales is not None:
+            scales = np.ones(new_capacity, dtype='float32')
+            scales[:self.ntotal] = self.scales[:self.ntotal]
+            self.scales = scales
+        row_ids = np.full(new_capacity, -1, dtype='int64')
+        row_ids[:self.ntotal] = self.row_ids[:self.ntotal]
+        self.vectors, self.row_ids = vectors, row_ids
+        logger.debug(f"[VectorStore] Grew capacity to {new_capacity}.")
+
+    def _prepare(self, vecs):
+        """float32 (n, stored_dimension) view of full or already truncated vectors."""
+        vecs = np.asarray(vecs, dtype='float32')
+        vecs = vecs.reshape(-1, vecs.shape[-1])
+        return np.ascontiguousarray(vecs[:, :self.stored_dimension])
+
+    def _write_row(self, row, vec):
+        if self.precision == "int8":
+            scale = float(np.abs(vec).max()) / 127.0
+            scale = scale if scale > 0 else 1.0
+            self.vectors[row] = np.clip(np.rint(vec / scale), -127, 127)
+            self.scales[row] = scale
+        else:
+            self.vectors[row] = vec
+
+    def upsert(self, ids, vecs):
+        """Inserts new ids and overwrites the rows of existing ones."""
+        vecs = self._prepare(vecs)
+        new_count = sum(1 for chunk_id in ids if int(chunk_id) not in self.id_to_row)
+        if self.ntotal + new_count > self.capacity:
+            self._grow(self.ntotal + new_count)
+        written_rows = []
+        for chunk_id, vec in zip(ids, vecs):
+            chunk_id = int(chunk_id)
+            row = self.id_to_row.get(chunk_id)
+            if row is None:
+                row = self.ntotal
+                self.id_to_row[chunk_id] = row
+                self.row_ids[row] = chunk_id
+                self.ntotal += 1
+            self._write_row(row, vec)
+            written_rows.append(row)
+
+        if self._needs_ann_training():
+            self._train_ann_index()
+        elif self.ann_index is not None and written_rows:
+            # Overwritten ids are removed first, so the index holds one (the latest) vector per chunk
+            rows = np.unique(written_rows)
+            row_ids = np.ascontiguousarray(self.row_ids[rows])
+            self._ann_remove(row_ids)
+            self.ann_index.add_with_ids(self._rows_float32(rows), row_ids)
+
+    def add_with_ids(self, vecs, ids):
+        self.upsert(ids, vecs)
+
+    def remove_ids(self, ids):
+        removed = 0
+        removed_ids = []
+        for chunk_id in np.asarray(ids).reshape(-1):
+            row = self.id_to_row.pop(int(chunk_id), None)
+            if row is None:
+                continue
+            removed_ids.append(int(chunk_id))
+            last = self.ntotal - 1
+            if row != last:
+                self.vectors[row] = self.vectors[last]
+                if self.scales is not None:
+                    self.scales[row] = self.scales[last]
+                moved_id = int(self.row_ids[last])
+                self.row_ids[row] = moved_id
+                self.id_to_row[moved_id] = row
+            self.row_ids[last] = -1
+            self.ntotal -= 1
+            removed += 1
+        if self.ann_index is not None and removed_ids:
+            self._ann_remove(removed_ids)
+        return removed
+
+    def _needs_ann_training(self):
+        if not self.ann_threshold or self.ntotal < self.ann_threshold:
+            return False
+        return self.ann_index is None or self.ntotal >= self.ann_trained_size * ANN_RETRAIN_FACTOR
+
+    def _train_ann_index(self):
+        """(Re)builds the IVF index over every stored vector, trained on a bounded sample of them."""
+        nlist = max(1, min(int(np.sqrt(self.ntotal)), self.ntotal // ANN_MIN_POINTS_PER_LIST))
+        quantizer = faiss.IndexFlatL2(self.stored_dimension)
+        if self.precision in ANN_SCALAR_QUANTIZERS:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, self.stored_dimension, nlist, ANN_SCALAR_QUANTIZERS[self.precision], faiss.METRIC_L2)
+        else:
+            index = faiss.IndexIVFFlat(quantizer, self.stored_dimension, nlist)
+        sample_size = min(self.ntotal, nlist * ANN_MAX_POINTS_PER_LIST)
+        sample = np.sort(np.random.default_rng(0).choice(self.ntotal, sample_size, replace=False)) if sample_size < self.ntotal else np.arange(self.ntotal)
+        index.train(self._rows_float32(sample))
+        index.set_direct_map_type(faiss.DirectMap.Hashtable) # removal by id without scanning the lists
+        for start in range(0, self.ntotal, SEARCH_BLOCK_ROWS):
+            stop = min(start + SEARCH_BLOCK_ROWS, self.ntotal)
+            index.add_with_ids(np.ascontiguousarray(self.get_vectors(start, stop)), np.ascontiguousarray(self.row_ids[start:stop]))
+        index.nprobe = min(self.ann_nprobe, nlist)
+        self._ann_quantizer = quantizer # the index does not own it
+        self.ann_index = index
+        self.ann_trained_size = self.ntotal
+        logger.info(f"[VectorStore] Switched to an IVF index ({nlist} lists, nprobe {index.nprobe}) over {self.ntotal} vectors.")
+
+    def _ann_remove(self, ids):
+        ids = np.ascontiguousarray(ids, dtype='int64')
+        self.ann_index.remove_ids(faiss.IDSelectorArray(len(ids), faiss.swig_ptr(ids)))
+
+    def _rows_float32(self, rows):
+        vectors = self.vectors[rows]
+        if self.precision == "float32":
+            return np.ascontiguousarray(vectors)
+        if self.precision == "float16":
+            return vectors.astype('float32')
+        return vectors.astype('float32') * self.scales[rows, None]
+
+    def get_vectors(self, start=0, stop=None):
+        """Live rows [start, stop) as float32 (dequantized), shape (rows, stored_dimension)."""
+        stop = self.ntotal if stop is None else min(stop, self.ntotal)
+        vectors = self.vectors[start:stop]
+        if self.precision == "float32":
+            return vectors
+        if self.precision == "float16":
+            return vectors.astype('float32')
+        return vectors.astype('float32') * self.scales[start:stop, None]
+
+    def get_vector(self, chunk_id):
+        row = self.id_to_row.get(chunk_id)
+        return None if row is None else self.get_vectors(row, row + 1)[0]
+
+    def search(self, queries, k, exact=False, among_ids=None):
+        """
+        Returns (squared L2 distances, chunk ids), both of shape (len(queries), k); missing slots are -1.
+        Uses the IVF index once there is one, unless exact is set.
+        among_ids: only these chunk ids are searched (e.g. the chunks a viewer saw), the others are never returned.
+        Fewer of them than ann_threshold are searched exactly; more go through the IVF index with the other ids
+        filtered out, probing more lists the fewer ids are searched, so about as many of them are compared.
+        """
+        queries = np.asarray(queries, dtype='float32').reshape(-1, self.dimension)
+        queries = np.ascontiguousarray(queries[:, :self.stored_dimension])
+        distances = np.full((queries.shape[0], k), np.inf, dtype='float32')
+        ids = np.full((queries.shape[0], k), -1, dtype='int64')
+        if among_ids is not None:
+            among_ids = np.ascontiguousarray(among_ids, dtype='int64').reshape(-1)
+        searched = self.ntotal if among_ids is None else min(len(among_ids), self.ntotal)
+        if searched == 0 or k <= 0:
+            return distances, ids
+        if self.ann_index is not None and not exact and searched >= self.ann_threshold:
+            actual_k = min(k, searched)
+            params = None
+            if among_ids is not None:
+                # The lists hold chunk ids; the selector skips the others while the probed lists are scanned
+                nprobe = min(self.ann_index.nlist, -(-self.ann_index.nprobe * self.ntotal // searched))
+                params = faiss.SearchParametersIVF(sel=faiss.IDSelectorBatch(among_ids), nprobe=nprobe)
+            found_distances, found_ids = self.ann_index.search(queries, actual_k, params=params)
+            distances[:, :actual_k] = np.where(found_ids >= 0, found_distances, np.inf)
+            ids[:, :actual_k] = found_ids
+            return distances, ids
+        among_rows = None
+        if among_ids is not None:
+            among_rows = np.array([self.id_to_row[chunk_id] for chunk_id in among_ids.tolist() if chunk_id in self.id_to_row], dtype='int64')
+            if len(among_rows) == 0:
+                return distances, ids
+        actual_k = min(k, self.ntotal if among_rows is None else len(among_rows))
+        if self.precision == "float32" and among_rows is None:
+            found_distances, rows = faiss.knn(queries, self.vectors[:self.ntotal], actual_k)
+        else:
+            found_distances, rows = self._blockwise_knn(queries, actual_k, among_rows)
+        distances[:, :actual_k] = found_distances
+        ids[:, :actual_k] = np.where(rows >= 0, self.row_ids[np.maximum(rows, 0)], -1)
+        return distances, ids
+
+    def _blockwise_knn(self, queries, k, among_rows=None):
+        """
+        faiss.knn over the dequantized rows (or only among_rows), SEARCH_BLOCK_ROWS at a time: the top-k of every
+        block, merged.
+        """
+        block_distances, block_rows = [], []
+        searched = self.ntotal if among_rows is None else len(among_rows)
+        for start in range(0, searched, SEARCH_BLOCK_ROWS):
+            stop = min(start + SEARCH_BLOCK_ROWS, searched)
+            if among_rows is None:
+                vectors, rows_of_block = self.get_vectors(start, stop), np.arange(start, stop)
+            else:
+                vectors, rows_of_block = self._rows_float32(among_rows[start:stop]), among_rows[start:stop]
+            found_distances, rows = faiss.knn(queries, np.ascontiguousarray(vectors), min(k, stop - start))
+            block_distances.append(found_distances)
+            block_rows.append(np.where(rows >= 0, rows_of_block[np.maximum(rows, 0)], -1))
+        if len(block_distances) == 1:
+            return block_distances[0], block_rows[0]
+        distances, rows = np.hstack(block_distances), np.hstack(block_rows)
+        best = np.argsort(distances, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(distances, best, axis=1), np.take_along_axis(rows, best, axis=1)
+
+    def recall_check(self, queries, k=10):
+        """
+        Recall@k of the current search against the exact search for the given queries, with the latency of
+        both in milliseconds per query. With no IVF index the recall is 1 by definition.
+        """
+        queries = np.asarray(queries, dtype='float32').reshape(-1, self.dimension)
+        start = time.perf_counter()
+        _, exact_ids = self.search(queries, k, exact=True)
+        exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        start = time.perf_counter()
+        _, found_ids = self.search(queries, k)
+        search_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        hits = [len(set(found[found >= 0]) & set(exact[exact >= 0])) / max(1, int((exact >= 0).sum()))
+                for found, exact in zip(found_ids, exact_ids)]
+        return {**self.index_info, f"recall@{k}": float(np.mean(hits)), "search_ms": search_ms, "exact_ms": exact_ms}